@@ -5,6 +5,7 @@ import numpy as np
 import envtb.time_propagator.lanczos
 import envtb.time_propagator.wave_function
 import envtb.time_propagator.vector_potential
+import envtb.time_propagator.ensemble
 import envtb.wannier90.w90hamiltonian as w90hamiltonian
 
 ##directory = '/tmp/'
@@ -52,14 +53,9 @@ def propagate_graphene_pulse(Nx=20, Ny=20, frame_num=10, magnetic_B=None):
 
     Nall = 250
 
-    w, v = ham.sorted_eigenvalue_problem(k=Nall, sigma=0.0)
-
-    '''
-        Store eigenvalue_problem
-    '''
-    fout = open('eigenvalue_problem.out', 'w')
-    for i in range(Nall):
-        fout.writelines(repr(w[i])+'   '+repr(v[:,i].tolist())+'\n')
+    # the eigenpairs are stored in .envtb_cache and reused by the next runs
+    # with the same hamiltonian
+    w, v = ham.sorted_eigenvalue_problem(k=Nall, sigma=0.0, cache=True)
 
 
     ''' Make vector potential'''
@@ -67,76 +63,13 @@ def propagate_graphene_pulse(Nx=20, Ny=20, frame_num=10, magnetic_B=None):
     A_pot = envtb.time_propagator.vector_potential.SinSqEnvelopePulse(
         amplitude_E0=laser_amp, frequency=laser_freq, Nc=Nc, cep=CEP, direction=direct)
 
-    import pypar
-
-    proc = pypar.size()                                # Number of processes as specified by mpirun
-    myid = pypar.rank()                                # Id of of this process (myid in [0, proc-1]) 
-    node = pypar.get_processor_name()                  # Host name on which current process is running
-
-    Nthread = Nall / proc
-
-    N_range = list(range(myid * Nthread, (myid + 1) * Nthread, 10))
-
-    for Nstate in N_range:
-
-        wf_out = open('wave_functions_%(Nstate)d.out' % vars(), 'w')
-        expansion_out = open('expansion_%(Nstate)d.out' % vars(), 'w')
-        coords_out = open('coords_current_%(Nstate)d.out' % vars(), 'w')
-        dipole_out = open('dipole_%(Nstate)d.out' % vars(), 'w')
-
-        dt_new = dt
-        NK_new = NK
-        time_counter = 0.0
-
-        '''initialize wave function
-        create wave function from file (WaveFunction(coords=ham.coords).wave_function_from_file),
-        wave function from eigenstate (WaveFunction(vec=v[:, Nstate],coords=ham.coords)) or
-        create Gaussian wave packet (GaussianWavePacket(coords=ham.coords, ic=ic, p0=[0.0, 1.5], sigma=7.))
-        '''
-        #wf_final = envtb.time_propagator.wave_function.WaveFunction(coords=ham.coords)
-        #time_counter = wf_final.wave_function_from_file('wave_functions_0.out')
-        wf_final = envtb.time_propagator.wave_function.WaveFunction(vec=v[:, Nstate],coords=ham.coords)
-        ##ic = Nx/2 * Ny + Ny/2
-        ##wf_final = envtb.time_propagator.wave_function.GaussianWavePacket(
-        ##        ham.coords, ic, p0=[0.0, 1.5], sigma=7.)
-        #maxel = max(wf_final.wf1d)
-
-        wf_final.save_wave_function_data(wf_out, time_counter)
-
-        import time
-
-        '''main loop'''
-        for i in range(frame_num):
-
-            #print 'frame %(i)d' % vars()
-            time_counter += dt_new
-
-            st = time.time()
-            ham2 = ham.apply_vector_potential(A_pot(time_counter))
-            #print 'efficiency ham2', time.time() - st
-
-            #print 'time', time_counter, 'A', A_pot(time)
-            st = time.time()
-            wf_init = wf_final
-            wf_final, dt_new, NK_new = propagate_wave_function(
-                  wf_init, ham2, NK=NK_new, dt=dt_new, maxel=None,
-                  regime='TSC', alpha=0.7)
-                  #file_out = directory+'f%03d_2d.png' % i)
-            #print 'efficiency lanz', time.time() - st
-
-            if np.mod(i,10) == 0:
-                  wf_final.save_wave_function_data(wf_out, time_counter)
-                  wf_final.save_wave_function_expansion(expansion_out, v)
-                  wf_final.save_coords_current(coords_out, A_pot(time))
-
-
-        wf_out.close()
-        expansion_out.close()
-        coords_out.close()
-        dipole_out.close()
-
-    pypar.finalize()
+    # the states are propagated on all cores of this node, each with a
+    # checkpoint, so that a killed run continues where it stopped
+    ensemble = envtb.time_propagator.ensemble.EnsemblePropagation(
+        ham, A_pot, (w, v), dt=dt, nframes=frame_num, NK=NK)
+    ensemble.run(list(range(0, Nall, 10)), nprocs=None)
 
     return None
 
-propagate_graphene_pulse(Nx=Nx, Ny=Ny, frame_num=Nframes)
+if __name__ == '__main__':
+    propagate_graphene_pulse(Nx=Nx, Ny=Ny, frame_num=Nframes)
@@ -5,6 +5,7 @@ import numpy as np
 import matplotlib.pylab as plt
 import envtb.time_propagator.lanczos
 import envtb.time_propagator.wave_function
+import envtb.time_propagator.time_dependent_hamiltonian
 import envtb.wannier90.w90hamiltonian as w90hamiltonian
 
 directory = '/tmp/'
@@ -86,15 +87,17 @@ def propagate_el_den_TB(Nx=50, Ny=40, mu=0.05, frame_num=100):
     plt.savefig('../../../../Desktop/pics_2d/TB/0%d_2d.png' % 0)
     plt.close()
                     
+    # H(t) is updated in place, the potential is evaluated on all sites at once
+    ham_t = envtb.time_propagator.time_dependent_hamiltonian.TimeDependentHamiltonian(
+        ham, scalar_potential=lambda t: envtb.ldos.potential.Potential1DFromFunction(
+            lambda x: -5. * (Ny/2 - x) * 2. / Ny * np.sin(0.1 * t)))
+                    
     for i in range(frame_num):
         
-        potential = envtb.ldos.potential.Potential1DFromFunction(
-            lambda x: -5. * (Ny/2 - x) * 2. / Ny * np.sin(0.1 * i))
-        
-        ham2 = ham.apply_potential(potential)
+        ham_t.update(i)
         
         envtb.ldos.plotter.Plotter().plot_potential(
-            ham2, ham, maxel = 5, minel = -5)
+            ham_t, ham, maxel = 5, minel = -5)
         
         plt.axes().set_aspect('equal')
         plt.savefig('../../../../Desktop/pics_2d/TB/pot%03d_2d.png' % i)
@@ -102,8 +105,8 @@ def propagate_el_den_TB(Nx=50, Ny=40, mu=0.05, frame_num=100):
         
         
         wf_init = wf_final
-        wf_final = propagate_wave_function(wf_init, ham2, maxel = maxel, 
-            file_out = '../../../../Desktop/pics_2d/TB/f%03d_2d.png' % i)
+        wf_final = propagate_wave_function(wf_init, ham_t, maxel = maxel, 
+            file_out = '../../../../Desktop/pics_2d/TB/f%03d_2d.png' % i)[0]
     
     return None
     
@@ -0,0 +1,332 @@
+"""
+Electron density n_i = <i|f(H)|i> (f: Fermi function) of a tight-binding
+Hamiltonian without the dense Ntot x Ntot matrices.
+
+Two modes:
+'chebyshev': f(H) is expanded in Chebyshev polynomials and applied to probe
+    vectors (or random vectors) with sparse matrix-vector products only. No
+    diagonalization is needed, the cost is O(nnz * nmoments * nr of vectors).
+'exact': n_i = sum_n f(E_n) |v_n,i|^2 from eigenpairs (all eigenpairs from a
+    dense diagonalization, or the ones you supply).
+
+Example:
+>>> dens = electron_density(H, mu=0.1, kT=0.0025)
+"""
+
+import numpy as np
+import scipy.sparse
+import scipy.fft
+import scipy.sparse.csgraph
+from . import kpm
+
+# relative margin of the spectral bounds, so that the rescaled spectrum
+# stays inside [-1, 1] even if the bounds are slightly underestimated
+SPECTRAL_MARGIN = 0.05
+
+
+def fermi_function(E, mu, kT):
+    """
+    Fermi function, also for kT=0 (step function, f(mu)=1/2).
+    """
+    E = np.asarray(E).real
+    if kT == 0:
+        return np.where(E < mu, 1., np.where(E > mu, 0., 0.5))
+    return 0.5 * (1. - np.tanh((E - mu) / (2. * kT)))
+
+
+def fermi_chebyshev_coefficients(mu, kT, nmoments, scale, shift,
+                                 kernel=None):
+    """
+    Chebyshev coefficients c_n of f(scale * x + shift) on [-1, 1],
+    calculated with a Chebyshev-Gauss quadrature on 2*nmoments nodes. The
+    quadrature sums are a discrete cosine transform (O(nmoments log
+    nmoments) time, O(nmoments) memory).
+
+    kernel: None keeps the plain coefficients, which converge exponentially
+    once nmoments is a few times scale/kT. 'jackson' damps the Gibbs
+    oscillations at the Fermi edge if kT is smaller than the resolution
+    scale/nmoments (e.g. kT=0).
+    """
+    nodes = 2 * nmoments
+    theta = np.pi * (np.arange(nodes) + 0.5) / nodes
+    f = fermi_function(scale * np.cos(theta) + shift, mu, kT)
+    # dct type 2: y_n = 2 sum_k f_k cos(n theta_k)
+    coefficients = scipy.fft.dct(f, type=2)[:nmoments] / nodes
+    coefficients[0] /= 2.
+    if kernel == 'jackson':
+        coefficients *= kpm.jackson_kernel(nmoments)
+    elif kernel is not None:
+        raise ValueError('Unknown kernel: %s' % kernel)
+    return coefficients
+
+
+def apply_chebyshev_series(matrix, vectors, coefficients, scale, shift):
+    """
+    Calculates sum_n c_n T_n((H - shift) / scale) |v> for a block of vectors.
+    """
+    def apply_scaled(a):
+        return (matrix.dot(a) - shift * a) / scale
+
+    a0 = vectors
+    result = coefficients[0] * a0
+    if len(coefficients) > 1:
+        a1 = apply_scaled(a0)
+        result = result + coefficients[1] * a1
+        for c in coefficients[2:]:
+            a0, a1 = a1, 2 * apply_scaled(a1) - a0
+            result += c * a1
+    return result
+
+
+def probe_colors(matrix, distance=4, coords=None, max_nnz=10**7):
+    """
+    Colors the sites so that sites of the same color are more than distance
+    hoppings apart.
+
+    If distance is at least the diameter of the lattice (in hoppings), every
+    site gets its own color. Otherwise the colors are maximal independent
+    sets of the pattern of H^distance, found in vectorized rounds (Luby's
+    algorithm). If that pattern has more than max_nnz elements, the sites
+    are sorted into cells of side distance * (longest hopping) with the
+    coordinates coords instead: sites of the same color are in different
+    cells of the same parity. Without coordinates, every site gets its own
+    color.
+
+    Return:
+    Array with the color of each site.
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    N = matrix.shape[0]
+    if distance >= _diameter_bound(matrix):
+        return np.arange(N)
+    reach = _reach_pattern(matrix, distance, max_nnz)
+    if reach is None:
+        if coords is None:
+            return np.arange(N)
+        return _cell_colors(matrix, distance, coords)
+
+    # a candidate site joins the current color if it has the highest
+    # (random) priority of the candidates it reaches, then it and all sites
+    # it reaches are no candidates any more
+    priority = np.random.RandomState(0).permutation(N).astype(float)
+    colors = -np.ones(N, dtype=int)
+    color = 0
+    while np.any(colors < 0):
+        candidates = colors < 0
+        chosen = np.zeros(N, dtype=bool)
+        while np.any(candidates):
+            p = np.where(candidates, priority, -1.)
+            highest = np.maximum.reduceat(p[reach.indices], reach.indptr[:-1])
+            winners = candidates & (p >= highest)
+            chosen |= winners
+            candidates &= ~(reach.dot(winners.astype(float)) > 0)
+        colors[chosen] = color
+        color += 1
+    return colors
+
+
+def _diameter_bound(matrix):
+    """
+    Upper bound of the diameter (in hoppings) of the connected parts of the
+    lattice: twice the largest distance from one site of each part.
+    """
+    graph = scipy.sparse.csr_matrix(
+        (np.ones(matrix.nnz), matrix.indices, matrix.indptr),
+        shape=matrix.shape)
+    ncomponents, labels = scipy.sparse.csgraph.connected_components(
+        graph, directed=False)
+    first = np.unique(labels, return_index=True)[1]
+    distances = scipy.sparse.csgraph.shortest_path(
+        graph, directed=False, unweighted=True, indices=first)
+    return 2 * int(np.max(distances[np.isfinite(distances)]))
+
+
+def _reach_pattern(matrix, distance, max_nnz):
+    """
+    Boolean pattern of (1 + H)^distance, None if it gets bigger than max_nnz.
+    """
+    N = matrix.shape[0]
+    pattern = scipy.sparse.csr_matrix(matrix, dtype=bool)
+    pattern = (pattern + scipy.sparse.identity(N, dtype=bool,
+                                               format='csr')).tocsr()
+    reach = pattern
+    for i in range(distance - 1):
+        reach = reach.dot(pattern).tocsr()
+        if reach.nnz > max_nnz:
+            return None
+    reach.data[:] = True
+    return reach
+
+
+def _cell_colors(matrix, distance, coords):
+    """
+    Colors from the cell of side distance * (longest hopping) of each site:
+    its parity and the rank of the site inside the cell.
+    """
+    coords = np.asarray(coords, dtype=float)[:matrix.shape[0]]
+    coo = matrix.tocoo()
+    hops = coo.row != coo.col
+    if not np.any(hops):
+        return np.zeros(matrix.shape[0], dtype=int)
+    bond = np.sqrt(np.max(np.sum((coords[coo.col[hops]] -
+                                  coords[coo.row[hops]])**2, axis=1)))
+    cell = np.floor((coords - coords.min(axis=0)) /
+                    (distance * bond)).astype(int)
+    cell_id = np.unique(cell, axis=0, return_inverse=True)[1].ravel()
+    order = np.argsort(cell_id, kind='stable')
+    rank = np.empty(len(cell_id), dtype=int)
+    rank[order] = np.arange(len(cell_id)) - \
+        np.searchsorted(cell_id[order], cell_id[order])
+    colors = np.column_stack([cell % 2, rank])
+    return np.unique(colors, axis=0, return_inverse=True)[1].ravel()
+
+
+class ElectronDensity:
+    """
+    Electron density engine for one Hamiltonian. The expensive parts
+    (spectral bounds, probe colors, eigenpairs) are calculated once and
+    reused for different mu and kT.
+    """
+
+    def __init__(self, H, method='chebyshev', nmoments=None, vectors='probe',
+                 probe_distance=None, probe_error=1e-4, nrandom=20, seed=None,
+                 bounds=None, blocksize=32, kernel=None, eigenpairs=None):
+        """
+        H: GeneralHamiltonian, w90hamiltonian.Hamiltonian (main cell) or
+        sparse matrix, see kpm.sparse_hamiltonian_matrix().
+        method: 'chebyshev' or 'exact'. 'chebyshev' needs about
+        4 * (half bandwidth) / kT moments per probe vector; at low kT, 'exact'
+        is faster for systems small enough for a dense diagonalization.
+
+        Parameters of 'chebyshev':
+        nmoments: number of Chebyshev moments. If None, it is chosen from kT
+        (4 * half bandwidth / kT, at least 200). Must be given for kT=0.
+        vectors: 'probe': sites more than probe_distance hoppings apart are
+                 probed together, and the elements of f(H) between them are
+                 added to the density. If probe_distance is None, it is the
+                 smallest distance d with sum_{n>=d} |c_n| < probe_error
+                 (c_n: Chebyshev coefficients of f), which bounds every
+                 neglected element of the series. The elements decay over
+                 about (half bandwidth)/(pi kT) hoppings, so at low kT
+                 probing only groups sites of large lattices.
+                 'random': stochastic estimate of the diagonal with nrandom
+                 random phase vectors. The error of each site is about
+                 1/sqrt(nrandom), good for totals, not for site densities.
+                 'sites': one unit vector per site (exact, but expensive).
+        bounds: (emin, emax) of the spectrum. If None, it is calculated.
+                They must enclose the spectrum; they are widened by
+                SPECTRAL_MARGIN.
+        blocksize: number of vectors propagated together.
+        kernel: see fermi_chebyshev_coefficients(). Use 'jackson' for kT=0.
+
+        Parameter of 'exact':
+        eigenpairs: (w, v) with the eigenvectors in the columns, e.g. from
+        H.eigenvalue_problem(). If None, all eigenpairs are calculated with
+        a dense solver.
+        """
+        if method not in ('chebyshev', 'exact'):
+            raise ValueError('Unknown method: %s' % method)
+        if vectors not in ('probe', 'random', 'sites'):
+            raise ValueError('Unknown vectors: %s' % vectors)
+        self.matrix = kpm.sparse_hamiltonian_matrix(H)
+        self.coords = None
+        if getattr(H, 'coords', None) is not None and \
+                hasattr(H, 'coords_array'):
+            self.coords = H.coords_array()
+        self.Ntot = self.matrix.shape[0]
+        self.method = method
+        self.nmoments = nmoments
+        self.vectors = vectors
+        self.probe_distance = probe_distance
+        self.probe_error = probe_error
+        self.nrandom = nrandom
+        self.seed = seed
+        self.blocksize = blocksize
+        self.kernel = kernel
+        self.__bounds = bounds
+        self.__colors = {}
+        self.__eigenpairs = eigenpairs
+
+    def __call__(self, mu, kT):
+        """
+        Site density n_i (occupation per site, without spin) at the chemical
+        potential mu and temperature kT (both in eV).
+        """
+        if self.method == 'exact':
+            return self.__exact(mu, kT)
+        return self.__chebyshev(mu, kT)
+
+    def __exact(self, mu, kT):
+        if self.__eigenpairs is None:
+            self.__eigenpairs = np.linalg.eigh(self.matrix.toarray())
+        w, v = self.__eigenpairs
+        return np.dot(np.abs(v)**2, fermi_function(w, mu, kT))
+
+    def __chebyshev(self, mu, kT):
+        if self.__bounds is None:
+            self.__bounds = kpm.spectral_bounds(self.matrix)
+        emin, emax = self.__bounds
+        scale = (emax - emin) / 2. * (1. + SPECTRAL_MARGIN)
+        shift = (emax + emin) / 2.
+
+        nmoments = self.nmoments
+        if nmoments is None:
+            if kT == 0:
+                raise ValueError('Supply nmoments for kT=0')
+            nmoments = max(200, int(np.ceil(4. * scale / kT)))
+        coefficients = fermi_chebyshev_coefficients(mu, kT, nmoments,
+                                                    scale, shift, self.kernel)
+
+        density = np.zeros(self.Ntot)
+        distance = self.probe_distance
+        if distance is None:
+            tail = np.cumsum(np.abs(coefficients)[::-1])[::-1]
+            distance = max(1, int(np.count_nonzero(tail >= self.probe_error)))
+        for vectors, sites in self.__vector_blocks(distance):
+            fv = apply_chebyshev_series(self.matrix, vectors, coefficients,
+                                        scale, shift)
+            if sites is None:
+                # stochastic estimate: mean of conj(r) * f(H) r
+                density += np.sum(vectors.conj() * fv, axis=1).real
+            else:
+                rows, columns = sites
+                density[rows] += fv[rows, columns].real
+        if self.vectors == 'random':
+            density /= self.nrandom
+        return density
+
+    def __vector_blocks(self, distance):
+        """
+        Yields blocks of vectors and, for probe and site vectors, the
+        (site, column) pairs whose elements belong to the diagonal.
+        """
+        if self.vectors == 'random':
+            random = np.random.RandomState(self.seed)
+            for start in range(0, self.nrandom, self.blocksize):
+                n = min(self.blocksize, self.nrandom - start)
+                yield np.exp(2j * np.pi * random.random_sample((self.Ntot, n))), None
+            return
+
+        if self.vectors == 'sites':
+            colors = np.arange(self.Ntot)
+        else:
+            if distance not in self.__colors:
+                self.__colors[distance] = probe_colors(self.matrix, distance,
+                                                       self.coords)
+            colors = self.__colors[distance]
+
+        ncolors = colors.max() + 1
+        for start in range(0, ncolors, self.blocksize):
+            end = min(start + self.blocksize, ncolors)
+            rows = np.nonzero((colors >= start) & (colors < end))[0]
+            columns = colors[rows] - start
+            vectors = np.zeros((self.Ntot, end - start))
+            vectors[rows, columns] = 1.
+            yield vectors, (rows, columns)
+
+
+def electron_density(H, mu, kT, method='chebyshev', **kwargs):
+    """
+    Site density n_i = <i|f(H)|i>. See ElectronDensity for the parameters.
+    """
+    return ElectronDensity(H, method=method, **kwargs)(mu, kT)
@@ -2,14 +2,34 @@ from . import hamiltonian
 from scipy import sparse
 from scipy.sparse import linalg
 import numpy as np
+import warnings
 from . import make_matrix as mm
+from . import leads
+
+
+class SliceStructureError(ValueError):
+    """
+    The Hamiltonian does not consist of Nx slices of Ny sites with couplings
+    between neighbouring slices only, so the recursive Green's function
+    cannot be used.
+    """
+
 
 class GreensFunction:
     """
     Class 
     """
     
-    def __init__(self, H, E, bc='closed'):
+    def __init__(self, H, E, bc='closed', method='recursive'):
+        """
+        H: hamiltonian.GeneralHamiltonian
+        E: energy
+        bc: 'closed' or 'open'. With 'open', semi-infinite leads made of the slices
+        (H.m0, H.mI) are attached to the first and the last slice (see leads).
+        method: 'recursive' uses the slice structure of H (RecursiveGreensFunction)
+        and falls back to 'direct' (sparse LU of the full matrix) if H has hoppings
+        beyond neighbouring slices, e.g. after make_periodic_x.
+        """
         
         self.bc = bc
 
@@ -23,29 +43,51 @@ class GreensFunction:
         self.Ntot = H.Ntot
         self.E = E
         self.H = H
+        self.method = method
               
     def __inv_greens_matrix(self, E, H):
         
         zplus = complex(0.0, 1.0) * 10**(-12)
-        #sig1 = np.zeros((H.Ny * Nx, H.Ny * Nx), dtype = complex)
-        #sig2 = np.zeros((H.Ny * Nx, H.Ny * Nx), dtype = complex)
-      
-        #if self.bc == 'open':
-        #sig1[0,0] = self.calculate_self_energy_for_1d(E, -0.05)
-        #sig2[-1,-1] = self.calculate_self_energy_for_1d(E, 0.05)
         matrix = (E + zplus) * sparse.eye(H.Ntot, H.Ntot, k = 0, dtype = complex) - H.mtot
+      
+        if self.bc == 'open':
+            sigma_left, sigma_right = self.__lead_self_energies()
+            matrix = matrix.tolil()
+            matrix[:H.Ny, :H.Ny] = matrix[:H.Ny, :H.Ny] - sigma_left
+            matrix[-H.Ny:, -H.Ny:] = matrix[-H.Ny:, -H.Ny:] - sigma_right
         solver = linalg.factorized(matrix.tocsc())
         return solver
     
     def get_diagonal_elements(self):
         
-        vec = np.eye(self.Ntot, self.Ntot)
+        if self.method == 'recursive':
+            sigma_left, sigma_right = None, None
+            if self.bc == 'open':
+                sigma_left, sigma_right = self.__lead_self_energies()
+            try:
+                recursive = RecursiveGreensFunction(self.H, self.E, sigma_left=sigma_left,
+                                                    sigma_right=sigma_right)
+            except SliceStructureError as error:
+                warnings.warn('%s, using the direct inverse instead' % error)
+            else:
+                return recursive.get_diagonal_elements()
+        elif self.method != 'direct':
+            raise ValueError('Unknown method: %s' % self.method)
+        
         Green_solver = self.__inv_greens_matrix(self.E, self.H)
         
-        Green_diagonal = np.array([Green_solver(vec[:, i])[i] for i in range(self.Ntot)])
+        Green_diagonal = np.zeros(self.Ntot, dtype=complex)
+        vec = np.zeros(self.Ntot, dtype=complex)
+        for i in range(self.Ntot):
+            vec[i] = 1.
+            Green_diagonal[i] = Green_solver(vec)[i]
+            vec[i] = 0.
         
         return Green_diagonal
     
+    def __lead_self_energies(self):
+        return leads.lead_self_energies(self.E, self.H.m0, self.H.mI)
+    
     def __calculate_self_energy_for_1d(self, Ef, U):
         zplus = complex(0.0,1.0) * 10**(-12)
         ck = (1.-((Ef + zplus - U)/(2. * mm.t)))
@@ -55,3 +97,156 @@ class GreensFunction:
         return sigma
 
 
+class RecursiveGreensFunction:
+    """
+    Recursive Green's function G(E) = (E + i0 - H)^-1 of a Hamiltonian made of
+    Nx slices with Ny sites each, where only neighbouring slices are coupled.
+    
+    The blocks are taken from H.mtot, so potentials, fields etc. that were
+    applied to mtot are included. The slices are swept from right to left
+    (right-connected Green's functions gR_i) and then from left to right:
+        G_11 = gR_1
+        G_i+1,i+1 = gR_i+1 + gR_i+1 H_i+1,i G_ii H_i,i+1 gR_i+1
+        G_i+1,i = gR_i+1 H_i+1,i G_ii,  G_i,i+1 = G_ii H_i,i+1 gR_i+1
+    The time is O(Nx Ny^3). Only every sqrt(Nx)-th gR_i is kept from the first
+    sweep (the others are recalculated), so the memory is O(sqrt(Nx) Ny^2).
+    """
+    
+    def __init__(self, H, E, zplus=1e-12, sigma_left=None, sigma_right=None):
+        """
+        H: hamiltonian.GeneralHamiltonian (or anything with mtot, Nx, Ny)
+        E: energy
+        zplus: small imaginary part added to E
+        sigma_left, sigma_right: Ny x Ny self-energies added to the first and
+        last slice, e.g. of semi-infinite leads. Default is None (closed system).
+        """
+        if H.mtot is None:
+            H.build_hamiltonian()
+        self.mtot = H.mtot.tocsr()
+        self.Nx = int(H.Nx)
+        self.Ny = int(H.Ny)
+        if self.Nx * self.Ny != self.mtot.shape[0]:
+            raise SliceStructureError('The Hamiltonian does not consist of Nx slices of Ny sites')
+        self.__check_slice_structure()
+        
+        self.E = E
+        self.zplus = zplus
+        self.sigma_left = sigma_left
+        self.sigma_right = sigma_right
+        
+    def __check_slice_structure(self):
+        coo = self.mtot.tocoo()
+        if np.any(np.abs(coo.row // self.Ny - coo.col // self.Ny) > 1):
+            raise SliceStructureError('The Hamiltonian couples slices which are not neighbours')
+    
+    def __block(self, i, j):
+        """
+        Block H_ij as sparse matrix; the couplings between slices are sparse, so
+        they are multiplied with the dense Green's functions without converting them.
+        """
+        return self.mtot[i*self.Ny:(i+1)*self.Ny, j*self.Ny:(j+1)*self.Ny]
+    
+    def __inverse_diagonal(self, i, sigma):
+        """
+        (E + i0 - H_ii - sigma)^-1, including the lead self-energies.
+        """
+        matrix = -self.__block(i, i).toarray() - sigma
+        matrix[np.diag_indices(self.Ny)] += self.E + 1j * self.zplus
+        if i == 0 and self.sigma_left is not None:
+            matrix -= self.sigma_left
+        if i == self.Nx - 1 and self.sigma_right is not None:
+            matrix -= self.sigma_right
+        return np.linalg.inv(matrix)
+    
+    def __right_connected(self, i, gR_next):
+        """
+        gR_i from gR_i+1 (gR_next=None for the last slice).
+        """
+        if gR_next is None:
+            return self.__inverse_diagonal(i, 0.)
+        sigma = self.__block(i, i+1) @ (gR_next @ self.__block(i+1, i))
+        return self.__inverse_diagonal(i, sigma)
+    
+    def __sweep(self):
+        """
+        Yields i, G_ii, G_i,i-1, G_i-1,i for all slices from left to right (the
+        off-diagonal blocks are None for i=0).
+        """
+        step = max(1, int(np.ceil(np.sqrt(self.Nx))))
+        
+        checkpoints = {}
+        gR = None
+        for i in reversed(range(self.Nx)):
+            gR = self.__right_connected(i, gR)
+            if i % step == 0:
+                checkpoints[i] = gR
+        
+        G = None
+        for start in range(0, self.Nx, step):
+            end = min(start + step, self.Nx)
+            # recalculate the gR_i of this segment from the next checkpoint
+            segment = [None] * (end - start)
+            gR = checkpoints.get(end)
+            for i in reversed(range(start, end)):
+                gR = self.__right_connected(i, gR)
+                segment[i - start] = gR
+            del checkpoints[start]
+            
+            for i in range(start, end):
+                gR = segment[i - start]
+                if i == 0:
+                    G = gR
+                    yield i, G, None, None
+                else:
+                    coupling = self.__block(i-1, i)
+                    G_lower = gR @ (self.__block(i, i-1) @ G)
+                    G_upper = (G @ coupling) @ gR
+                    G = gR + G_lower @ (coupling @ gR)
+                    yield i, G, G_lower, G_upper
+    
+    def get_diagonal_elements(self):
+        """
+        Diagonal of G(E), ordered like mtot.
+        """
+        diagonal = np.zeros(self.Nx * self.Ny, dtype=complex)
+        for i, G, G_lower, G_upper in self.__sweep():
+            diagonal[i*self.Ny:(i+1)*self.Ny] = np.diag(G)
+        return diagonal
+    
+    def get_diagonal_blocks(self):
+        """
+        List of the Nx diagonal blocks G_ii (Ny x Ny).
+        """
+        return [G for i, G, G_lower, G_upper in self.__sweep()]
+    
+    def get_offdiagonal_blocks(self, slices=None):
+        """
+        Blocks G_i+1,i and G_i,i+1 connecting neighbouring slices, e.g. for
+        bond currents.
+        
+        slices: list of slice numbers i (0...Nx-2). If None, all are returned.
+        
+        Return:
+        dictionary i: (G_i+1,i, G_i,i+1)
+        """
+        if slices is None:
+            slices = range(self.Nx - 1)
+        wanted = set(slices)
+        return dict((i-1, (G_lower, G_upper)) for i, G, G_lower, G_upper in self.__sweep()
+                    if i-1 in wanted)
+    
+    def get_corner_block(self):
+        """
+        The block G_1N between the first and the last slice (e.g. for the
+        transmission), calculated with left-connected Green's functions in
+        one sweep with O(Ny^2) memory:
+        G_1N = gL_1 H_12 gL_2 H_23 ... H_N-1,N gL_N
+        """
+        gL = self.__inverse_diagonal(0, 0.)
+        G_1N = gL
+        for i in range(1, self.Nx):
+            coupling = self.__block(i-1, i)
+            sigma = self.__block(i, i-1) @ (gL @ coupling)
+            gL = self.__inverse_diagonal(i, sigma)
+            G_1N = (G_1N @ coupling) @ gL
+        return G_1N
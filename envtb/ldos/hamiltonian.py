@@ -3,6 +3,8 @@ from . import make_matrix as mm
 from . import make_matrix_graphene as mmg
 from . import make_matrix_graphene_armchair_5nn as mmg_a
 from . import potential
+from . import density
+from . import spectrum_slicing
 import copy
 try:
     import matplotlib.pylab as plt
@@ -12,6 +14,7 @@ except:
 import scipy.sparse
 from scipy.sparse import linalg
 import cmath
+import envtb.utility.eigencache as eigencache
 #from scipy.sparse import linalg
 #from scipy import sparse
 
@@ -35,6 +38,8 @@ class GeneralHamiltonian(object):
         self.coords = coords
         self.w = None
         self.v = None
+        self.__coords_cache = None
+        self.__bond_cache = {}
 
     def build_hamiltonian(self):
         self.mtot = mm.make_H(self.m0, self.mI, self.Nx)
@@ -87,17 +92,17 @@ class GeneralHamiltonian(object):
 
         mt = self.mtot.copy()
 
+        coords = self.coords_array()
+
         if isinstance(U, potential.Potential1D):
 
             #mdia = scipy.sparse.dia_matrix((np.array([U(self.coords[i][1])
             #                    for i in xrange(self.Ntot)]), np.array([0])),
             #                               shape=(self.Ntot,self.Ntot))
             if in_x:
-                mdia = np.array([U(self.coords[i][0])
-                                for i in range(self.Ntot)])
+                mdia = potential.evaluate(U, coords[:self.Ntot, 0])
             else:
-                mdia = np.array([U(self.coords[i][1])
-                                for i in range(self.Ntot)])
+                mdia = potential.evaluate(U, coords[:self.Ntot, 1])
 
             if sign_variation:
                 mdia[::2] = -1.0 * mdia[::2]
@@ -106,8 +111,7 @@ class GeneralHamiltonian(object):
             mt = mt + mdia.tocsr()
 
         else:
-            mdia = np.array([U([self.coords[i][0], self.coords[i][1]])
-                                for i in range(self.Ntot)])
+            mdia = potential.evaluate(U, coords[:self.Ntot, :2].T)
 
             if sign_variation:
                 mdia[::2] = -1.0 * mdia[::2]
@@ -126,13 +130,90 @@ class GeneralHamiltonian(object):
         mt = self.mtot.copy()
 
         if isinstance(U, potential.Potential1D):
-            mdia = np.array([U(self.coords[i][1])
-                                for i in range(self.Ntot-1)])
+            mdia = potential.evaluate(U, self.coords_array()[:self.Ntot-1, 1])
 
             mdia = scipy.sparse.diags(np.array([mdia,mdia]), np.array([-1, 1]), shape=(self.Ntot,self.Ntot))
             mt = mt + mdia.tocsr()
         return self.copy_ins_with_new_matrix(mt)
 
+    def coords_array(self):
+        """
+        The coordinates as an array of shape (nr of sites, dim). The array is
+        created once and reused as long as self.coords is the same object.
+        """
+        if self.__coords_cache is None or self.__coords_cache[0] is not self.coords:
+            self.__coords_cache = (self.coords,
+                                   np.asarray(self.coords, dtype=float))
+        return self.__coords_cache[1]
+
+
+    def bond_table(self, name='mtot'):
+        """
+        Bond displacements r_column - r_row and bond midpoints of the nonzero
+        elements of self.mtot, self.m0 or self.mI (name), aligned with the
+        data array of the csr matrix. The columns of mI belong to the next
+        slice. The table is calculated once per matrix and coordinates.
+
+        Return:
+        matrix: the csr matrix
+        displacement, midpoint: arrays of shape (nnz, 2)
+        """
+        if name == 'mtot' and self.mtot is None:
+            self.build_hamiltonian()
+        original = getattr(self, name)
+        cached = self.__bond_cache.get(name)
+        if cached is not None and cached[0] is original and \
+                cached[1] is self.coords:
+            return cached[2:]
+
+        matrix = scipy.sparse.csr_matrix(original)
+        rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        columns = matrix.indices
+        if name == 'mI':
+            columns = columns + self.Ny
+        coords = self.coords_array()[:, :2]
+        displacement = coords[columns] - coords[rows]
+        midpoint = 0.5 * (coords[columns] + coords[rows])
+
+        # copies share the cache dictionary, so it is replaced, not changed
+        cache = dict(self.__bond_cache)
+        cache[name] = (original, self.coords, matrix, displacement, midpoint)
+        self.__bond_cache = cache
+        return matrix, displacement, midpoint
+
+    def __peierls_phases(self, name, A=None, magnetic_B=None, gauge='landau_x'):
+        """
+        Multiplies the hopping elements of the matrix name with the Peierls
+        phases of the uniform vector potential A = [Ax, Ay] or of the
+        uniform magnetic field magnetic_B in the given gauge.
+
+        Return:
+        A new csr matrix.
+        """
+        matrix, displacement, midpoint = self.bond_table(name)
+        dx, dy = displacement.T
+        x, y = midpoint.T
+
+        if A is not None:
+            conversion_factor = 1.602176487 / 1.0545717*1e5  # e/hbar*Angstrem
+            phase = conversion_factor * (A[0] * dx + A[1] * dy)
+        else:
+            conversion_factor=1.602176487/1.0545717*1e-5  # e/hbar*Angstrem^2
+            if gauge == 'landau_x':
+                # A = (-B y, 0)
+                phase = -conversion_factor * magnetic_B * dx * y
+            elif gauge == 'landau_y':
+                # A = (0, B x)
+                phase = conversion_factor * magnetic_B * x * dy
+            elif gauge == 'symmetric':
+                # A = B/2 (-y, x)
+                phase = 0.5 * conversion_factor * magnetic_B * (x * dy - y * dx)
+            else:
+                raise ValueError('Unknown gauge: %s' % gauge)
+
+        m_pot = matrix.astype(complex)
+        m_pot.data *= np.exp(1j * phase)
+        return m_pot
 
     def apply_simple_vector_potential(self, A):
         """
@@ -142,72 +223,19 @@ class GeneralHamiltonian(object):
 
         A: a vector potential of the form [Ax, Ay]
         """
-        conversion_factor = 1.602176487 / 1.0545717*1e5
-
-        nonzero_elements_0 = self.m0.nonzero()
-        nonzero_elements_I = self.mI.nonzero()
-
-        phase_matrix_0 = np.exp(1j * conversion_factor * A[0] *
-                             np.array([self.coords[nonzero_elements_0[1][k]][0] -
-                                       self.coords[nonzero_elements_0[0][k]][0]
-                                       for k in range(len(nonzero_elements_0[0]))]))*\
-                      np.exp(1j * conversion_factor * A[1] *
-                             np.array([self.coords[nonzero_elements_0[1][k]][1] -
-                                       self.coords[nonzero_elements_0[0][k]][1]
-                                       for k in range(len(nonzero_elements_0[0]))]))
-        phase_matrix_I = np.exp(1j * conversion_factor * A[0] *
-                             np.array([self.coords[nonzero_elements_I[1][k]+self.Ny][0] -
-                                       self.coords[nonzero_elements_I[0][k]][0]
-                                       for k in range(len(nonzero_elements_I[0]))]))*\
-                      np.exp(1j * conversion_factor * A[1] *
-                             np.array([self.coords[nonzero_elements_I[1][k]+self.Ny][1] -
-                                       self.coords[nonzero_elements_I[0][k]][1]
-                                       for k in range(len(nonzero_elements_I[0]))]))
-        m_0_data = self.m0.data * phase_matrix_0
-        m_I_data = self.mI.data * phase_matrix_I
-
-        m_0 = scipy.sparse.csr_matrix((m_0_data, nonzero_elements_0), shape=(self.Ny, self.Ny))
-        m_I = scipy.sparse.csr_matrix((m_I_data, nonzero_elements_I), shape=(self.Ny, self.Ny))
+        m_0 = self.__peierls_phases('m0', A=A)
+        m_I = self.__peierls_phases('mI', A=A)
 
         return self.copy_ins(m0=m_0, mI=m_I)
 
     def apply_simple_magnetic_field(self, magnetic_B=0, gauge='landau_x'):
-        conversion_factor=1.602176487/1.0545717*1e-5  # e/hbar*Angstrem^2
-
-        nonzero_elements_0 = self.m0.nonzero()
-        nonzero_elements_I = self.mI.nonzero()
-        if gauge == 'landau_x':
-             phase_matrix_0 = np.exp(1j * conversion_factor * magnetic_B *
-                                   np.array([-0.5 * (self.coords[nonzero_elements_0[1][k]][0] -
-                                                      self.coords[nonzero_elements_0[0][k]][0]) *\
-                                              (self.coords[nonzero_elements_0[0][k]][1] +
-                                                self.coords[nonzero_elements_0[1][k]][1])
-                                              for k in range(len(nonzero_elements_0[0]))]))
-             phase_matrix_I = np.exp(1j * conversion_factor * magnetic_B *
-                                   np.array([-0.5 * (self.coords[nonzero_elements_I[1][k] + self.Ny][0] -
-                                                      self.coords[nonzero_elements_I[0][k]][0]) *\
-                                              (self.coords[nonzero_elements_I[0][k] + self.Ny][1] +
-                                                self.coords[nonzero_elements_I[1][k]][1])
-                                              for k in range(len(nonzero_elements_I[0]))]))
-        elif gauge == 'landau_y':
-            phase_matrix_0 = np.exp(1j * conversion_factor * magnetic_B *
-                                  np.array([0.5 * (self.coords[nonzero_elements_0[1][k]][0] +
-                                                    self.coords[nonzero_elements_0[0][k]][0]) *\
-                                             (self.coords[nonzero_elements_0[1][k]][1] -
-                                               self.coords[nonzero_elements_0[0][k]][1])
-                                              for k in range(len(nonzero_elements_0[0]))]))
-            phase_matrix_I = np.exp(1j * conversion_factor * magnetic_B *
-                                  np.array([0.5 * (self.coords[nonzero_elements_I[1][k] + self.Ny][0] +
-                                                    self.coords[nonzero_elements_I[0][k]][0]) *\
-                                             (self.coords[nonzero_elements_I[1][k] + self.Ny][1] -
-                                               self.coords[nonzero_elements_I[0][k]][1])
-                                              for k in range(len(nonzero_elements_I[0]))]))
-
-        m_0_data = self.m0.data * phase_matrix_0
-        m_I_data = self.mI.data * phase_matrix_I
-
-        m_0 = scipy.sparse.csr_matrix((m_0_data, nonzero_elements_0), shape=(self.Ny, self.Ny))
-        m_I = scipy.sparse.csr_matrix((m_I_data, nonzero_elements_I), shape=(self.Ny, self.Ny))
+        """
+        The function applies a magnetic field to the hamiltonian parts (H0 and HI)
+
+        gauge: 'landau_x', 'landau_y' or 'symmetric'
+        """
+        m_0 = self.__peierls_phases('m0', magnetic_B=magnetic_B, gauge=gauge)
+        m_I = self.__peierls_phases('mI', magnetic_B=magnetic_B, gauge=gauge)
 
         return self.copy_ins(m0=m_0, mI=m_I)
 
@@ -223,49 +251,21 @@ class GeneralHamiltonian(object):
         if self.mtot is None:
             self.build_hamiltonian()
         #TODO: implement vector potential A(r) position dependent
-        conversion_factor = 1.602176487 / 1.0545717*1e5
 
-        nonzero_elements = self.mtot.nonzero()
-
-        phase_matrix = np.exp(1j * conversion_factor * A[0] *
-                             np.array([self.coords[nonzero_elements[1][k]][0] -
-                                       self.coords[nonzero_elements[0][k]][0]
-                                       for k in range(len(nonzero_elements[0]))]))*\
-                      np.exp(1j * conversion_factor * A[1] *
-                             np.array([self.coords[nonzero_elements[1][k]][1] -
-                                       self.coords[nonzero_elements[0][k]][1]
-                                       for k in range(len(nonzero_elements[0]))]))
-        m_pot_data = self.mtot.data * phase_matrix
-        m_pot = scipy.sparse.csr_matrix((m_pot_data, nonzero_elements), shape=(self.Ntot, self.Ntot))
-
-        return self.copy_ins_with_new_matrix(m_pot)
+        return self.copy_ins_with_new_matrix(self.__peierls_phases('mtot', A=A))
 
     def apply_magnetic_field(self, magnetic_B=0, gauge='landau_x'):
+        """
+        The function applies a magnetic field to the hamiltonian
+
+        gauge: 'landau_x', 'landau_y' or 'symmetric'
+        """
 
         if self.mtot is None:
             self.build_hamiltonian()
-        conversion_factor=1.602176487/1.0545717*1e-5  # e/hbar*Angstrem^2
-
-        nonzero_elements = self.mtot.nonzero()
-        if gauge == 'landau_x':
-             phase_matrix = np.exp(1j * conversion_factor * magnetic_B *
-                                   np.array([-0.5 * (self.coords[nonzero_elements[1][k]][0] -
-                                                      self.coords[nonzero_elements[0][k]][0]) *\
-                                              (self.coords[nonzero_elements[0][k]][1] +
-                                                self.coords[nonzero_elements[1][k]][1])
-                                              for k in range(len(nonzero_elements[0]))]))
-        elif gauge == 'landau_y':
-            phase_matrix = np.exp(1j * conversion_factor * magnetic_B *
-                                  np.array([0.5 * (self.coords[nonzero_elements[1][k]][0] +
-                                                    self.coords[nonzero_elements[0][k]][0]) *\
-                                             (self.coords[nonzero_elements[1][k]][1] -
-                                               self.coords[nonzero_elements[0][k]][1])
-                                              for k in range(len(nonzero_elements[0]))]))
-
-        m_pot_data = self.mtot.data * phase_matrix
-        m_pot = scipy.sparse.csr_matrix((m_pot_data, nonzero_elements), shape=(self.Ntot, self.Ntot))
-
-        return self.copy_ins_with_new_matrix(m_pot)
+
+        return self.copy_ins_with_new_matrix(
+            self.__peierls_phases('mtot', magnetic_B=magnetic_B, gauge=gauge))
 
     def add_vacancies(self, Nvac=10, vactype='single', sign_variation=True, sublat_sim=True, randseed=1000, E0=10.0):
         Ntotal = self.Nx * self.Ny
@@ -298,11 +298,34 @@ class GeneralHamiltonian(object):
 
         return self.copy_ins_with_new_matrix(mt)
 
-    def eigenvalue_problem(self, k=20, sigma=0.0, **kwrds):
+    def fingerprint(self):
+        """
+        Hash of the content of the hamiltonian (csr data and indices of mtot
+        and the coordinates). Hamiltonians built in the same way have the
+        same fingerprint, see envtb.utility.eigencache.
+        """
         if self.mtot is None:
             self.build_hamiltonian()
-        w,v = linalg.eigs(self.mtot.tocsc(), k=k, sigma=sigma, **kwrds)
-        return w, v
+        coords = self.coords_array() if self.coords is not None else None
+        return eigencache.digest(self.mtot, coords)
+
+    def eigenvalue_problem(self, k=20, sigma=0.0, cache=None, **kwrds):
+        """
+        k eigenpairs closest to sigma (scipy.sparse.linalg.eigs).
+
+        cache: None (no cache), True (directory .envtb_cache) or a directory.
+        The eigenpairs are stored under the fingerprint of the hamiltonian
+        and the parameters, and are read instead of calculated the next time.
+        """
+        if self.mtot is None:
+            self.build_hamiltonian()
+
+        def solve():
+            return linalg.eigs(self.mtot.tocsc(), k=k, sigma=sigma, **kwrds)
+
+        return eigencache.cached_eigenpairs(
+            self.fingerprint() if cache else None, solve, cache,
+            solver='eigs', k=k, sigma=sigma, **kwrds)
 
     def sorted_eigenvalue_problem(self, k=20, sigma=0.0, **kwrds):
         if self.mtot is None:
@@ -311,6 +334,21 @@ class GeneralHamiltonian(object):
         wsort, vsort = self.__sort_spec(w=w, v=v, sortv=True)
         return wsort, vsort
 
+    def sliced_eigenvalue_problem(self, emin, emax, nwindows=None, k=40,
+                                  nprocs=1, **kwrds):
+        """
+        All eigenpairs with emin <= E <= emax, sorted by energy. The interval
+        is split into nwindows windows, which are solved independently with
+        the hermitian shift-invert solver (eigsh) in nprocs processes, see
+        spectrum_slicing.spectrum_slicing(). Better than eigenvalue_problem()
+        for hundreds of interior states of big systems.
+        """
+        if self.mtot is None:
+            self.build_hamiltonian()
+        return spectrum_slicing.spectrum_slicing(
+            self.mtot, emin, emax, nwindows=nwindows, k=k, nprocs=nprocs,
+            **kwrds)
+
     def __sort_spec(self, w, v=None, sortv=False):
         isort = np.argsort(w)
         v = np.array(v)
@@ -353,6 +391,77 @@ class GeneralHamiltonian(object):
             wE = self.__sort_spec(w)[0]
             return wE
 
+    def bloch_blocks(self, tol=1e-10):
+        """
+        Bloch matrices m0 + e^{ik} mI + e^{-ik} mI^+ (like in get_spec) of a
+        hamiltonian made periodic in x with make_periodic_x(), for the Nx
+        phases k = 2 pi n / Nx. m0 and mI are the blocks of the first slice
+        of mtot. mtot is checked to consist of Nx identical slices (up to
+        tol), otherwise ValueError is raised (e.g. after applying a
+        potential which depends on x).
+
+        Return:
+        k: array of shape (Nx,)
+        blocks: array of shape (Nx, Ny, Ny)
+        """
+        if self.mtot is None:
+            self.build_hamiltonian()
+        Nx, Ny = self.Nx, self.Ny
+        if Nx < 3:
+            raise ValueError('Nx >= 3 slices are needed, not %d' % Nx)
+        mtot = scipy.sparse.csr_matrix(self.mtot)
+        if mtot.shape != (Nx * Ny, Nx * Ny):
+            raise ValueError('mtot is not made of %d slices of %d sites'
+                             % (Nx, Ny))
+        m0 = mtot[:Ny, :Ny]
+        mI = mtot[:Ny, Ny:2*Ny]
+
+        shift = scipy.sparse.csr_matrix(
+            (np.ones(Nx), (np.arange(Nx), (np.arange(Nx) + 1) % Nx)),
+            shape=(Nx, Nx))
+        periodic = scipy.sparse.kron(scipy.sparse.identity(Nx), m0) + \
+            scipy.sparse.kron(shift, mI) + \
+            scipy.sparse.kron(shift.T, mI.conjugate().T)
+        difference = abs(mtot - periodic)
+        if difference.nnz and difference.max() > tol:
+            raise ValueError('The hamiltonian is not periodic in x with '
+                             'identical slices (see make_periodic_x)')
+
+        k = 2. * np.pi * np.arange(Nx) / Nx
+        m0 = m0.toarray()
+        mI = mI.toarray()
+        phase = np.exp(1j * k)[:, np.newaxis, np.newaxis]
+        blocks = m0 + phase * mI + phase.conjugate() * mI.conjugate().T
+        return k, blocks
+
+    def periodic_eigenvalue_problem(self, get_wf=False, tol=1e-10):
+        """
+        Full spectrum of a hamiltonian made periodic in x (make_periodic_x),
+        from the Nx Bloch blocks (bloch_blocks()) instead of the full matrix:
+        O(Nx Ny^3) instead of O((Nx Ny)^3). All blocks are diagonalized in
+        one stacked call of numpy.linalg.eigh.
+
+        get_wf: also return the eigenvectors in real space,
+        v[j*Ny + a] = e^{ikj} u_a / sqrt(Nx) for the slice j
+
+        Return:
+        w sorted by energy, or w, v (eigenvectors in the columns)
+        """
+        k, blocks = self.bloch_blocks(tol=tol)
+        if not get_wf:
+            return np.sort(np.linalg.eigvalsh(blocks).ravel())
+
+        w, u = np.linalg.eigh(blocks)
+        order = np.argsort(w.ravel(), kind='stable')
+        Nx, Ny = self.Nx, self.Ny
+        slices = np.arange(Nx)
+        phases = np.exp(1j * np.outer(slices, k)) / np.sqrt(Nx)
+        # v[j, a, n, b] = e^{i k_n j} u[n, a, b] / sqrt(Nx)
+        v = phases[:, np.newaxis, :, np.newaxis] * \
+            u.transpose(1, 0, 2)[np.newaxis]
+        v = v.reshape(Nx * Ny, Nx * Ny)[:, order]
+        return w.ravel()[order], v
+
     def plot_bandstructure(self, krange = np.linspace(0.0,2.5,100), n_eigs=200, **kwrds):
         w = np.array([self.get_spec(k, num_eigs=n_eigs) for k in krange])
 
@@ -366,19 +475,35 @@ class GeneralHamiltonian(object):
         #plt.show()
         return None
 
-    def electron_density(self, mu, kT):
+    def electron_density(self, mu, kT, method='exact', cache=None, **kwrds):
+        """
+        Site density sum_n f(E_n) |v_n,i|^2.
+
+        method: 'exact' sums over the full spectrum, from a dense hermitian
+        diagonalization (done once). 'chebyshev' expands the Fermi function
+        in Chebyshev polynomials without diagonalization, which is the choice
+        for big systems. **kwrds are passed to density.ElectronDensity.
+        cache: eigenpair cache of the full diagonalization (see
+        eigenvalue_problem())
+        """
+        if method == 'exact' and 'eigenpairs' not in kwrds:
+            kwrds['eigenpairs'] = self.full_eigenvalue_problem(cache=cache)
 
-        if self.w == None:
-            self.w, self.v = self.eigenvalue_problem()
+        return density.electron_density(self, mu, kT, method=method, **kwrds)
 
-        rho = FermiFunction(self.w, mu, kT)
-        rho2 = np.dot(self.v, np.dot(
-                      np.diag(rho) * np.identity((self.Ny * self.Nx),dtype = float), 
-                      np.conjugate(np.transpose(self.v))))
+    def full_eigenvalue_problem(self, cache=None):
+        """
+        All eigenpairs from a dense hermitian diagonalization (numpy.linalg.eigh),
+        sorted by energy. cache: see eigenvalue_problem().
+        """
+        if self.mtot is None:
+            self.build_hamiltonian()
 
-        density = np.diag(rho2)
+        def solve():
+            return np.linalg.eigh(self.mtot.toarray())
 
-        return density
+        return eigencache.cached_eigenpairs(
+            self.fingerprint() if cache else None, solve, cache, solver='eigh')
 
     def find_lead_solution(self, E=0.0, k=10, sigma=0.0, **kwrds):
         A = scipy.sparse.lil_matrix((2*self.Ny, 2*self.Ny), dtype=complex)
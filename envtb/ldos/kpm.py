@@ -0,0 +1,237 @@
+"""
+Kernel polynomial method (KPM) for the density of states and the local
+density of states of big sparse Hamiltonians.
+
+The spectral density is expanded in Chebyshev polynomials of the rescaled
+Hamiltonian. The expansion coefficients (moments) are calculated with
+sparse matrix-vector products only, so the cost is O(nnz * nr of moments)
+and no factorization is needed. Once calculated, the moments can be
+evaluated on any energy grid.
+
+Example:
+>>> kpm = KernelPolynomialMethod(H, nmoments=1024)
+>>> dos = kpm.dos(np.linspace(-3, 3, 601), nrandom=20)
+>>> ldos = kpm.ldos(0.0, sites=[10, 11, 12])
+
+See Weisse et al., Rev. Mod. Phys. 78, 275 (2006).
+"""
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse import linalg
+from . import hamiltonian
+
+
+def sparse_hamiltonian_matrix(H):
+    """
+    Returns the Hamiltonian matrix of H as csr_matrix.
+
+    H: GeneralHamiltonian (mtot is used and built if necessary),
+    w90hamiltonian.Hamiltonian (the main cell matrix is used, e.g. of a
+    supercell flake) or a (sparse) matrix.
+    """
+    if isinstance(H, hamiltonian.GeneralHamiltonian):
+        if H.mtot is None:
+            H.build_hamiltonian()
+        return scipy.sparse.csr_matrix(H.mtot)
+    if hasattr(H, 'maincell_hamiltonian_matrix'):
+        return scipy.sparse.csr_matrix(H.maincell_hamiltonian_matrix())
+    return scipy.sparse.csr_matrix(H)
+
+
+def spectral_bounds(matrix, tol=1e-4):
+    """
+    Estimates the lowest and highest eigenvalue of a hermitian sparse
+    matrix with the Lanczos method (scipy.sparse.linalg.eigsh).
+
+    Return:
+    emin, emax
+    """
+    if matrix.shape[0] < 3:
+        w = np.linalg.eigvalsh(matrix.toarray())
+        return w[0], w[-1]
+    emin = linalg.eigsh(matrix, k=1, which='SA', tol=tol,
+                        return_eigenvectors=False)[0]
+    emax = linalg.eigsh(matrix, k=1, which='LA', tol=tol,
+                        return_eigenvectors=False)[0]
+    return emin, emax
+
+
+def jackson_kernel(nmoments):
+    """
+    Damping factors g_n of the Jackson kernel, which suppress the Gibbs
+    oscillations of the truncated Chebyshev series. The resulting
+    broadening is approximately pi*(half bandwidth)/nmoments.
+    """
+    n = np.arange(nmoments)
+    N = nmoments + 1.
+    return ((N - n) * np.cos(np.pi * n / N) +
+            np.sin(np.pi * n / N) / np.tan(np.pi / N)) / N
+
+
+def chebyshev_moments(matrix, vectors, nmoments, scale, shift):
+    """
+    Calculates the Chebyshev moments mu_n = <v|T_n(Ht)|v> for a block of
+    vectors, where Ht = (H - shift) / scale must have its spectrum in
+    (-1, 1).
+
+    Two moments are obtained per matrix-vector product, using
+    mu_2n = 2 <a_n|a_n> - mu_0 and mu_2n+1 = 2 <a_n+1|a_n> - mu_1
+    with a_n = T_n(Ht)|v>.
+
+    matrix: sparse Hamiltonian matrix
+    vectors: array of shape (N, nr of vectors)
+    nmoments: number of moments
+
+    Return:
+    Array of shape (nmoments, nr of vectors).
+    """
+    vectors = np.asarray(vectors, dtype=complex)
+    if vectors.ndim == 1:
+        vectors = vectors[:, np.newaxis]
+
+    def apply_scaled(a):
+        return (matrix.dot(a) - shift * a) / scale
+
+    mu = np.zeros((nmoments, vectors.shape[1]))
+    a0 = vectors
+    a1 = apply_scaled(a0)
+    mu[0] = np.sum(np.abs(a0)**2, axis=0)
+    if nmoments > 1:
+        mu[1] = np.sum(a0.conj() * a1, axis=0).real
+
+    for n in range(1, (nmoments + 1) // 2):
+        if 2 * n < nmoments:
+            mu[2 * n] = 2 * np.sum(np.abs(a1)**2, axis=0) - mu[0]
+        a2 = 2 * apply_scaled(a1) - a0
+        if 2 * n + 1 < nmoments:
+            mu[2 * n + 1] = 2 * np.sum(a2.conj() * a1, axis=0).real - mu[1]
+        a0, a1 = a1, a2
+
+    return mu
+
+
+class KernelPolynomialMethod:
+    """
+    KPM engine for the total DOS (stochastic trace estimation) and the
+    LDOS of selected sites (exact moments).
+    """
+
+    def __init__(self, H, nmoments=512, bounds=None, kernel='jackson',
+                 blocksize=64):
+        """
+        H: GeneralHamiltonian, w90hamiltonian.Hamiltonian (main cell) or
+        sparse matrix, see sparse_hamiltonian_matrix().
+        nmoments: number of Chebyshev moments. The energy resolution is
+        about pi*(half bandwidth)/nmoments.
+        bounds: (emin, emax) of the spectrum. If None, they are calculated
+        with spectral_bounds().
+        kernel: 'jackson' or None (no damping).
+        blocksize: number of vectors propagated together.
+        """
+        self.matrix = sparse_hamiltonian_matrix(H)
+        self.Ntot = self.matrix.shape[0]
+        self.nmoments = nmoments
+        self.blocksize = blocksize
+
+        if bounds is None:
+            bounds = spectral_bounds(self.matrix)
+        emin, emax = bounds
+        # keep the rescaled spectrum safely inside (-1, 1)
+        epsilon = 0.01
+        self.scale = (emax - emin) / (2. - epsilon)
+        self.shift = (emax + emin) / 2.
+
+        if kernel == 'jackson':
+            self.kernel = jackson_kernel(nmoments)
+        elif kernel is None:
+            self.kernel = np.ones(nmoments)
+        else:
+            raise ValueError('Unknown kernel: %s' % kernel)
+
+    def __moments(self, vector_blocks):
+        return np.concatenate([chebyshev_moments(self.matrix, block,
+                                                 self.nmoments, self.scale,
+                                                 self.shift)
+                               for block in vector_blocks], axis=1)
+
+    def dos_moments(self, nrandom=10, seed=None):
+        """
+        Moments of the total DOS, Tr T_n(Ht), estimated with nrandom random
+        phase vectors.
+        """
+        random = np.random.RandomState(seed)
+
+        def blocks():
+            for start in range(0, nrandom, self.blocksize):
+                n = min(self.blocksize, nrandom - start)
+                yield np.exp(2j * np.pi * random.random_sample((self.Ntot, n)))
+
+        return self.__moments(blocks()).mean(axis=1)
+
+    def ldos_moments(self, sites):
+        """
+        Exact moments <i|T_n(Ht)|i> of the LDOS for the given sites.
+
+        Return:
+        Array of shape (nmoments, nr of sites).
+        """
+        sites = np.atleast_1d(sites)
+
+        def blocks():
+            for start in range(0, len(sites), self.blocksize):
+                part = sites[start:start + self.blocksize]
+                vectors = np.zeros((self.Ntot, len(part)), dtype=complex)
+                vectors[part, np.arange(len(part))] = 1.
+                yield vectors
+
+        return self.__moments(blocks())
+
+    def evaluate(self, moments, E):
+        """
+        Evaluates the (damped) Chebyshev series of the moments on the
+        energies E.
+
+        moments: array of shape (nmoments,) or (nmoments, nr of series)
+        E: energy or array of energies
+
+        Return:
+        The spectral density (per eV) with the shape of E (plus the series
+        axis, if moments is two-dimensional). It is zero outside the bounds.
+        """
+        E = np.asarray(E, dtype=float)
+        x = ((E - self.shift) / self.scale).ravel()
+        inside = np.abs(x) < 1.
+        xin = x[inside]
+        moments = np.asarray(moments)
+        n = np.arange(self.nmoments)
+
+        weights = self.kernel * np.where(n == 0, 1., 2.)
+        chebyshev = np.cos(np.outer(np.arccos(xin), n))  # T_n(x) = cos(n arccos x)
+        density = np.zeros((len(x),) + moments.shape[1:])
+        density[inside] = np.dot(chebyshev, weights[(slice(None),) +
+                                                    (np.newaxis,) * (moments.ndim - 1)]
+                                 * moments)
+        density[inside] /= (np.pi * self.scale *
+                            np.sqrt(1. - xin**2))[(slice(None),) +
+                                                  (np.newaxis,) * (moments.ndim - 1)]
+
+        return density.reshape(E.shape + moments.shape[1:])
+
+    def dos(self, E, nrandom=10, seed=None):
+        """
+        Total density of states (states per eV) on the energies E.
+        """
+        return self.evaluate(self.dos_moments(nrandom, seed), E)
+
+    def ldos(self, E, sites=None):
+        """
+        Local density of states of the given sites (all sites if None).
+
+        Return:
+        Array of shape E.shape + (nr of sites,); for a single energy one
+        value per site, like LocalDensityOfStates.
+        """
+        if sites is None:
+            sites = np.arange(self.Ntot)
+        return self.evaluate(self.ldos_moments(sites), E)
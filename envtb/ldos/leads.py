@@ -0,0 +1,141 @@
+"""
+Semi-infinite periodic leads: surface Green's functions and the
+self-energies of leads attached to a Hamiltonian made of slices.
+
+The surface Green's functions are calculated with the iterative decimation
+of Sancho and Rubio (J. Phys. F 15, 851 (1985)) at a broadening relative to
+the lead bandwidth, which converges in a few dozen iterations, and refined
+with Newton steps on the Dyson equation of the lead.
+"""
+
+import numpy as np
+from scipy.sparse import linalg
+
+# minimal broadening of the decimation, relative to the lead bandwidth
+DECIMATION_BROADENING = 1e-5
+
+
+def surface_greens_function(E, H00, H01, zplus=1e-9, tol=1e-12, maxiter=200):
+    """
+    Surface Green's function of a semi-infinite periodic lead, calculated
+    by iterative decimation and refined with Newton steps on the Dyson
+    equation g = (z - H00 - H01 g H01^+)^-1.
+
+    The decimation runs with a broadening of at least
+    DECIMATION_BROADENING * (bandwidth of the lead): with a smaller one,
+    the first steps invert z - H00 close to an eigenvalue of H00 (e.g. in
+    the band centre) and the couplings blow up. The Newton steps then
+    remove this broadening.
+
+    E: energy
+    H00: Hamiltonian of one lead cell
+    H01: coupling from the surface cell to the next cell inside the lead
+    zplus: small imaginary part of the energy
+    tol: the decimation stops when the effective couplings are below
+    tol * bandwidth; the Newton steps stop when the relative residual of the
+    Dyson equation is below max(tol, 1e-10).
+
+    Return:
+    The surface Green's function (dense matrix).
+    """
+    H00 = dense_matrix(H00).astype(complex)
+    H01 = dense_matrix(H01).astype(complex)
+    bandwidth = np.linalg.norm(H00, 2) + 2 * np.linalg.norm(H01, 2)
+    if bandwidth == 0:
+        bandwidth = 1.
+    eta = max(zplus, DECIMATION_BROADENING * bandwidth)
+    g = _decimation(E + 1j * eta, H00, H01, tol * bandwidth, maxiter)
+    if eta == zplus:
+        return g
+
+    z = (E + 1j * zplus) * np.eye(H00.shape[0])
+    H10 = H01.conj().T
+    target = max(tol, 1e-10)
+    for iteration in range(20):
+        M_inv = np.linalg.inv(z - H00 - np.dot(H01, np.dot(g, H10)))
+        residual = M_inv - g
+        error = np.linalg.norm(residual) / np.linalg.norm(g)
+        if error < target:
+            return g
+        # Newton step: dg - M^-1 H01 dg H10 M^-1 = M^-1 - g
+        g = g + _solve_stein(np.dot(M_inv, H01), np.dot(H10, M_inv), residual)
+    if error > 1e-6:
+        raise RuntimeError("Surface Green's function not converged at E=%g "
+                           "(residual %g)" % (E, error))
+    return g
+
+
+def _decimation(z, H00, H01, tol, maxiter):
+    """
+    Iterative decimation of Sancho and Rubio at the complex energy z.
+    """
+    alpha = H01
+    beta = alpha.conj().T
+    z = z * np.eye(H00.shape[0])
+    epsilon_surface = H00
+    epsilon = H00
+
+    for iteration in range(maxiter):
+        g = np.linalg.inv(z - epsilon)
+        alpha_g_beta = np.dot(alpha, np.dot(g, beta))
+        beta_g_alpha = np.dot(beta, np.dot(g, alpha))
+        epsilon_surface = epsilon_surface + alpha_g_beta
+        epsilon = epsilon + alpha_g_beta + beta_g_alpha
+        alpha = np.dot(alpha, np.dot(g, alpha))
+        beta = np.dot(beta, np.dot(g, beta))
+        if np.abs(alpha).max() < tol and np.abs(beta).max() < tol:
+            break
+    else:
+        raise RuntimeError('Decimation did not converge at E=%g' % z[0, 0].real)
+
+    return np.linalg.inv(z - epsilon_surface)
+
+
+def _solve_stein(P, Q, R):
+    """
+    Solves X - P X Q = R (directly for small matrices, else with GMRES).
+    """
+    n = P.shape[0]
+    if n <= 32:
+        # vec(P X Q) = (Q^T kron P) vec(X) for column-major vec
+        A = np.eye(n * n) - np.kron(Q.T, P)
+        return np.linalg.solve(A, R.ravel(order='F')).reshape((n, n), order='F')
+
+    def matvec(x):
+        X = x.reshape((n, n))
+        return (X - np.dot(P, np.dot(X, Q))).ravel()
+
+    operator = linalg.LinearOperator((n * n, n * n), matvec=matvec,
+                                     dtype=complex)
+    x, info = linalg.gmres(operator, R.ravel(), rtol=1e-12, atol=0.,
+                           restart=100, maxiter=20)
+    return x.reshape((n, n))
+
+
+def lead_self_energies(E, m0, mI, zplus=1e-9):
+    """
+    Self-energies of semi-infinite leads made of slices (m0, mI), attached
+    to the left of the first and to the right of the last slice of a device
+    (H_i,i+1 = mI).
+
+    Return:
+    sigma_left, sigma_right
+    """
+    mI = dense_matrix(mI)
+    mIT = mI.conj().T
+    # the left lead continues to the left: its surface cell couples to the
+    # next one with mI^+
+    g_left = surface_greens_function(E, m0, mIT, zplus)
+    g_right = surface_greens_function(E, m0, mI, zplus)
+    sigma_left = np.dot(mIT, np.dot(g_left, mI))
+    sigma_right = np.dot(mI, np.dot(g_right, mIT))
+    return sigma_left, sigma_right
+
+
+def dense_matrix(matrix):
+    """
+    Dense array of a sparse or dense matrix.
+    """
+    if hasattr(matrix, 'toarray'):
+        return matrix.toarray()
+    return np.asarray(matrix)
@@ -2,6 +2,56 @@ import numpy as np
 import random
 from scipy.ndimage.filters import gaussian_filter
 
+
+def evaluate(U, r):
+    """
+    Values of the potential U at many points in one call.
+
+    U: potential (Potential1D, Potential2D, ...)
+    r: coordinates, an array x for 1D potentials or [x, y] with arrays x
+       and y for 2D potentials
+
+    Return:
+    Array with one value per point. Potentials which only accept single
+    points are called point by point.
+    """
+    r = np.asarray(r, dtype=float)
+    shape = r.shape[-1:]
+    try:
+        return np.array(np.broadcast_to(U(r), shape))
+    except (TypeError, ValueError, IndexError):
+        pass
+    if r.ndim == 1:
+        return np.array([U(x) for x in r])
+    return np.array([U(list(point)) for point in r.T])
+
+
+def _evaluate_function(f, *args):
+    """
+    Calls f with the coordinate arrays args. Functions which only work on
+    scalars (e.g. math functions or if statements) are called point by
+    point.
+    """
+    args = np.broadcast_arrays(*[np.asarray(a) for a in args])
+    if args[0].ndim == 0:
+        return f(*[a[()] for a in args])
+    try:
+        return np.array(np.broadcast_to(f(*args), args[0].shape))
+    except (TypeError, ValueError):
+        values = [f(*point) for point in zip(*[a.ravel() for a in args])]
+        return np.array(values).reshape(args[0].shape)
+
+
+def _scalar_or_array(values):
+    """
+    Returns a number for a 0-d array, so that single points give a number
+    like before.
+    """
+    values = np.asarray(values)
+    if values.ndim == 0:
+        return values[()]
+    return values
+
 class Potential1D:
 
     def range(self):
@@ -14,6 +64,7 @@ class Potential1D:
     def __call__(self,x):
         """
         Returns the value of the potential at x.
+        x can be a number or an array of coordinates.
         """
         pass
 
@@ -29,8 +80,9 @@ class Potential1DFromFunction(Potential1D):
     def __call__(self,x):
         """
         Returns the value of the potential at x.
+        x can be a number or an array of coordinates.
         """
-        return self.potential(x)
+        return _evaluate_function(self.potential, x)
 
     def __init__(self, f):
         """
@@ -49,10 +101,10 @@ class Potential1DOnGrid(Potential1D):
     def __call__(self,r):
         """
         Returns the value of the potential at r.
-        r is a list of [x,y]
+        r can be a number or an array of coordinates.
         """
-        ix = int(r/self.dx)
-        return self.potential[ix]
+        ix = np.asarray(np.asarray(r) / self.dx).astype(int)
+        return _scalar_or_array(np.asarray(self.potential)[ix])
 
     def __init__(self, array, dx=1.0, dy=1.0):
         """
@@ -74,6 +126,7 @@ class Potential2D:
     def __call__(self,x):
         """
         Returns the value of the potential at x.
+        x is a list of [x,y], where x and y can be arrays of coordinates.
         """
         pass
 
@@ -88,11 +141,11 @@ class Potential2DOnGrid(Potential2D):
     def __call__(self,r):
         """
         Returns the value of the potential at r.
-        r is a list of [x,y]
+        r is a list of [x,y], where x and y can be arrays of coordinates.
         """
-        ix = int(r[0]/self.dx)
-        iy = int(r[1]/self.dy)
-        return self.potential[ix,iy]
+        ix = np.asarray(np.asarray(r[0]) / self.dx).astype(int)
+        iy = np.asarray(np.asarray(r[1]) / self.dy).astype(int)
+        return _scalar_or_array(np.asarray(self.potential)[ix, iy])
 
     def __init__(self, array, dx=1.0, dy=1.0):
         """
@@ -113,9 +166,9 @@ class Potential2DFromFunction(Potential2D):
     def __call__(self,r):
         """
         Returns the value of the potential at r.
-        r is a list of [x,y]
+        r is a list of [x,y], where x and y can be arrays of coordinates.
         """
-        return self.potential(r[0], r[1])
+        return _evaluate_function(self.potential, r[0], r[1])
 
     def __init__(self, f):
         """
@@ -135,22 +188,30 @@ class RandomSmoothPotential2D(Potential2D):
         np.random.seed(randseed)
         self.cor = self.sx*cor/self.Lx
         print(self.cor)
-        z = np.random.uniform(low=-amp/2.0, high = amp/2.0, size=self.sx*self.sy)
-        self.rand_pot = (gaussian_filter(z.reshape(self.sx, self.sy), sigma=self.cor/np.sqrt(2))*self.cor)
+        z = np.random.uniform(low=-amp/2.0, high = amp/2.0, size=int(self.sx)*int(self.sy))
+        self.rand_pot = (gaussian_filter(z.reshape(int(self.sx), int(self.sy)), sigma=self.cor/np.sqrt(2))*self.cor)
+        self.x0 = np.linspace(0.0, self.Lx, int(self.sx))
+        self.y0 = np.linspace(0.0, self.Ly, int(self.sy))
 
     def __call__(self, r):
+        """
+        r is a list of [x,y], where x and y can be arrays of coordinates.
+        """
         dx0 = self.Lx/self.sx
         dy0 = self.Lx/self.sx
-        x0 = np.linspace(0.0, self.Lx, self.sx)
-        y0 = np.linspace(0.0, self.Ly, self.sy)
-        i0 = np.where(x0 >= r[0])[0][0]
-        j0 = np.where(y0 >= r[1])[0][0]
-        deltax = r[0] - x0[i0]
-        deltay = r[1] - y0[j0]
-        if i0 < len(x0)-1 and j0 < len(y0)-1:
-            return self.rand_pot[i0, j0] + deltax * (self.rand_pot[i0+1, j0] - self.rand_pot[i0, j0]) /dx0 + deltay * (self.rand_pot[i0, j0+1] - self.rand_pot[i0, j0]) /dy0
-        else: 
-           return self.rand_pot[i0, j0]
+        x, y = np.broadcast_arrays(np.asarray(r[0], dtype=float),
+                                   np.asarray(r[1], dtype=float))
+        # first grid point >= r, like np.where(x0 >= r[0])[0][0]
+        i0 = np.searchsorted(self.x0, x)
+        j0 = np.searchsorted(self.y0, y)
+        deltax = x - self.x0[i0]
+        deltay = y - self.y0[j0]
+        inner = (i0 < len(self.x0)-1) & (j0 < len(self.y0)-1)
+        i1 = np.where(inner, i0+1, i0)
+        j1 = np.where(inner, j0+1, j0)
+        pot = self.rand_pot[i0, j0]
+        pot = np.where(inner, pot + deltax * (self.rand_pot[i1, j0] - pot) /dx0 + deltay * (self.rand_pot[i0, j1] - pot) /dy0, pot)
+        return _scalar_or_array(pot)
 
 #end class Potential2DFromFunction
 
@@ -189,88 +250,60 @@ class SoftConfinmentPotential:
     def __call__(self, r):
         """
         Returns the value of the potential at r.
-        r is a list of [x,y]
-        i counter in hamiltonian array (corresponds to position on diagonal of ham matrix with coordinate r)
+        r is a list of [x,y], where x and y can be arrays of coordinates.
         """
+        x, y = np.broadcast_arrays(np.asarray(r[0], dtype=float),
+                                   np.asarray(r[1], dtype=float))
 
-        pot_edge = self.__calculate_edge_potential(r)
+        pot_edge = self.__calculate_edge_potential(x, y)
 
         if self.side == 0:
-            pot_corner = self.__calculate_corner_potential(r)
-            if pot_corner < 1.0:
-                return (1.0 + (-1) * pot_corner) * self.amplitude
-            else: return (1.0 + (-1) * pot_edge) * self.amplitude
+            pot_corner = self.__calculate_corner_potential(x, y)
+            pot = np.where(pot_corner < 1.0, pot_corner, pot_edge)
         elif self.side == 12 or self.side == 34:
-            #if pot_edge < 1.0:
-            return (1.0 + (-1) * pot_edge) * self.amplitude
-            #else:
-            #    return (1.0+(-1)*pot_edge)*10.0
+            pot = pot_edge
+        return _scalar_or_array((1.0 + (-1) * pot) * self.amplitude)
 
     def __smooth_function(self, x):
         return abs(np.cos((x + self.da) / self.da * np.pi / 2.))
 
-    def __calculate_edge_potential(self, r):
-        x = r[0]
-        y = r[1]
-
-        pot_amp = 1.0
-
-        if x > self.max_x - self.da:
-            if self.side == 0 or self.side == 12:
-                x = x - self.max_x
-                pot_amp = self.__smooth_function(x)
-            else:
-                if y > self.max_y - self.da:
-                    y = y - self.max_y
-                    pot_amp = self.__smooth_function(y)
-                elif y < self.da:
-                    pot_amp = self.__smooth_function(y)
-        elif x < self.da:
-            if self.side == 0 or self.side == 12:
-                pot_amp = self.__smooth_function(x)
-            else:
-                 if y > self.max_y - self.da:
-                    y = y - self.max_y
-                    pot_amp = self.__smooth_function(y)
-                 elif y < self.da:
-                    pot_amp = self.__smooth_function(y)
-
-        elif y > self.max_y - self.da:
-            if self.side == 0 or self.side == 34:
-                y = y - self.max_y
-                pot_amp = self.__smooth_function(y)
-
-        elif y < self.da:
-            if self.side == 0 or self.side == 34:
-                pot_amp = self.__smooth_function(y)
+    def __calculate_edge_potential(self, x, y):
+        pot_amp = np.ones(x.shape)
+
+        right = x > self.max_x - self.da
+        left = ~right & (x < self.da)
+        top = ~right & ~left & (y > self.max_y - self.da)
+        bottom = ~right & ~left & ~top & (y < self.da)
+
+        if self.side == 0 or self.side == 12:
+            pot_amp = np.where(right, self.__smooth_function(x - self.max_x), pot_amp)
+            pot_amp = np.where(left, self.__smooth_function(x), pot_amp)
+        else:
+            # at the left and right ends only the zigzag edges are smoothed
+            y_top = (right | left) & (y > self.max_y - self.da)
+            y_bottom = (right | left) & ~y_top & (y < self.da)
+            pot_amp = np.where(y_top, self.__smooth_function(y - self.max_y), pot_amp)
+            pot_amp = np.where(y_bottom, self.__smooth_function(y), pot_amp)
+
+        if self.side == 0 or self.side == 34:
+            pot_amp = np.where(top, self.__smooth_function(y - self.max_y), pot_amp)
+            pot_amp = np.where(bottom, self.__smooth_function(y), pot_amp)
 
         return pot_amp
 
-    def __calculate_corner_potential(self,r):
-
-            x = r[0]
-            y = r[1]
-            if x >= self.max_x - self.da and y >= self.max_y - self.da:
-                x = x - self.max_x
-                y = y - self.max_y
-                #pot_amp = 0.0001 * (self.da - x)
-            elif x <= self.da and y >= self.max_y - self.da:
-                x = x
-                y = y - self.max_y
-                #pot_amp = 0.0001 * (self.da - x)
-            elif x <= self.da and y <= self.da:
-                x = x
-                y = y
-                #pot_amp = 0.0001 * (self.da - x)
-            elif x >= self.max_x-self.da and y <= self.da:
-                x = x - self.max_x
-                y = y
-                #pot_amp = 0.0001 * (self.da - x)
-            else:
-                return 1.0
-
-            pot_amp = self.__smooth_function(x) * self.__smooth_function(y)
-            return pot_amp
+    def __calculate_corner_potential(self, x, y):
+
+            right = x >= self.max_x - self.da
+            left = x <= self.da
+            top = y >= self.max_y - self.da
+            bottom = y <= self.da
+            corners = [right & top, left & top, left & bottom, right & bottom]
+
+            xc = np.select(corners, [x - self.max_x, x, x, x - self.max_x], x)
+            yc = np.select(corners, [y - self.max_y, y - self.max_y, y, y], y)
+
+            pot_amp = self.__smooth_function(xc) * self.__smooth_function(yc)
+            return np.where(np.any(corners, axis=0), pot_amp, 1.0)
 
 #end class SoftConfinmentPotential
 
@@ -287,30 +320,25 @@ class SuperLatticePotential:
 
     def __call__(self, r):
         '''
-            r is a list with coords [x, y]
+            r is a list with coords [x, y], where x and y can be arrays
         '''
         a = 1.42
 
-        iy_main = int(r[1] / 3. / a * 4)
+        x = np.asarray(r[0], dtype=float)
+        y = np.asarray(r[1], dtype=float)
 
-        irest = np.mod(r[1], 3.*a)
-        if abs(irest) <= a/2 + 0.00001:
-            iy = iy_main + 1
-        elif abs(irest) <= 3.*a/2. + 0.00001:
-            iy = iy_main + 2
-        elif abs(irest) <= 2. * a + 0.00001:
-            iy = iy_main + 3
-        else:
-            iy = iy_main
+        iy_main = np.trunc(y / 3. / a * 4).astype(int)
 
-        ix = int(r[0] / np.sqrt(3) /a)
+        irest = np.abs(np.mod(y, 3.*a))
+        iy = iy_main + np.select([irest <= a/2 + 0.00001,
+                                  irest <= 3.*a/2. + 0.00001,
+                                  irest <= 2. * a + 0.00001], [1, 2, 3], 0)
 
-        while iy > self.Ny-1:
-            iy = iy - self.Ny
+        ix = np.trunc(x / np.sqrt(3) /a).astype(int)
 
-        while ix > self.Nx-1:
-            ix = ix - self.Nx
+        iy = np.where(iy > self.Ny-1, np.mod(iy, self.Ny), iy)
+        ix = np.where(ix > self.Nx-1, np.mod(ix, self.Nx), ix)
 
         index = ix * self.Ny + iy
 
-        return self.pot[index]
+        return _scalar_or_array(np.asarray(self.pot)[index])
@@ -0,0 +1,192 @@
+"""
+Interior eigenpairs of a big hermitian sparse Hamiltonian by spectrum
+slicing.
+
+The energy interval [emin, emax] is split into windows. In each window the
+eigenpairs closest to its center are calculated in shift-invert mode
+(scipy.sparse.linalg.eigsh) with one LU factorization of H - sigma, which
+is reused when the number of requested eigenpairs has to be increased
+because the window holds more states. The windows are independent and are
+solved in a process pool. Eigenpairs found twice at the window boundaries
+are removed.
+
+Example:
+>>> w, v = spectrum_slicing(ham.mtot, -0.5, 0.5, nwindows=8, nprocs=None)
+or
+>>> w, v = ham.sliced_eigenvalue_problem(-0.5, 0.5, nprocs=None)
+"""
+
+import os
+import numpy as np
+import scipy.sparse
+from scipy.sparse import linalg
+from concurrent.futures import ProcessPoolExecutor
+
+
+def window_eigenpairs(matrix, emin, emax, k=40, tol=0, maxiter=None,
+                      margin=0.):
+    """
+    All eigenpairs with emin - margin <= E <= emax + margin of the hermitian
+    sparse matrix.
+
+    k: number of eigenpairs requested first. It is doubled until an
+    eigenvalue outside of the window is found, i.e. until the window is
+    complete.
+    tol, maxiter: see scipy.sparse.linalg.eigsh
+    margin: the windows of spectrum_slicing overlap by margin, so that no
+    eigenvalue at a boundary is lost to rounding
+
+    Return:
+    w, v (eigenvectors in the columns), sorted by energy
+    """
+    N = matrix.shape[0]
+    sigma = 0.5 * (emin + emax)
+    half_width = 0.5 * (emax - emin) + margin
+
+    lu = None
+    if N > 2 * k:
+        identity = scipy.sparse.identity(N, dtype=matrix.dtype, format='csc')
+        for shift in (0., 1e-6, 1e-4):
+            # sigma must not be an eigenvalue, move it slightly if it is
+            try:
+                sigma_shifted = sigma + shift * max(half_width, 1.)
+                lu = linalg.splu((matrix - sigma_shifted * identity).tocsc())
+                sigma = sigma_shifted
+                break
+            except RuntimeError:
+                continue
+
+    while True:
+        if lu is None or k >= N - 1:
+            w, v = np.linalg.eigh(matrix.toarray())
+            break
+        OPinv = linalg.LinearOperator(matrix.shape, matvec=lu.solve,
+                                      dtype=lu.L.dtype)
+        w, v = _shift_invert_eigsh(matrix, k, sigma, OPinv, tol, maxiter)
+        if np.max(np.abs(w - sigma)) > half_width:
+            break
+        k = min(2 * k, N - 1)
+
+    inside = (w >= emin - margin) & (w <= emax + margin)
+    order = np.argsort(w[inside])
+    return w[inside][order], v[:, inside][:, order]
+
+
+def _shift_invert_eigsh(matrix, k, sigma, OPinv, tol, maxiter, attempts=3):
+    """
+    eigsh in shift-invert mode, with a bigger Krylov space if it does not
+    converge.
+    """
+    N = matrix.shape[0]
+    ncv = min(N, max(2 * k + 1, 20))
+    for attempt in range(attempts):
+        try:
+            return linalg.eigsh(matrix, k=k, sigma=sigma, OPinv=OPinv,
+                                which='LM', ncv=ncv, tol=tol,
+                                maxiter=maxiter)
+        except linalg.ArpackNoConvergence:
+            if attempt == attempts - 1:
+                raise
+            ncv = min(N, 2 * ncv)
+            maxiter = None if maxiter is None else 2 * maxiter
+
+def remove_duplicates(w, v, window, degeneracy_tol=1e-8):
+    """
+    Removes eigenpairs which were found in two windows. Eigenvalues closer
+    than degeneracy_tol form a group; if a group comes from more than one
+    window, its eigenvectors are orthonormalized and the ones which lie in
+    the span of the others are dropped. Real degeneracies are kept.
+
+    w, v: eigenvalues sorted by energy and eigenvectors in the columns
+    window: index of the window of each eigenpair
+
+    Return:
+    w, v
+    """
+    if len(w) == 0:
+        return w, v
+    starts = np.concatenate([[0], np.nonzero(np.diff(w) > degeneracy_tol)[0] + 1,
+                             [len(w)]])
+    keep_w = []
+    keep_v = []
+    for start, end in zip(starts[:-1], starts[1:]):
+        if len(set(window[start:end])) == 1:
+            keep_w.append(w[start:end])
+            keep_v.append(v[:, start:end])
+            continue
+        basis = []
+        energies = []
+        for i in range(start, end):
+            r = v[:, i].copy()
+            for q in basis:
+                r -= np.vdot(q, r) * q
+            norm = np.sqrt(np.vdot(r, r).real)
+            if norm > 0.5:
+                basis.append(r / norm)
+                energies.append(w[i])
+        keep_w.append(np.array(energies))
+        keep_v.append(np.array(basis).T)
+    return np.concatenate(keep_w), np.concatenate(keep_v, axis=1)
+
+
+def spectrum_slicing(matrix, emin, emax, nwindows=None, k=40, nprocs=1,
+                     tol=0, maxiter=None, degeneracy_tol=1e-8):
+    """
+    All eigenpairs of the hermitian sparse matrix with emin <= E <= emax.
+
+    nwindows: number of windows of equal width. Default is the number of
+    processes.
+    k: number of eigenpairs requested first per window (see
+    window_eigenpairs). A good choice is a bit more than the expected
+    number of states per window.
+    nprocs: number of worker processes. Default is 1 (no worker processes);
+    None uses all CPUs. The matrix is sent to each worker only once.
+    tol, maxiter: see scipy.sparse.linalg.eigsh
+    degeneracy_tol: see remove_duplicates, also the overlap of the windows
+
+    Return:
+    w, v (eigenvectors in the columns), sorted by energy
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    if nprocs is None:
+        nprocs = os.cpu_count() or 1
+    if nwindows is None:
+        nwindows = nprocs
+    edges = np.linspace(emin, emax, nwindows + 1)
+    windows = list(zip(edges[:-1], edges[1:]))
+    options = dict(k=k, tol=tol, maxiter=maxiter, margin=degeneracy_tol)
+
+    if nprocs == 1:
+        _slicing_worker_init(matrix, options)
+        try:
+            results = [_slicing_worker(window) for window in windows]
+        finally:
+            _slicing_worker_state.clear()
+    else:
+        with ProcessPoolExecutor(min(nprocs, nwindows),
+                                 initializer=_slicing_worker_init,
+                                 initargs=(matrix, options)) as pool:
+            results = list(pool.map(_slicing_worker, windows))
+
+    w = np.concatenate([result[0] for result in results])
+    v = np.concatenate([result[1] for result in results], axis=1)
+    window = np.concatenate([np.full(len(result[0]), i)
+                             for i, result in enumerate(results)])
+    order = np.argsort(w, kind='stable')
+    w, v = remove_duplicates(w[order], v[:, order], window[order],
+                             degeneracy_tol)
+    inside = (w >= emin) & (w <= emax)
+    return w[inside], v[:, inside]
+
+
+_slicing_worker_state = {}
+
+
+def _slicing_worker_init(matrix, options):
+    _slicing_worker_state.update(matrix=matrix, options=options)
+
+
+def _slicing_worker(window):
+    emin, emax = window
+    state = _slicing_worker_state
+    return window_eigenpairs(state['matrix'], emin, emax, **state['options'])
@@ -0,0 +1,102 @@
+"""
+Two-terminal transport through a Hamiltonian made of slices (m0: slice,
+mI: coupling to the next slice in x direction), with semi-infinite leads
+attached to the first and the last slice.
+
+The lead self-energies are calculated in envtb.ldos.leads. The transmission
+is given by the Landauer formula T(E) = Tr[Gamma_L G_1N Gamma_R G_1N^+],
+where G_1N is calculated with a recursive sweep over the slices
+(RecursiveGreensFunction).
+
+Example:
+>>> device = TwoTerminalDevice(H.apply_potential(U))
+>>> T = device.transmission_sweep(np.linspace(-1, 1, 201), nprocs=4)
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from . import greens_function
+from .leads import surface_greens_function, lead_self_energies, dense_matrix
+
+
+class TwoTerminalDevice:
+    """
+    Device (a GeneralHamiltonian with Nx slices) between two semi-infinite
+    leads.
+    """
+
+    def __init__(self, H, lead=None, zplus=1e-9):
+        """
+        H: hamiltonian.GeneralHamiltonian. The device matrix is H.mtot, so
+        potentials etc. applied to mtot are included.
+        lead: (m0, mI) of the leads. Default is (H.m0, H.mI), i.e. the
+        leads continue the unperturbed slices.
+        zplus: small imaginary part of the energy
+        """
+        if H.mtot is None:
+            H.build_hamiltonian()
+        self.H = H
+        if lead is None:
+            lead = (H.m0, H.mI)
+        self.lead_m0, self.lead_mI = dense_matrix(lead[0]), dense_matrix(lead[1])
+        self.zplus = zplus
+
+    def self_energies(self, E):
+        """
+        sigma_left, sigma_right at the energy E.
+        """
+        return lead_self_energies(E, self.lead_m0, self.lead_mI, self.zplus)
+
+    def greens_function(self, E):
+        """
+        RecursiveGreensFunction of the device including the leads.
+        """
+        sigma_left, sigma_right = self.self_energies(E)
+        return greens_function.RecursiveGreensFunction(
+            self.H, E, zplus=self.zplus, sigma_left=sigma_left,
+            sigma_right=sigma_right)
+
+    def transmission(self, E):
+        """
+        Landauer transmission T(E) = Tr[Gamma_L G_1N Gamma_R G_1N^+].
+        """
+        sigma_left, sigma_right = self.self_energies(E)
+        G_1N = greens_function.RecursiveGreensFunction(
+            self.H, E, zplus=self.zplus, sigma_left=sigma_left,
+            sigma_right=sigma_right).get_corner_block()
+        gamma_left = 1j * (sigma_left - sigma_left.conj().T)
+        gamma_right = 1j * (sigma_right - sigma_right.conj().T)
+        return np.trace(np.dot(np.dot(gamma_left, G_1N),
+                               np.dot(gamma_right, G_1N.conj().T))).real
+
+    def transmission_sweep(self, energies, nprocs=1):
+        """
+        Transmission for a list of energies.
+
+        nprocs: number of worker processes. Default is 1 (no worker
+        processes); None uses all CPUs. The device is sent to each worker
+        only once; the energies are distributed in ordered chunks.
+        """
+        energies = np.asarray(energies, dtype=float)
+        if nprocs == 1:
+            return np.array([self.transmission(E) for E in energies])
+
+        if nprocs is None:
+            nprocs = os.cpu_count() or 1
+        chunksize = max(1, len(energies) // (4 * nprocs))
+        with ProcessPoolExecutor(nprocs, initializer=_transport_worker_init,
+                                 initargs=(self,)) as pool:
+            return np.array(list(pool.map(_transport_worker, energies,
+                                          chunksize=chunksize)))
+
+
+_transport_worker_device = []
+
+
+def _transport_worker_init(device):
+    _transport_worker_device[:] = [device]
+
+
+def _transport_worker(E):
+    return _transport_worker_device[0].transmission(E)
@@ -6,6 +6,7 @@ from .common import Constants
 import numpy
 import math
 import scipy.interpolate
+import envtb.ldos.density
 
 class QuantumCapacitanceSelfConsistency:
     """
@@ -286,3 +287,54 @@ class BulkGrapheneWithTemperature:
     
     def Ef_interp(self,charge):
         return self.interp(charge)
+
+class TightBindingCharge:
+    """
+    How the charge density of a tight-binding system depends on the Fermi
+    energy, calculated with the electron density engine envtb.ldos.density
+    (Chebyshev expansion of the Fermi function, no diagonalization).
+    
+    Like BulkGrapheneWithTemperature, use Q() as charge_fermi_energy_dependence
+    and Ef() as fermi_energy_charge_dependence. Ef is given in J relative to
+    the charge neutrality point.
+    """
+    minEf=-1.5e-18
+    maxEf=1.5e-18
+    Eftol=1e-25 #for root search
+    
+    def __init__(self,H,T,volume,neutrality_point=0.0,spin_degeneracy=2,**kwargs):
+        """
+        H: tight-binding Hamiltonian (see envtb.ldos.density.ElectronDensity)
+        T: temperature in K
+        volume: volume (or area, see BulkGrapheneWithTemperature.Q) the charge
+        is distributed over.
+        neutrality_point: chemical potential (in eV) of the neutral system.
+        spin_degeneracy: the Hamiltonian is spinless by default.
+        kwargs: passed to envtb.ldos.density.ElectronDensity.
+        """
+        self.T=T
+        self.volume=volume
+        self.neutrality_point=neutrality_point
+        self.spin_degeneracy=spin_degeneracy
+        self.density=envtb.ldos.density.ElectronDensity(H,**kwargs)
+        self.__neutral_electrons={}
+    
+    def electrons(self,mu,T):
+        """
+        Number of electrons at the chemical potential mu (in eV).
+        """
+        kT=Constants.k_B*T/Constants.elem_charge
+        return self.spin_degeneracy*numpy.sum(self.density(mu,kT))
+    
+    def Q(self,Ef,T=None):
+        if T==None:
+            T=self.T
+        if T not in self.__neutral_electrons:
+            self.__neutral_electrons[T]=self.electrons(self.neutrality_point,T)
+        mu=self.neutrality_point+Ef/Constants.elem_charge
+        return -Constants.elem_charge*(self.electrons(mu,T)-self.__neutral_electrons[T])/self.volume
+    
+    def Ef(self,charge,T=None):
+        if T==None:
+            T=self.T
+        return scipy.optimize.brentq(lambda myEf: self.Q(myEf,T)-charge,self.minEf,self.maxEf,xtol=self.Eftol)
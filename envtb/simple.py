@@ -139,7 +139,7 @@ def TopPzBandNrAtGamma(procar_filename, gnrwidth_rings, pzoffset=0):
 
 def plot_zigzag_graphene_nanoribbon_pz_bandstructure(
         wannier90hr_graphene, poscarfile, wannier90woutfile, outcarfile,
-        width, output=None, usedhoppingcells_rings='all'):
+        width, output=None, usedhoppingcells_rings='all', nprocs=1):
     """
     Plot the \pi bandstructure of a zigzag graphene nanoribbon based on a
     wannier90 calculation of bulk graphene. The \pz orbitals have to be the
@@ -158,6 +158,8 @@ def plot_zigzag_graphene_nanoribbon_pz_bandstructure(
     you can set the number of 'rings' surrounding the main cell here. If it
     is a list (e.g. range(5)), several plots are created.
     The default value is 'all'.
+    nprocs: number of worker processes for the bandstructure calculation
+    (see Hamiltonian.bandstructure_data). Default is 1.
 
     Return:
     Hamiltonian: the generated GNR Hamiltonian.
@@ -200,18 +202,19 @@ def plot_zigzag_graphene_nanoribbon_pz_bandstructure(
 
         path = ham4.point_path([[0, 0, 0], [0.5, 0, 0]], 100)
         if output is not None:
-            ham4.plot_bandstructure(path, str(ring)+"_"+output, 'd')
+            ham4.plot_bandstructure(path, str(ring)+"_"+output, 'd',
+                                    nprocs=nprocs)
             numpy.savetxt(str(ring)+"_"+output+'.dat', numpy.real(
                 data), fmt="%12.6G")
         data = ham4.bandstructure_data(
-            path, 'd')  # data is calculated twice, that's kind of stupid
+            path, 'd', nprocs=nprocs)  # data is calculated twice, that's kind of stupid
 
         return ham4, data, path
 
 
 def plot_armchair_graphene_nanoribbon_pz_bandstructure(
         wannier90hr_graphene, poscarfile, wannier90woutfile, width, output,
-        usedhoppingcells_rings='all'):
+        usedhoppingcells_rings='all', nprocs=1):
     """
     Plot the \pi bandstructure of an armchair graphene nanoribbon based on a
     wannier90 calculation of bulk graphene. The \pz orbitals have to be the
@@ -229,6 +232,8 @@ def plot_armchair_graphene_nanoribbon_pz_bandstructure(
     you can set the number of 'rings' surrounding the main cell here. If it
     is a list (e.g. range(5)), several plots are created.
     The default value is 'all'.
+    nprocs: number of worker processes for the bandstructure calculation
+    (see Hamiltonian.bandstructure_data). Default is 1.
     """
     unitcells = width
 
@@ -258,14 +263,15 @@ def plot_armchair_graphene_nanoribbon_pz_bandstructure(
             ham3.drop_dimension_from_cell_list(0))
 
         path = ham4.point_path([[0, 0, 0], [0, 0.5, 0]], 100)
-        ham4.plot_bandstructure(path, str(ring)+"_"+output, 'd')
-        data = ham4.bandstructure_data(path, 'd')
+        ham4.plot_bandstructure(path, str(ring)+"_"+output, 'd',
+                                nprocs=nprocs)
+        data = ham4.bandstructure_data(path, 'd', nprocs=nprocs)
         numpy.savetxt(str(ring)+"_"+output+'.dat', numpy.real(
             data), fmt="%12.6G")
 
 
 def plot_zigzag_graphene_nanoribbon_pz_bandstructure_nn(
-        nnfile, width, output, length, magnetic_B=None):
+        nnfile, width, output, length, magnetic_B=None, nprocs=1):
     """
     Plot the \pi bandstructure of a zigzag graphene nanoribbon based on a
     n-th nearest neighbour parameterization of bulk graphene.
@@ -277,6 +283,8 @@ def plot_zigzag_graphene_nanoribbon_pz_bandstructure_nn(
     output: path to the output image file.
     length: length in x-direction of the returned (not the bandstructure
     plot!) unit cell (in rings)
+    nprocs: number of worker processes for the bandstructure calculation
+    (see Hamiltonian.bandstructure_data). Default is 1.
 
     Return: Hamiltonian of the unit cell with given length
     """
@@ -303,7 +311,7 @@ def plot_zigzag_graphene_nanoribbon_pz_bandstructure_nn(
         magnetic_B=magnetic_B)
 
     path = ham4.point_path([[-0.5, 0, 0], [0.5, 0, 0]], 100)
-    ham4.plot_bandstructure(path, output, 'd')
+    ham4.plot_bandstructure(path, output, 'd', nprocs=nprocs)
     ham5 = ham4.create_supercell_hamiltonian([[i, 0, 0] for i in range(
         length)], [[length, 0, 0], [0, 1, 0], [0, 0, 1]])
     # data=ham4.bandstructure_data(path, 'd')
@@ -312,7 +320,7 @@ def plot_zigzag_graphene_nanoribbon_pz_bandstructure_nn(
 
 
 def plot_armchair_graphene_nanoribbon_pz_bandstructure_nn(
-        nnfile, width, output, magnetic_B=None):
+        nnfile, width, output, magnetic_B=None, nprocs=1):
     """
     Plot the \pi bandstructure of an armchair graphene nanoribbon based on
     a n-th nearest neighbour parameterization of bulk graphene.
@@ -323,6 +331,8 @@ def plot_armchair_graphene_nanoribbon_pz_bandstructure_nn(
     nnfile: path to the nearest-neighbour input file (see example files)
     width: width of the ribbon (number of rings). Must be an even number.
     output: path to the output image file.
+    nprocs: number of worker processes for the bandstructure calculation
+    (see Hamiltonian.bandstructure_data). Default is 1.
     """
     unitcells = width
     ham = w90hamiltonian.Hamiltonian.from_nth_nn_list(nnfile)
@@ -340,8 +350,8 @@ def plot_armchair_graphene_nanoribbon_pz_bandstructure_nn(
         magnetic_B=magnetic_B, gauge_B='landau_y')
 
     path = ham4.point_path([[0, -0.5, 0], [0, 0.5, 0]], 100)
-    ham4.plot_bandstructure(path, output, 'd')
-    data = ham4.bandstructure_data(path, 'd')
+    ham4.plot_bandstructure(path, output, 'd', nprocs=nprocs)
+    data = ham4.bandstructure_data(path, 'd', nprocs=nprocs)
     numpy.savetxt(output+'.dat', numpy.real(data), fmt="%12.6G")
 
 
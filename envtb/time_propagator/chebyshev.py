@@ -0,0 +1,184 @@
+import numpy as np
+import scipy.linalg
+import scipy.special
+import envtb.ldos.kpm
+from . import wave_function
+
+# relative margin of the spectral bounds, so that the rescaled spectrum
+# stays inside [-1, 1] even if the bounds are slightly underestimated
+SPECTRAL_MARGIN = 0.05
+
+
+def lanczos_bounds(matrix, nsteps=20, seed=None):
+    """
+    Rough estimate of the spectral bounds of a hermitian (sparse) matrix
+    from a few Lanczos steps from a random vector: the extreme Ritz values,
+    widened by the norms of their residuals. The residual only bounds the
+    distance to the nearest eigenvalue, not to the extreme one, so the
+    bounds do not always enclose the spectrum. ChebyshevPropagator uses the
+    converged eigenvalues of envtb.ldos.kpm.spectral_bounds() instead.
+
+    Return:
+    emin, emax
+    """
+    N = matrix.shape[0]
+    nsteps = min(nsteps, N)
+    random = np.random.RandomState(seed)
+    q = random.random_sample(N) - 0.5 + 0j
+    q /= np.sqrt(np.vdot(q, q).real)
+    q_old = np.zeros(N, dtype=complex)
+    alpha = np.zeros(nsteps)
+    beta = np.zeros(nsteps)
+
+    for j in range(nsteps):
+        r = matrix.dot(q) - (beta[j-1] * q_old if j > 0 else 0.)
+        alpha[j] = np.vdot(q, r).real
+        r -= alpha[j] * q
+        beta[j] = np.sqrt(np.vdot(r, r).real)
+        if beta[j] < 1e-12 * max(1., abs(alpha[j])):
+            nsteps = j + 1
+            break
+        q_old, q = q, r / beta[j]
+
+    w, v = scipy.linalg.eigh_tridiagonal(alpha[:nsteps], beta[:nsteps-1])
+    residual = beta[nsteps-1] * np.abs(v[-1])
+    return w[0] - residual[0], w[-1] + residual[-1]
+
+
+def chebyshev_coefficients(tau, scale, shift, num_error=10**(-18)):
+    """
+    Coefficients c_n of exp(-i*H*tau) = sum_n c_n T_n((H - shift) / scale),
+    c_n = (2 - delta_n0) (-i)^n J_n(scale*tau) exp(-i*shift*tau).
+
+    The series is cut where |c_n|**2 < num_error for all following terms.
+    The Bessel functions decay exponentially for n > scale*tau, so about
+    scale*tau + O((scale*tau)**(1/3)) terms are needed.
+    """
+    R = scale * tau
+    nterms = int(R + 10 * R**(1./3) + 20)
+    while True:
+        n = np.arange(nterms)
+        bessel = scipy.special.jv(n, R)
+        large = np.nonzero(4 * bessel**2 >= num_error)[0]
+        last = large[-1] if len(large) else 0
+        if last < nterms - 5:
+            break
+        nterms *= 2
+
+    n = n[:last + 1]
+    coefficients = 2 * bessel[:last + 1] * (-1j)**n
+    coefficients[0] /= 2.
+    return coefficients * np.exp(-1j * shift * tau)
+
+
+class ChebyshevPropagator():
+    """
+    Propagates a wave function with exp(-i*H*dt/hbar), expanded in Chebyshev
+    polynomials of the rescaled hamiltonian. The hamiltonian has to be
+    constant during the step, but the step can be arbitrarily long: the
+    number of terms (matrix-vector products) grows like
+    (half bandwidth)*dt/hbar and is chosen from the spectral bounds and
+    num_error. There is no time step or Krylov space adjustment, so long
+    field-free stretches can be done in one step.
+
+    Same interface as LanczosPropagator:
+    >>> prop = ChebyshevPropagator(wf, ham, dt=1e-12)
+    >>> wf_final, dt, nterms = prop.propagate(num_error=1e-18)
+
+    NOTE:
+    hbar = 0.66 * 10**(-15) eV * s, like in lanczos
+    """
+
+    def __init__(self, wf, ham, NK=None, dt=1., bounds=None):
+        """
+        wf: WaveFunction or array (also (N, nr of states) for many states)
+        ham: hamiltonian with the matrix ham.mtot (GeneralHamiltonian,
+        TimeDependentHamiltonian)
+        NK: unused, for compatibility with LanczosPropagator
+        dt: time step in s
+        bounds: (emin, emax) of the spectrum in eV. They must enclose the
+        spectrum (the series diverges for eigenvalues outside), they are
+        only widened by SPECTRAL_MARGIN. If None, the extreme eigenvalues
+        are calculated with envtb.ldos.kpm.spectral_bounds(). Reuse
+        prop.bounds for the next steps with the same hamiltonian.
+        """
+        if isinstance(wf, wave_function.WaveFunction):
+            wf = wf.wf1d
+        self.wf = np.asarray(wf, dtype=complex)
+        self.ham = ham
+        if self.ham.mtot is None:
+            self.ham.build_hamiltonian()
+        self.dt = dt
+        if bounds is None:
+            bounds = envtb.ldos.kpm.spectral_bounds(self.ham.mtot)
+        self.bounds = bounds
+        self.NK = None
+
+    def propagate(self, num_error=10**(-18), regime=None):
+        """
+        Applies exp(-i*H*dt/hbar) to the wave function.
+
+        num_error: the series is cut when the squared coefficients are below
+        num_error (like ||wf_NK - wf_{NK-1}||**2 < num_error for Lanczos)
+        regime: unused, for compatibility with LanczosPropagator
+
+        Return:
+        wf_out, dt, number of Chebyshev terms
+        """
+        hbar = 0.66 * 10**(-15)
+
+        emin, emax = self.bounds
+        # keep the rescaled spectrum safely inside [-1, 1]
+        scale = (emax - emin) / 2. * (1. + SPECTRAL_MARGIN)
+        shift = (emax + emin) / 2.
+        coefficients = chebyshev_coefficients(self.dt / hbar, scale, shift,
+                                              num_error)
+        self.NK = len(coefficients)
+
+        matrix = self.ham.mtot
+
+        def apply_scaled(a):
+            b = matrix.dot(a)
+            b -= shift * a
+            b *= 1. / scale
+            return b
+
+        a0 = self.wf
+        result = coefficients[0] * a0
+        if len(coefficients) > 1:
+            a1 = apply_scaled(a0)
+            result += coefficients[1] * a1
+            for c in coefficients[2:]:
+                a2 = apply_scaled(a1)
+                a2 *= 2.
+                a2 -= a0
+                result += c * a2
+                a0, a1 = a1, a2
+
+        if result.ndim > 1:
+            return result, self.dt, self.NK
+        wf_out = wave_function.WaveFunction(result)
+        wf_out.coords = self.ham.coords
+
+        return wf_out, self.dt, self.NK
+
+# end class ChebyshevPropagator
+
+
+def propagate_wave_function(wf_init, hamilt, NK=None, dt=1., maxel=None,
+                            num_error=10**(-18), regime=None, file_out=None,
+                            bounds=None, **kwrds):
+    """
+    Chebyshev version of Propagator.propagate_wave_function: one step of
+    length dt with the constant hamiltonian hamilt.
+
+    Return:
+    wf_final, dt, number of Chebyshev terms
+    """
+    prop = ChebyshevPropagator(wf=wf_init, ham=hamilt, dt=dt, bounds=bounds)
+
+    wf_final, dt_new, NK_new = prop.propagate(num_error=num_error)
+
+    if file_out is not None:
+        wf_final.save_wave_function_pic(file_out, maxel, **kwrds)
+    return wf_final, dt_new, NK_new
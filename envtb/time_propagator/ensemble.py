@@ -0,0 +1,239 @@
+"""
+Propagation of an ensemble of initial states (e.g. eigenstates) in a laser
+pulse on a local process pool, without MPI.
+
+The states are handed out one at a time, so a worker which is done takes the
+next state (dynamic load balancing). The eigenbasis is put into shared
+memory once and attached by the workers. Every state writes checkpoints; a
+run which was killed continues each state at its last checkpoint when it is
+started again with the same output directory.
+
+Output per state (like calculations/time_eigenstate_laser.py):
+wave_functions_<n>.trj (binary, see envtb.utility.trajectory),
+expansion_<n>.out, coords_current_<n>.out, dipole_<n>.out (time and
+dipole moment, see observables.Observables.dipole)
+
+Example:
+>>> w, v = ham.sorted_eigenvalue_problem(k=250, sigma=0.0)
+>>> pulse = vector_potential.SinSqEnvelopePulse(...)
+>>> ensemble = EnsemblePropagation(ham, pulse, (w, v), dt=1e-15, nframes=2500)
+>>> ensemble.run(range(0, 250, 10), nprocs=None)
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import envtb.utility.sharedarray as sharedarray
+import envtb.utility.trajectory as trajectory
+from . import lanczos
+from . import observables
+from . import time_dependent_hamiltonian
+from . import wave_function
+
+
+class EnsemblePropagation(object):
+    """
+    Propagates initial eigenstates of ham in the vector potential pulse,
+    one state per task.
+    """
+
+    def __init__(self, ham, pulse, eigenpairs, dt, nframes, NK=12,
+                 num_error=10**(-18), save_every=10, checkpoint_every=100,
+                 directory='.'):
+        """
+        ham: static hamiltonian (GeneralHamiltonian)
+        pulse: vector potential, callable A(t) (see vector_potential)
+        eigenpairs: (w, v), eigenvectors in the columns. The initial states
+        are columns of v, the expansion output is calculated with v.
+        dt: time step in s
+        nframes: number of time steps
+        NK: initial size of the Krylov space (the 'TSC' regime enlarges it)
+        num_error: see LanczosPropagator.propagate
+        save_every: the output is written every save_every steps
+        checkpoint_every: a checkpoint is written every checkpoint_every steps
+        directory: directory of the output and checkpoint files
+        """
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        self.ham = ham
+        self.pulse = pulse
+        self.w, self.v = eigenpairs
+        self.dt = dt
+        self.nframes = nframes
+        self.NK = NK
+        self.num_error = num_error
+        self.save_every = save_every
+        self.checkpoint_every = checkpoint_every
+        self.directory = directory
+
+    def run(self, states, nprocs=None):
+        """
+        Propagates the states (column indices of v).
+
+        nprocs: number of worker processes; None uses all CPUs, 1 runs in
+        this process.
+
+        Return:
+        List of the finished states, in the order they finished.
+        """
+        states = [int(n) for n in states]
+        if not states:
+            return []
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if nprocs is None:
+            nprocs = os.cpu_count() or 1
+
+        if nprocs == 1:
+            _ensemble_worker_init(self, None)
+            try:
+                return [_ensemble_worker(n) for n in states]
+            finally:
+                _ensemble_worker_state.clear()
+
+        v, self.v = self.v, None
+        try:
+            with sharedarray.SharedArray(v) as shared:
+                with ProcessPoolExecutor(
+                        min(nprocs, len(states)),
+                        initializer=_ensemble_worker_init,
+                        initargs=(self, shared.descriptor())) as pool:
+                    futures = [pool.submit(_ensemble_worker, n)
+                               for n in states]
+                    return [future.result()
+                            for future in as_completed(futures)]
+        finally:
+            self.v = v
+
+    def file_name(self, kind, Nstate):
+        """
+        Name of an output file, kind is 'wave_functions', 'expansion',
+        'coords_current', 'dipole' or 'checkpoint'.
+        """
+        extension = {'checkpoint': 'npz',
+                     'wave_functions': 'trj'}.get(kind, 'out')
+        return os.path.join(self.directory,
+                            '%s_%d.%s' % (kind, Nstate, extension))
+
+    def propagate_state(self, Nstate, ham_t):
+        """
+        Propagates the eigenstate Nstate, continuing at the checkpoint if
+        there is one. ham_t is the TimeDependentHamiltonian of the worker.
+        """
+        kinds = ('wave_functions', 'expansion', 'coords_current', 'dipole')
+        checkpoint = self.__load_checkpoint(Nstate)
+
+        if checkpoint is None:
+            frame = 0
+            time_counter = 0.0
+            dt_new = self.dt
+            NK_new = self.NK
+            psi = np.array(self.v[:, Nstate], dtype=complex)
+            files = dict((kind, open(self.file_name(kind, Nstate), 'w'))
+                         for kind in kinds[1:])
+            files['wave_functions'] = trajectory.TrajectoryWriter(
+                self.file_name('wave_functions', Nstate),
+                coords=self.ham.coords)
+            self.__save_frame(files, psi, time_counter)
+        else:
+            if checkpoint['finished']:
+                return Nstate
+            frame = int(checkpoint['frame'])
+            time_counter = float(checkpoint['time'])
+            dt_new = float(checkpoint['dt'])
+            NK_new = int(checkpoint['NK'])
+            psi = checkpoint['psi']
+            # drop the output written after the checkpoint
+            sizes = [int(size) for size in checkpoint['sizes']]
+            files = {'wave_functions': trajectory.TrajectoryWriter(
+                self.file_name('wave_functions', Nstate), append=True)}
+            files['wave_functions'].truncate(sizes[0])
+            for kind, size in zip(kinds[1:], sizes[1:]):
+                files[kind] = open(self.file_name(kind, Nstate), 'r+')
+                files[kind].truncate(size)
+                files[kind].seek(size)
+
+        obs = observables.Observables(ham_t)
+        basis = None
+        try:
+            while frame < self.nframes:
+                time_counter += dt_new
+                ham_t.update(time_counter)
+                prop = lanczos.LanczosPropagator(psi, ham_t, NK=NK_new,
+                                                 dt=dt_new, basis=basis)
+                basis = prop.basis
+                wf_final, dt_new, NK_new = prop.propagate(
+                    num_error=self.num_error, regime='TSC')
+                psi = wf_final.wf1d
+
+                if np.mod(frame, self.save_every) == 0:
+                    self.__save_frame(files, psi, time_counter, obs)
+                frame += 1
+
+                if np.mod(frame, self.checkpoint_every) == 0 or \
+                        frame == self.nframes:
+                    self.__save_checkpoint(Nstate, files, frame, time_counter,
+                                           dt_new, NK_new, psi,
+                                           frame == self.nframes)
+        finally:
+            for f in files.values():
+                f.close()
+
+        return Nstate
+
+    def __save_frame(self, files, psi, time_counter, obs=None):
+        wf_final = wave_function.WaveFunction(vec=psi, coords=self.ham.coords)
+        wave_function.WaveFunction.save_wave_function_data(
+            psi, files['wave_functions'], time_counter)
+        if obs is not None:
+            wf_final.save_wave_function_expansion(files['expansion'], self.v)
+            wf_final.save_coords_current(files['coords_current'],
+                                         self.pulse(time_counter))
+            files['dipole'].write('%e   %e   %e\n' % (
+                (time_counter,) + obs.dipole(psi)))
+
+    def __save_checkpoint(self, Nstate, files, frame, time_counter, dt,
+                          NK, psi, finished):
+        for f in files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        sizes = [files[kind].tell() for kind in
+                 ('wave_functions', 'expansion', 'coords_current', 'dipole')]
+        name = self.file_name('checkpoint', Nstate)
+        # write to a temporary file first, so that a killed job never leaves
+        # a broken checkpoint
+        with open(name + '.tmp', 'wb') as f:
+            np.savez(f, frame=frame, time=time_counter, dt=dt, NK=NK, psi=psi,
+                     sizes=sizes, finished=finished)
+        os.replace(name + '.tmp', name)
+
+    def __load_checkpoint(self, Nstate):
+        name = self.file_name('checkpoint', Nstate)
+        if not os.path.exists(name):
+            return None
+        with np.load(name) as checkpoint:
+            return dict((key, checkpoint[key]) for key in checkpoint.files)
+
+# end class EnsemblePropagation
+
+
+_ensemble_worker_state = {}
+
+
+def _ensemble_worker_init(ensemble, eigenbasis_descriptor):
+    """
+    Initializer of the worker processes: attaches the shared eigenbasis and
+    sets up the time dependent hamiltonian once per worker.
+    """
+    if eigenbasis_descriptor is not None:
+        shm, v = sharedarray.attach(eigenbasis_descriptor)
+        ensemble.v = v
+        _ensemble_worker_state['shm'] = shm
+    ham_t = time_dependent_hamiltonian.TimeDependentHamiltonian(
+        ensemble.ham, vector_potential=ensemble.pulse)
+    _ensemble_worker_state.update(ensemble=ensemble, ham_t=ham_t)
+
+
+def _ensemble_worker(Nstate):
+    state = _ensemble_worker_state
+    return state['ensemble'].propagate_state(Nstate, state['ham_t'])
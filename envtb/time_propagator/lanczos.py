@@ -1,4 +1,6 @@
 import numpy as np
+import scipy.linalg
+from scipy.linalg import blas
 try:
     import matplotlib.pylab as plt
 except:
@@ -17,27 +19,64 @@ class LanczosPropagator():
     wf0: initial wave function
 
     NK: size of the Krylov subspace
-    """
 
-    def __init__(self, wf, ham, NK=6, dt=1.):
+    The Krylov vectors are the rows of one preallocated array self.Q of
+    shape (NKmax, N). The array can be handed to the propagator of the next
+    time step (basis=prop.basis), so that no new basis is allocated.
+    """
 
-        self.Q = []
+    def __init__(self, wf, ham, NK=6, dt=1., NKmax=None, reorthogonalize=False,
+                 basis=None):
+        """
+        NKmax: number of rows of the Krylov basis. It is enlarged if the
+        'TSC' regime needs more vectors. Default is 2*NK.
+        reorthogonalize: if True, a new Krylov vector is orthogonalized again
+        against the basis when its overlaps exceed sqrt(machine epsilon)
+        (selective reorthogonalization, needed for large NK).
+        basis: complex array of shape (NKmax, N) to reuse, e.g. prop.basis of
+        the previous time step.
+        """
         if isinstance(wf, wave_function.WaveFunction):
-            self.Q.append(wf.wf1d)
+            wf = wf.wf1d
+        wf = np.asarray(wf)
+
+        if NKmax is None:
+            NKmax = 2 * NK
+        NKmax = max(NK, NKmax)
+        if basis is not None and basis.ndim == 2 and \
+                basis.shape[1] == len(wf) and \
+                basis.shape[0] >= NK and basis.dtype == complex and \
+                basis.flags.c_contiguous:
+            self.Q = basis
         else:
-            self.Q.append(wf)
-        self.alpha = []
-        self.betta = []
+            self.Q = np.empty((NKmax, len(wf)), dtype=complex)
+        self.alpha = np.zeros(self.Q.shape[0])
+        self.betta = np.zeros(self.Q.shape[0])
+
+        # the basis starts with the normalized wave function, the norm is
+        # restored in propagate()
+        self.norm = np.sqrt(np.vdot(wf, wf).real)
+        np.multiply(wf, 1. / self.norm, out=self.Q[0])
+
         self.NK = NK
         self.dt = dt
+        self.reorthogonalize = reorthogonalize
         self.ham = ham
         if self.ham.mtot is None:
             self.ham.build_hamiltonian()
-        #self.Nx = ham.Nx
-        #self.Ny = ham.Ny
-        #self.coords = ham.coords
+        self.__axpy, self.__scal = blas.get_blas_funcs(('axpy', 'scal'),
+                                                       (self.Q,))
+        self.__nvectors = 0
+        self.__invariant = False
         self.create_subspace()
 
+    @property
+    def basis(self):
+        """
+        The basis array, to be reused by the next propagator.
+        """
+        return self.Q
+
     def create_subspace(self):
         """
         The create_subspace(ham) function creates Krylov subspace and finds
@@ -71,25 +110,60 @@ class LanczosPropagator():
         self.betta[i-1] = <self.Q[i] * H self.Q[i-1]>
 
         """
-        r = self.__applyHwf()
-
-        self.alpha.append(np.dot(np.conjugate(np.transpose(self.Q[-1])), r))
-
-        r -= self.alpha[0] * self.Q[-1]
-        self.betta.append(np.sqrt(np.dot(np.conjugate(np.transpose(r)), r)))
-
-        for i in range(1, self.NK):
-            v = self.Q[-1]
-            self.Q.append(r / self.betta[-1])
-            r = self.__applyHwf() - self.betta[-1]*v
-            self.alpha.append(np.dot(np.conjugate(np.transpose(self.Q[-1])), r))
-            r -= self.alpha[-1] * self.Q[-1]
-
-            self.betta.append(np.sqrt(np.dot(np.conjugate(np.transpose(r)), r)))
+        while self.__nvectors < self.NK:
+            self.__lanczos_step()
 
         return None
 
-    def __applyHwf(self):
+    def __lanczos_step(self):
+        """
+        Adds the next Krylov vector Q[j] (j = nr of vectors so far) and
+        calculates alpha[j] and betta[j].
+
+        The residual r = H Q[j] - betta[j-1] Q[j-1] - alpha[j] Q[j] is kept
+        in self.__r; Q[j+1] = r / betta[j].
+        """
+        j = self.__nvectors
+        if j >= self.Q.shape[0]:
+            self.__enlarge_basis()
+        Q = self.Q
+
+        if j > 0:
+            if self.__invariant:
+                # the Krylov space is exhausted, H Q[j-1] lies in the space
+                Q[j] = 0.
+                self.alpha[j] = 0.
+                self.betta[j] = 0.
+                self.__nvectors += 1
+                return
+            np.multiply(self.__r, 1. / self.betta[j-1], out=Q[j])
+
+        r = np.asarray(self.__applyHwf(Q[j]), dtype=complex)
+        if j > 0:
+            r = self.__axpy(Q[j-1], r, a=-self.betta[j-1])
+        self.alpha[j] = np.vdot(Q[j], r).real
+        r = self.__axpy(Q[j], r, a=-self.alpha[j])
+
+        if self.reorthogonalize:
+            overlaps = np.dot(Q[:j+1].conj(), r)
+            if np.abs(overlaps).max() > np.sqrt(np.finfo(float).eps) * \
+                    np.sqrt(np.vdot(r, r).real):
+                r -= np.dot(overlaps, Q[:j+1])
+
+        self.betta[j] = np.sqrt(np.vdot(r, r).real)
+        self.__invariant = self.betta[j] <= \
+            np.finfo(float).eps * max(1., abs(self.alpha[j]))
+        self.__r = r
+        self.__nvectors += 1
+
+    def __enlarge_basis(self):
+        Q = np.empty((2 * self.Q.shape[0], self.Q.shape[1]), dtype=complex)
+        Q[:self.Q.shape[0]] = self.Q
+        self.Q = Q
+        self.alpha = np.concatenate([self.alpha, np.zeros(len(self.alpha))])
+        self.betta = np.concatenate([self.betta, np.zeros(len(self.betta))])
+
+    def __applyHwf(self, q):
         """
         The applyHwf(ham) applies Hamiltonian to the wave function
 
@@ -101,7 +175,7 @@ class LanczosPropagator():
 
         """
 
-        Hwf = self.ham.mtot.dot(np.array(self.Q[-1]))#np.dot(self.ham.mtot, np.array(self.Q[-1])) 
+        Hwf = self.ham.mtot.dot(q)
 
         return Hwf
 
@@ -118,74 +192,40 @@ class LanczosPropagator():
         """
 
         self.NK += 1
-
-        r = self.__applyHwf() - self.betta[-2]*self.Q[-2] - \
-            self.alpha[-1]*self.Q[-1]
-
-        v = self.Q[-1]
-        self.Q.append(r / self.betta[-1])
-        r = self.__applyHwf() - self.betta[-1]*v
-        self.alpha.append(np.dot(np.conjugate(np.transpose(self.Q[-1])), r))
-        r -= self.alpha[-1] * self.Q[-1]
-        self.betta.append(np.sqrt(np.dot(np.conjugate(np.transpose(r)), r)))
+        self.create_subspace()
 
         return None
 
-    def __build_hamiltonian_in_lanczos_basis(self):
+    def __build_propagator(self):
         """
-        The build_hamiltonian_in_lanczos_basis() creates the hamiltonian
-        matrix in the lanczos basis
+        The build_propagator() calculates the first column of
+        exp(-i*HL*dt/hbar) = Z * exp(-i*Dn*dt/hbar) * Z^T,
+        where HL is the tridiagonal hamiltonian in the Lanczos basis
             |alpha_0    betta_0    0    0    ...            |
         HL = |betta_0    alpha_1    betta_1    0    ...      |
             |0    betta_1    alpha_2    betta_1    0    ... |
 
-        Return 
-        None
-
-        The function fills in the matrix self.HL
-        """
-        bt = self.betta[:]
-
-        bt.insert(0,0.0)
-
-        NKSpace = len(self.alpha)
-
-        return  self.alpha * np.diag(np.ones(NKSpace, dtype = float)) + \
-                bt[:-1] * np.diag(np.ones(NKSpace-1, dtype = float), 1) + \
-                bt[1:] * np.diag(np.ones(NKSpace-1, dtype = float), -1)
-
-    def __build_propagator(self):
-        """
-        THe built_propagator() creates the
-        exp(-i*HL*dt/hbar) = Z * exp(-i*Dn*dt/hbar) * Z^deggar
-
         NOTE:
         hbar = 0.66 * 10**(-15) eV * s (!!!)
         for graphene Dn is in eV
 
         Return
-        btmp: propagator itself
-
-        THe function fills in self.U
+        The coefficients of the propagated wave function in the Lanczos
+        basis.
 
         """
 
         hbar = 0.66 * 10**(-15) 
 
-        HL = self.__build_hamiltonian_in_lanczos_basis()
-
-        dt = self.dt
-        w, v = np.linalg.eig(HL)
-
-        U = np.zeros((len(w),len(w)), dtype = complex)
-
-        for i in range(len(w)):
-            atmp = dt * w[i] / hbar
-            U[:,i] = v[:,i] * complex(np.cos(atmp), -np.sin(atmp))
-
-        btmp = np.dot(U, np.conjugate(np.transpose(v)))
+        NK = self.NK
+        if NK == 1:
+            w = self.alpha[:1]
+            v = np.ones((1, 1))
+        else:
+            w, v = scipy.linalg.eigh_tridiagonal(self.alpha[:NK],
+                                                 self.betta[:NK-1])
 
-        return btmp
+        return np.dot(v, np.exp(-1j * w * self.dt / hbar) * v[0])
 
     def propagate(self, num_error=10**(-18), regime='SIL'):
 
@@ -206,16 +246,13 @@ class LanczosPropagator():
         wf_out: one time step evolution of the wf0
         """
 
-        #if self.U == None:
-
-        if regime is not 'SIL':
-            if regime is not 'TSC':
+        if regime != 'SIL':
+            if regime != 'TSC':
                 raise NameError("name %(regime)s is not defined" % vars())
 
         while 1:
 
-            U = self.__build_propagator()
-            wf_krylov = U[:,0]
+            wf_krylov = self.__build_propagator()
 
             dwfk = wf_krylov[self.NK-1]
 
@@ -227,7 +264,7 @@ class LanczosPropagator():
             """
             conver = np.abs(dwfk)**2
 
-            if conver < num_error:
+            if conver < num_error or self.__invariant:
 
                 break
 
@@ -246,11 +283,175 @@ class LanczosPropagator():
                 self.__add_subspace()
                 #print 'num_error', conver
 
-        wfk = np.zeros(len(self.Q[0]), dtype = complex)
-        for i in range(0, self.NK):
-            wfk[:] += wf_krylov[i] * self.Q[i]
+        # one matrix-vector product with the basis
+        wfk = np.dot(wf_krylov * self.norm, self.Q[:self.NK])
 
         wf_out = wave_function.WaveFunction(wfk)
         wf_out.coords = self.ham.coords
 
-        return wf_out, self.dt, self.NK
\ No newline at end of file
+        return wf_out, self.dt, self.NK
+
+
+class BlockLanczosPropagator():
+    """
+    Lanczos propagator for a block of wave functions, an array of shape
+    (N, nr of states). Every state has its own Krylov space (its own alpha,
+    betta and propagator), but the Krylov vectors of all states are
+    calculated together: one sparse matrix-matrix product per Lanczos step
+    instead of one matrix-vector product per state, so the hamiltonian is
+    read from memory once for all states.
+
+    Same interface as LanczosPropagator; dt and NK are common to all states
+    ('SIL' adjusts dt for the slowest state, 'TSC' enlarges the Krylov space
+    until all states are converged).
+    """
+
+    def __init__(self, wf, ham, NK=6, dt=1., NKmax=None, basis=None):
+        """
+        wf: array of shape (N, nr of states)
+        NKmax, basis: see LanczosPropagator; basis has the shape
+        (NKmax, N, nr of states)
+        """
+        wf = np.asarray(wf)
+        if wf.ndim != 2:
+            raise ValueError('wf must be an array of shape (N, nr of states)')
+
+        if NKmax is None:
+            NKmax = 2 * NK
+        NKmax = max(NK, NKmax)
+        if basis is not None and basis.shape[1:] == wf.shape and \
+                basis.shape[0] >= NK and basis.dtype == complex and \
+                basis.flags.c_contiguous:
+            self.Q = basis
+        else:
+            self.Q = np.empty((NKmax,) + wf.shape, dtype=complex)
+        self.alpha = np.zeros((self.Q.shape[0], wf.shape[1]))
+        self.betta = np.zeros((self.Q.shape[0], wf.shape[1]))
+
+        self.norm = np.sqrt(np.sum(np.abs(wf)**2, axis=0))
+        np.multiply(wf, 1. / self.norm, out=self.Q[0])
+
+        self.NK = NK
+        self.dt = dt
+        self.ham = ham
+        if self.ham.mtot is None:
+            self.ham.build_hamiltonian()
+        self.__nvectors = 0
+        self.__work = None
+        self.create_subspace()
+
+    @property
+    def basis(self):
+        """
+        The basis array, to be reused by the next propagator.
+        """
+        return self.Q
+
+    def create_subspace(self):
+        """
+        Calculates the Krylov vectors up to self.NK for all states (see
+        LanczosPropagator.create_subspace).
+        """
+        while self.__nvectors < self.NK:
+            self.__lanczos_step()
+
+        return None
+
+    def __lanczos_step(self):
+        j = self.__nvectors
+        if j >= self.Q.shape[0]:
+            self.__enlarge_basis()
+        Q = self.Q
+
+        if j > 0:
+            # states with an exhausted Krylov space get zero vectors
+            betta = self.betta[j-1]
+            invariant = betta <= np.finfo(float).eps * \
+                np.maximum(1., np.abs(self.alpha[j-1]))
+            np.multiply(self.__r, np.where(invariant, 0.,
+                                           1. / np.where(invariant, 1., betta)),
+                        out=Q[j])
+
+        r = np.asarray(self.ham.mtot.dot(Q[j]), dtype=complex)
+        if self.__work is None or self.__work.shape != r.shape:
+            self.__work = np.empty_like(r)
+        work = self.__work
+        if j > 0:
+            np.multiply(Q[j-1], self.betta[j-1], out=work)
+            r -= work
+        self.alpha[j] = self.__column_dot(Q[j], r)
+        np.multiply(Q[j], self.alpha[j], out=work)
+        r -= work
+        self.betta[j] = np.sqrt(self.__column_dot(r, r))
+        self.__r = r
+        self.__nvectors += 1
+
+    @staticmethod
+    def __column_dot(a, b):
+        """
+        Real part of the column-wise inner products <a_s|b_s>, without
+        temporary arrays.
+        """
+        return np.einsum('nk,nk->k', a.view(float),
+                         b.view(float)).reshape(-1, 2).sum(axis=1)
+
+    def __enlarge_basis(self):
+        Q = np.empty((2 * self.Q.shape[0],) + self.Q.shape[1:], dtype=complex)
+        Q[:self.Q.shape[0]] = self.Q
+        self.Q = Q
+        self.alpha = np.concatenate([self.alpha, np.zeros_like(self.alpha)])
+        self.betta = np.concatenate([self.betta, np.zeros_like(self.betta)])
+
+    def __build_propagator(self):
+        """
+        First columns of exp(-i*HL*dt/hbar) of all states, shape (NK, nr of
+        states).
+        """
+        hbar = 0.66 * 10**(-15)
+
+        NK = self.NK
+        coefficients = np.empty((NK, self.alpha.shape[1]), dtype=complex)
+        for state in range(self.alpha.shape[1]):
+            if NK == 1:
+                w = self.alpha[:1, state]
+                v = np.ones((1, 1))
+            else:
+                w, v = scipy.linalg.eigh_tridiagonal(self.alpha[:NK, state],
+                                                     self.betta[:NK-1, state])
+            coefficients[:, state] = np.dot(v, np.exp(-1j * w * self.dt / hbar) * v[0])
+        return coefficients
+
+    def propagate(self, num_error=10**(-18), regime='SIL'):
+        """
+        One time step for all states, see LanczosPropagator.propagate.
+
+        Return
+        wf_out: array of shape (N, nr of states), dt, NK
+        """
+        if regime != 'SIL':
+            if regime != 'TSC':
+                raise NameError("name %(regime)s is not defined" % vars())
+
+        while 1:
+
+            wf_krylov = self.__build_propagator()
+
+            conver = np.max(np.abs(wf_krylov[self.NK-1])**2)
+
+            if conver < num_error:
+
+                break
+
+            if regime == 'SIL':
+                scale = 0.95 * (num_error / conver)**(1./ self.NK)
+                self.dt *= max([0.5, scale])
+
+            elif regime == 'TSC':
+                self.NK += 1
+                self.create_subspace()
+
+        wfk = np.einsum('jns,js->ns', self.Q[:self.NK], wf_krylov * self.norm)
+
+        return wfk, self.dt, self.NK
+
+# end class BlockLanczosPropagator
@@ -0,0 +1,167 @@
+import numpy as np
+import envtb.ldos.kpm
+from . import chebyshev
+from . import lanczos
+from . import wave_function
+
+
+class _ExponentHamiltonian(object):
+    """
+    Linear combination of H(t) at the Gauss-Legendre nodes, with the
+    attributes the propagators need (mtot, coords).
+    """
+
+    def __init__(self, mtot, coords):
+        self.mtot = mtot
+        self.coords = coords
+
+    def build_hamiltonian(self):
+        pass
+
+
+class MagnusPropagator(object):
+    """
+    Fourth order commutator-free Magnus integrator (CFM4) for a strongly time
+    dependent hamiltonian:
+
+    psi(t + dt) = exp(-i*dt*(a1*H1 + a2*H2)/hbar) exp(-i*dt*(a2*H1 + a1*H2)/hbar) psi(t)
+
+    with H1, H2 = H(t + c1*dt), H(t + c2*dt) at the Gauss-Legendre nodes
+    c1,2 = 1/2 -+ sqrt(3)/6 and a1,2 = (3 -+ 2*sqrt(3))/12 (Blanes and Moan,
+    Appl. Numer. Math. 56, 1519 (2006)). Unlike one evaluation of A(t) per
+    step, the error is O(dt**5) per step also during the pulse, so much
+    larger steps give the same accuracy.
+
+    Each exponential is applied with LanczosPropagator ('lanczos', fixed dt,
+    growing Krylov space; BlockLanczosPropagator for a block of states) or
+    ChebyshevPropagator ('chebyshev').
+
+    Example:
+    >>> ham_t = TimeDependentHamiltonian(ham, vector_potential=A_pot)
+    >>> magnus = MagnusPropagator(ham_t, dt=0.01 * 10**(-12))
+    >>> wf, t = magnus.propagate(wf, t0=0., nsteps=100)
+
+    NOTE:
+    hbar = 0.66 * 10**(-15) eV * s, like in lanczos
+    """
+
+    c1 = 0.5 - np.sqrt(3.) / 6.
+    c2 = 0.5 + np.sqrt(3.) / 6.
+    a1 = (3. - 2. * np.sqrt(3.)) / 12.
+    a2 = (3. + 2. * np.sqrt(3.)) / 12.
+
+    def __init__(self, ham_t, dt, backend='lanczos', NK=12,
+                 num_error=10**(-18), bounds=None):
+        """
+        ham_t: TimeDependentHamiltonian
+        dt: time step in s
+        backend: 'lanczos' or 'chebyshev'
+        NK: (initial) size of the Krylov space for 'lanczos'
+        num_error: accuracy of each exponential (see the propagators)
+        bounds: (emin, emax) covering the spectra of H(t) for all t, used by
+        'chebyshev'. They must enclose these spectra. If None, they are the
+        extreme eigenvalues of H at the first step with 5% margin, and in
+        every step they are widened by the change of the diagonal (scalar
+        potential) since then, which by Weyl's inequality keeps the spectrum
+        enclosed. Changes of the vector potential have to stay within the
+        margin.
+        """
+        if backend not in ('lanczos', 'chebyshev'):
+            raise ValueError('Unknown backend: %s' % backend)
+        self.ham_t = ham_t
+        self.dt = dt
+        self.backend = backend
+        self.NK = NK
+        self.num_error = num_error
+        self.bounds = bounds
+        self.__reference_diagonal = None
+        self.__data1 = np.empty_like(ham_t.mtot.data)
+        self.__exponent = _ExponentHamiltonian(ham_t.mtot.copy(),
+                                               ham_t.coords)
+        self.__basis = None
+
+    def step(self, wf, t):
+        """
+        Propagates wf (WaveFunction or array, also (N, nr of states)) from t
+        to t + dt.
+
+        Return:
+        The wave function at t + dt (same type as wf).
+        """
+        psi = wf.wf1d if isinstance(wf, wave_function.WaveFunction) else wf
+        psi = np.asarray(psi, dtype=complex)
+
+        self.ham_t.update(t + self.c1 * self.dt)
+        self.__data1[:] = self.ham_t.mtot.data
+        if self.backend == 'chebyshev':
+            diagonal1 = self.ham_t.mtot.diagonal().real
+            if self.bounds is None:
+                emin, emax = envtb.ldos.kpm.spectral_bounds(self.ham_t.mtot)
+                margin = 0.05 * (emax - emin)
+                self.bounds = (emin - margin, emax + margin)
+                self.__reference_diagonal = diagonal1
+        self.ham_t.update(t + self.c2 * self.dt)
+        data2 = self.ham_t.mtot.data
+
+        bounds = self.bounds
+        if self.backend == 'chebyshev' and \
+                self.__reference_diagonal is not None:
+            shifts = np.concatenate(
+                [diagonal1 - self.__reference_diagonal,
+                 self.ham_t.mtot.diagonal().real - self.__reference_diagonal])
+            bounds = (self.bounds[0] + min(0., shifts.min()),
+                      self.bounds[1] + max(0., shifts.max()))
+
+        # both exponents are written as 2*(...) applied for dt/2, so that
+        # the weights add up to one like for a hamiltonian
+        data = self.__exponent.mtot.data
+        for w1, w2 in ((self.a2, self.a1), (self.a1, self.a2)):
+            np.multiply(self.__data1, 2. * w1, out=data)
+            data += 2. * w2 * data2
+            psi = self.__exponential(psi, bounds)
+
+        if isinstance(wf, wave_function.WaveFunction):
+            wf_out = wave_function.WaveFunction(psi)
+            wf_out.coords = self.ham_t.coords
+            return wf_out
+        return psi
+
+    def __exponential(self, psi, bounds):
+        dt = 0.5 * self.dt
+        if self.backend == 'chebyshev':
+            emin, emax = bounds
+            # spectrum of the weighted sum of H1 and H2 (one negative weight)
+            w1, w2 = 2. * self.a2, 2. * self.a1
+            bounds = (w1 * emin + w2 * emax, w1 * emax + w2 * emin)
+            out = chebyshev.ChebyshevPropagator(
+                psi, self.__exponent, dt=dt, bounds=bounds).propagate(
+                    num_error=self.num_error)[0]
+            return out if psi.ndim > 1 else out.wf1d
+
+        if psi.ndim > 1:
+            prop = lanczos.BlockLanczosPropagator(psi, self.__exponent,
+                                                  NK=self.NK, dt=dt,
+                                                  basis=self.__basis)
+            self.__basis = prop.basis
+            return prop.propagate(num_error=self.num_error, regime='TSC')[0]
+        prop = lanczos.LanczosPropagator(psi, self.__exponent, NK=self.NK,
+                                         dt=dt, basis=self.__basis)
+        self.__basis = prop.basis
+        wf_out, dt_new, NK_new = prop.propagate(num_error=self.num_error,
+                                                regime='TSC')
+        return wf_out.wf1d
+
+    def propagate(self, wf, t0, nsteps):
+        """
+        nsteps steps from t0.
+
+        Return:
+        wf, t at the end
+        """
+        t = t0
+        for i in range(nsteps):
+            wf = self.step(wf, t)
+            t = t0 + (i + 1) * self.dt
+        return wf, t
+
+# end class MagnusPropagator
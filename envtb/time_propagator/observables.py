@@ -0,0 +1,169 @@
+"""
+Observables of propagated wave functions without plotting.
+
+The coordinates, the current operators i[H, x], i[H, y] and the eigenbasis
+are set up once per hamiltonian, every evaluation is a few matrix-vector
+(or, for a block of states in the columns, matrix-matrix) products.
+
+Example:
+>>> obs = Observables(ham_t, v)
+>>> for t in times:
+...     ham_t.update(t)
+...     wf = LanczosPropagator(wf, ham_t, NK=12, dt=dt).propagate()[0]
+...     x, y = obs.position(wf.wf1d)
+...     j_x, j_y = obs.current(wf.wf1d)
+...     occupations = obs.occupations(wf.wf1d)
+"""
+
+import numpy as np
+import scipy.sparse
+from . import wave_function
+
+
+class Observables(object):
+    """
+    Position, dipole, current and eigenbasis occupations of a wave function
+    psi (array of length N, or (N, nr of states) for a block of states).
+    Results for a block are arrays with one entry per state.
+
+    NOTE:
+    hbar = 0.66 * 10**(-15) eV * s, like in lanczos
+    """
+
+    def __init__(self, ham, v=None):
+        """
+        ham: hamiltonian with ham.mtot and ham.coords (GeneralHamiltonian,
+        TimeDependentHamiltonian). The current operators follow the in place
+        updates of a TimeDependentHamiltonian.
+        v: eigenbasis (eigenvectors in the columns), needed for expansion()
+        and occupations()
+        """
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        self.ham = ham
+        self.v = v
+
+        coords = np.asarray(ham.coords, dtype=float)
+        self.coords = coords[:ham.mtot.shape[0], :2]
+        self.__xy = np.ascontiguousarray(self.coords.T)
+        self.center = self.coords.mean(axis=0)
+
+        # i[H, x]_ij = i H_ij (x_j - x_i), x and y stacked into one
+        # (2N, N) matrix, so both components need one product
+        matrix = ham.mtot
+        if not scipy.sparse.isspmatrix_csr(matrix):
+            matrix = scipy.sparse.csr_matrix(matrix)
+        N = matrix.shape[0]
+        rows = np.repeat(np.arange(N), np.diff(matrix.indptr))
+        displacement = self.coords[matrix.indices] - self.coords[rows]
+        self.__displacement = 1j * np.concatenate(
+            [displacement[:, 0], displacement[:, 1]])
+        self.__matrix = matrix
+        self.__current = scipy.sparse.csr_matrix(
+            (np.empty(2 * matrix.nnz, dtype=complex),
+             np.concatenate([matrix.indices, matrix.indices]),
+             np.concatenate([matrix.indptr,
+                             matrix.indptr[1:] + matrix.indptr[-1]])),
+            shape=(2 * N, N))
+        self.__time = None
+        self.update()
+
+    def update(self):
+        """
+        Recalculates the current operators from ham.mtot (done automatically
+        when ham.time changed). Call it after changing the data of ham.mtot
+        of a static hamiltonian.
+        """
+        data = self.__matrix.data
+        if self.__matrix is not self.ham.mtot:
+            data = scipy.sparse.csr_matrix(self.ham.mtot).data
+        np.multiply(self.__displacement, np.concatenate([data, data]),
+                    out=self.__current.data)
+        self.__time = getattr(self.ham, 'time', None)
+
+    def current_operator(self):
+        """
+        i[H, x] and i[H, y] (csr matrices, eV * Angstrem).
+        """
+        if getattr(self.ham, 'time', None) != self.__time:
+            self.update()
+        N = self.__current.shape[1]
+        return self.__current[:N], self.__current[N:]
+
+    @staticmethod
+    def __psi(psi):
+        if isinstance(psi, wave_function.WaveFunction):
+            psi = psi.wf1d
+        return np.asarray(psi)
+
+    def norm(self, psi):
+        """
+        <psi|psi>
+        """
+        psi = self.__psi(psi)
+        return np.einsum('i...,i...->...', psi.conj(), psi).real
+
+    def position(self, psi):
+        """
+        Average position <x>, <y> (Angstrem) of the normalized density.
+        """
+        psi = self.__psi(psi)
+        density = psi.real**2 + psi.imag**2
+        r = self.__xy.dot(density) / density.sum(axis=0)
+        return r[0], r[1]
+
+    def dipole(self, psi, charge=-1.):
+        """
+        Dipole moment charge * (<r> - center of the sites), in e * Angstrem.
+        """
+        x, y = self.position(psi)
+        return charge * (x - self.center[0]), charge * (y - self.center[1])
+
+    def current(self, psi):
+        """
+        Expectation values of the velocity operators i[H, x]/hbar,
+        i[H, y]/hbar (Angstrem/s) of the normalized state.
+        """
+        hbar = 0.66 * 10**(-15)
+        psi = self.__psi(psi)
+        if getattr(self.ham, 'time', None) != self.__time:
+            self.update()
+        N = psi.shape[0]
+        J_psi = self.__current.dot(psi)
+        j = np.einsum('i...,i...->...', psi.conj(), J_psi[:N]).real, \
+            np.einsum('i...,i...->...', psi.conj(), J_psi[N:]).real
+        norm = self.norm(psi)
+        return j[0] / (hbar * norm), j[1] / (hbar * norm)
+
+    def expansion(self, psi):
+        """
+        Coefficients v^H psi of psi in the eigenbasis.
+        """
+        if self.v is None:
+            raise ValueError('No eigenbasis given')
+        psi = self.__psi(psi)
+        return np.dot(psi.conj().T, self.v).conj().T
+
+    def occupations(self, psi):
+        """
+        Occupations |v^H psi|**2 of the eigenstates.
+        """
+        c = self.expansion(psi)
+        return c.real**2 + c.imag**2
+
+    def evaluate(self, psi):
+        """
+        All observables of psi.
+
+        Return:
+        dict with position, dipole, current (and occupations if there is an
+        eigenbasis)
+        """
+        values = {'position': self.position(psi),
+                  'dipole': self.dipole(psi),
+                  'current': self.current(psi)}
+        if self.v is not None:
+            values['occupations'] = self.occupations(psi)
+        return values
+
+# end class Observables
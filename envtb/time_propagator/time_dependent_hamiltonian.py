@@ -0,0 +1,132 @@
+import copy
+import numpy as np
+import scipy.sparse
+from scipy.sparse import linalg
+import envtb.ldos.potential
+
+
+class TimeDependentHamiltonian(object):
+    """
+    Hamiltonian H(t) = H0 with Peierls phases of a uniform vector potential
+    A(t) plus a scalar potential U(t) on the diagonal.
+
+    The csr structure of H0, the bond displacements and the site coordinates
+    are set up once. update(t) overwrites the data array of self.mtot in
+    place, so the object can be handed to the propagators (LanczosPropagator
+    uses ham.mtot and ham.coords) in every time step without copying the
+    Hamiltonian.
+
+    Example:
+    >>> ham_t = TimeDependentHamiltonian(ham, vector_potential=A_pot)
+    >>> for t in times:
+    ...     ham_t.update(t)
+    ...     wf = LanczosPropagator(wf, ham_t, NK=12, dt=dt).propagate()[0]
+    """
+
+    def __init__(self, ham, vector_potential=None, scalar_potential=None,
+                 in_x=False):
+        """
+        ham: static hamiltonian (GeneralHamiltonian), e.g. with a magnetic
+        field or a static potential already applied
+        vector_potential: callable A(t) returning [Ax, Ay], e.g. an instance
+        of vector_potential.VectorPotential
+        scalar_potential: callable U(t) returning a potential (Potential1D,
+        Potential2D, ...) or an array of the on-site energies
+        in_x: Potential1D is a function of x instead of y (see
+        apply_potential)
+        """
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        self.vector_potential = vector_potential
+        self.scalar_potential = scalar_potential
+        self.in_x = in_x
+        self.Nx = ham.Nx
+        self.Ny = ham.Ny
+        self.coords = ham.coords
+        self.Ntot = ham.mtot.shape[0]
+
+        # explicit (zero) diagonal elements, so that U(t) can be written
+        # into the data array
+        mtot = scipy.sparse.csr_matrix(ham.mtot).tocoo()
+        diagonal = np.arange(self.Ntot)
+        mtot = scipy.sparse.csr_matrix(
+            (np.concatenate([mtot.data, np.zeros(self.Ntot)]),
+             (np.concatenate([mtot.row, diagonal]),
+              np.concatenate([mtot.col, diagonal]))),
+            shape=mtot.shape, dtype=complex)
+        static = copy.copy(ham)
+        static.mtot = mtot
+
+        matrix, displacement, midpoint = static.bond_table('mtot')
+        self.__data0 = matrix.data.copy()
+        self.__dx = np.ascontiguousarray(displacement[:, 0])
+        self.__dy = np.ascontiguousarray(displacement[:, 1])
+        rows = np.repeat(diagonal, np.diff(matrix.indptr))
+        self.__diagonal = np.nonzero(rows == matrix.indices)[0]
+        self.__site_coords = static.coords_array()[:self.Ntot]
+
+        self.mtot = matrix
+        self.__phase = np.empty(len(self.__data0))
+        self.__exp_phase = np.empty(len(self.__data0), dtype=complex)
+        self.time = None
+
+    def build_hamiltonian(self):
+        """
+        Nothing to do, mtot always exists (for compatibility with
+        GeneralHamiltonian).
+        """
+        pass
+
+    def update(self, t):
+        """
+        Sets self.mtot to H(t) in place.
+
+        Return:
+        self
+        """
+        data = self.mtot.data
+        if self.vector_potential is None:
+            data[:] = self.__data0
+        else:
+            A = self.vector_potential(t)
+            conversion_factor = 1.602176487 / 1.0545717*1e5  # e/hbar*Angstrem
+            phase = self.__phase
+            np.multiply(self.__dx, conversion_factor * A[0], out=phase)
+            phase += conversion_factor * A[1] * self.__dy
+            exp_phase = self.__exp_phase
+            exp_phase.real = 0.
+            exp_phase.imag = phase
+            np.exp(exp_phase, out=exp_phase)
+            np.multiply(self.__data0, exp_phase, out=data)
+
+        if self.scalar_potential is not None:
+            data[self.__diagonal] += self.__site_energies(
+                self.scalar_potential(t))
+
+        self.time = t
+        return self
+
+    def __site_energies(self, U):
+        if not callable(U):
+            return np.asarray(U)
+        if isinstance(U, envtb.ldos.potential.Potential1D):
+            if self.in_x:
+                return envtb.ldos.potential.evaluate(U, self.__site_coords[:, 0])
+            return envtb.ldos.potential.evaluate(U, self.__site_coords[:, 1])
+        return envtb.ldos.potential.evaluate(U, self.__site_coords[:, :2].T)
+
+    def matvec(self, psi):
+        """
+        H(t) psi for a vector or a block of vectors (columns).
+        """
+        return self.mtot.dot(psi)
+
+    def linear_operator(self):
+        """
+        H(t) as scipy.sparse.linalg.LinearOperator. It follows the in-place
+        updates.
+        """
+        return linalg.LinearOperator(self.mtot.shape, matvec=self.matvec,
+                                     matmat=self.matvec, dtype=complex)
+
+# end class TimeDependentHamiltonian
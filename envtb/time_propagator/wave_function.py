@@ -1,5 +1,7 @@
 import numpy as np
 import envtb.ldos.plotter
+import envtb.ldos.density
+import envtb.utility.trajectory
 try:
     import matplotlib.pylab as plt
 except:
@@ -43,40 +45,41 @@ class WaveFunction(object):
         Return:
         x_aver, y_aver
         """
-        f_aver = sum([np.abs(self.wf1d[i])**2 for i in range(len(self.wf1d))])
-        x_aver = sum([np.abs(self.wf1d[i])**2 * self.coords[i][0]
-                      for i in range(len(self.wf1d))]) / f_aver
-        y_aver = sum([np.abs(self.wf1d[i])**2 * self.coords[i][1]
-                      for i in range(len(self.wf1d))]) / f_aver
+        density = np.abs(self.wf1d)**2
+        coords = np.asarray(self.coords, dtype=float)[:len(density)]
+        x_aver, y_aver = np.dot(density, coords[:, :2]) / density.sum()
 
         return x_aver, y_aver
 
-    def calculate_current(self, A):
+    def finite_differences(self):
+        """
+        Derivatives of the wave function between consecutive sites
+        (wf[i+1]-wf[i]) / (r[i+1]-r[i]) in x and y, zero if the coordinate
+        does not change and for the last site.
 
-        wf_prime_x = []
-        wf_prime_y = []
-        n = len(self.wf1d)
-        for i in range(n-1):
-            if abs(self.coords[i+1][0] - self.coords[i][0]) > 0:
-                wf_prime_x.append((self.wf1d[i+1]-self.wf1d[i]) / (self.coords[i+1][0] - self.coords[i][0]))
-            else:
-                wf_prime_x.append(0.0)
+        Return:
+        wf_prime_x, wf_prime_y
+        """
+        wf = np.asarray(self.wf1d)
+        n = len(wf)
+        coords = np.asarray(self.coords, dtype=float)[:n, :2]
+        dr = np.diff(coords, axis=0)
+        dwf = np.diff(wf)[:, np.newaxis]
+        wf_prime = np.zeros((n, 2), dtype=complex)
+        np.divide(dwf, dr, out=wf_prime[:-1], where=np.abs(dr) > 0)
+        return wf_prime[:, 0], wf_prime[:, 1]
 
-            if abs(self.coords[i+1][1] - self.coords[i][1]) > 0:
-                wf_prime_y.append((self.wf1d[i+1]-self.wf1d[i]) / (self.coords[i+1][1] - self.coords[i][1]))
-            else:
-                wf_prime_y.append(0.0)
+    def calculate_current(self, A):
 
-        wf_prime_x.append(0)
-        wf_prime_y.append(0)
+        wf = np.asarray(self.wf1d)
+        wf_prime_x, wf_prime_y = self.finite_differences()
+        norm = np.vdot(wf, wf)
 
-        j_x = - (np.dot(np.conjugate(np.array(self.wf1d)), np.array(wf_prime_x)) -
-                np.dot(np.array(self.wf1d), np.conjugate(np.array(wf_prime_x)))) * complex(0.0, 1.0)\
-                + A[0] * np.dot(np.array(self.wf1d), np.conjugate(np.array(self.wf1d)))
+        j_x = - (np.vdot(wf, wf_prime_x) - np.vdot(wf_prime_x, wf)) * complex(0.0, 1.0)\
+                + A[0] * norm
 
-        j_y = - (np.dot(np.conjugate(np.array(self.wf1d)), np.array(wf_prime_y)) -
-               np.dot(np.array(self.wf1d), np.conjugate(np.array(wf_prime_y)))) * complex(0.0, 1.0)\
-                + A[1] * np.dot(np.array(self.wf1d), np.conjugate(np.array(self.wf1d)))
+        j_y = - (np.vdot(wf, wf_prime_y) - np.vdot(wf_prime_y, wf)) * complex(0.0, 1.0)\
+                + A[1] * norm
 
         return j_x, j_y
 
@@ -84,9 +87,24 @@ class WaveFunction(object):
         pass
 
     def wave_function_from_file(self, file_name, wf_num=-1):
+        """
+        Reads frame wf_num of a trajectory file or of a text file written
+        by save_wave_function_data.
+
+        Return:
+        time of the frame
+        """
+        if envtb.utility.trajectory.is_trajectory(file_name):
+            trajectory = envtb.utility.trajectory.Trajectory(file_name)
+            tm, wf = trajectory[wf_num]
+            self.wf1d = np.array(wf)
+            if trajectory.coords.shape[1] > 0:
+                self.coords = trajectory.coords.tolist()
+            return float(tm)
 
         f_in = open(file_name,'r')
         ln = f_in.readlines()
+        f_in.close()
         lnS = ln[wf_num].split('   ')
         tm = float(lnS[0])
         self.wf1d = np.array(eval(lnS[1]))
@@ -94,12 +112,20 @@ class WaveFunction(object):
         return tm
 
     def expand_wave_function(self, v):
-        return [np.abs(np.dot(np.conjugate(np.transpose(v[:,i])), self.wf1d))
-                for i in range(len(v[0,:]))]
+        """
+        Absolute values |v[:,i]^H wf| of the expansion in the eigenbasis v.
+        """
+        return np.abs(np.dot(np.conjugate(self.wf1d), v))
 
     @staticmethod
     def save_wave_function_data(wave_function, file_out, param=None):
-        print('Hi!')
+        """
+        Appends a frame (param is the time). file_out is a
+        trajectory.TrajectoryWriter (binary) or an open text file.
+        """
+        if isinstance(file_out, envtb.utility.trajectory.TrajectoryWriter):
+            file_out.append(wave_function, 0.0 if param is None else param)
+            return None
         file_out.writelines(repr(param)+'   '+repr(wave_function.tolist())+'\n')
         return None
 
@@ -115,7 +141,7 @@ class WaveFunction(object):
 
     def save_wave_function_expansion(self, file_out, v):
         a = self.expand_wave_function(v)
-        file_out.writelines(repr(a)+'\n')
+        file_out.writelines(repr(a.tolist())+'\n')
         return None
 
     def save_coords_current(self, file_out, A):
@@ -175,16 +201,20 @@ class WaveFunction0(WaveFunction):
     ham - hamiltonian
 
     mu- fermi energy
+
+    cache - eigenpair cache of ham.eigenvalue_problem()
     """
 
-    def __init__(self, ham, mu, kT):
+    def __init__(self, ham, mu, kT, cache=None):
 
         self.ham = ham
+        self.cache = cache
         self.wf1d = self.setup(mu, kT)
         self.coords = self.ham.coords
 
     def setup(self, mu, kT):
-        w, v = self.ham.eigenvalue_problem()
+        w, v = self.ham.eigenvalue_problem(cache=self.cache)
+        self.w, self.v = w, v
         wf0 = np.zeros(len(v[:,0]), dtype = complex)
         count = 0
         for i in range(len(w)):
@@ -197,4 +227,15 @@ class WaveFunction0(WaveFunction):
         norm = np.sum(np.abs(wf0)**2)
         return wf0 / np.sqrt(norm)
 
+    def electron_density(self, mu, kT, method='exact', **kwrds):
+        """
+        Site density at mu, kT. 'exact' sums over the full spectrum (the
+        eigenpairs of setup() are only the ones closest to sigma), 'chebyshev'
+        works without diagonalization (see envtb.ldos.density).
+        """
+        if method == 'exact' and 'eigenpairs' not in kwrds:
+            kwrds['eigenpairs'] = self.ham.full_eigenvalue_problem(cache=self.cache)
+        return envtb.ldos.density.electron_density(self.ham, mu, kT,
+                                                   method=method, **kwrds)
+
 #end class WaveFunction0
@@ -10,6 +10,7 @@ import imp
 imp.reload(w90)
 imp.reload(fourier)
 from envtb.utility.fourier import GNRSimpleFourierTransform
+import envtb.utility.trajectory as trajectory
 import copy
 import os
 
@@ -82,6 +83,9 @@ class NumericalData(object):
 
     @staticmethod
     def get_wave_function_from_file(file_name, Nwf=0):
+        if trajectory.is_trajectory(file_name):
+            tm, wf = trajectory.Trajectory(file_name)[Nwf]
+            return float(tm), np.array(wf)
         fin = open(file_name,'r')
         ln = fin.readlines()[Nwf]
         lnS = ln.split('   ')
@@ -90,6 +94,25 @@ class NumericalData(object):
         fin.close()
         return tm, wf
 
+    @staticmethod
+    def iterate_wave_functions(file_name, start=0, stop=None, step=1):
+        """
+        Lazy iteration over (time, wf) of the frames start:stop:step of a
+        trajectory or text file. Only the frames which are used are read.
+        """
+        if trajectory.is_trajectory(file_name):
+            for tm, wf in trajectory.Trajectory(file_name).iterate(start, stop, step):
+                yield float(tm), np.array(wf)
+            return
+        with open(file_name,'r') as fin:
+            for i, ln in enumerate(fin):
+                if stop is not None and i >= stop:
+                    break
+                if i < start or (i - start) % step:
+                    continue
+                lnS = ln.split('   ')
+                yield float(lnS[0]), np.array(eval(lnS[1]))
+
     def calculate_density_matrix(self, c):
         ro_0 = np.array([[c[0,i]*c[0,j].conjugate() for i in range(len(c[0,:]))] for j in range(len(c[0,:]))])
         ro = np.array([[c[-2,i]*c[-2,j].conjugate() for i in range(len(c[-2,:]))] for j in range(len(c[-2,:]))])
@@ -363,9 +386,10 @@ class PlotNumericalData(object):
     def plot_wave_functions_stack(file_name, Nx, Ny, nx_s=3, ny_s=10, time_step=2, file_to_save='wf_stack.png', figuresize=(20,30)):
 
         plt.figure(figsize=figuresize)
-        for i in range(nx_s * ny_s):
+        frames = NumericalData.iterate_wave_functions(
+            file_name, stop=nx_s*ny_s*time_step, step=time_step)
+        for i, (tm, wf) in enumerate(frames):
             plt.subplot(ny_s,nx_s,i+1)
-            tm, wf = NumericalData.get_wave_function_from_file(file_name, Nwf=i*time_step)
             PlotNumericalData.plot_wave_function(wf, Nx, Ny, file_to_save=None, figuresize=None)
             plt.title('%.2E' % tm)
 
@@ -0,0 +1,115 @@
+"""
+On-disk cache of eigenpairs, keyed by a fingerprint of the hamiltonian and
+the parameters of the eigenvalue solver.
+
+The fingerprint is a hash of the content (csr data, indices, geometry), not
+of the python object, so repeated runs and parameter sweeps which build the
+same hamiltonian again find the eigenpairs of the earlier runs. Files are
+written under a temporary name and renamed, so processes starting at the
+same time never read a partially written file.
+
+Example:
+>>> w, v = ham.sorted_eigenvalue_problem(k=250, sigma=0.0, cache=True)
+or, for any solver:
+>>> w, v = cached_eigenpairs(ham.fingerprint(), solve, cache=True, k=250)
+"""
+
+import hashlib
+import os
+import tempfile
+import zipfile
+import numpy
+import scipy.sparse
+
+DEFAULT_DIRECTORY = '.envtb_cache'
+
+
+def digest(*items):
+    """
+    sha1 hex digest of the content of arrays, sparse matrices and other
+    values (the latter through repr). Sparse matrices are brought into
+    canonical csr form first, so that the storage order does not matter.
+    """
+    key = hashlib.sha1()
+    for item in items:
+        if scipy.sparse.issparse(item):
+            matrix = scipy.sparse.csr_matrix(item, copy=True)
+            matrix.sum_duplicates()
+            matrix.sort_indices()
+            key.update(('csr %r %s ' % (matrix.shape, matrix.dtype.str)).encode())
+            for array in (matrix.indptr, matrix.indices):
+                key.update(numpy.ascontiguousarray(array, dtype='<i8').tobytes())
+            key.update(numpy.ascontiguousarray(matrix.data).tobytes())
+        elif isinstance(item, numpy.ndarray):
+            key.update(('array %r %s ' % (item.shape, item.dtype.str)).encode())
+            key.update(numpy.ascontiguousarray(item).tobytes())
+        else:
+            key.update(('%r ' % (item,)).encode())
+    return key.hexdigest()
+
+
+def cache_file_name(fingerprint, cache=True, **parameters):
+    """
+    Path of the cache file for the eigenpairs of the hamiltonian with the
+    given fingerprint, calculated with parameters (e.g. k, sigma, which).
+
+    cache: True (directory .envtb_cache in the working directory) or a
+    directory
+    """
+    directory = DEFAULT_DIRECTORY if cache is True else cache
+    items = ['envtb-eig-1', fingerprint]
+    for name in sorted(parameters):
+        items += [name, parameters[name]]
+    return os.path.join(directory, 'eig_' + digest(*items) + '.npz')
+
+
+def load(file_name):
+    """
+    Eigenpairs w, v from a cache file (v is None if only eigenvalues were
+    stored). Returns None if the file does not exist or is unreadable.
+    """
+    if not os.path.isfile(file_name):
+        return None
+    try:
+        with numpy.load(file_name) as data:
+            v = data['v'] if data['has_v'] else None
+            return data['w'], v
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def save(file_name, w, v=None):
+    """
+    Writes the eigenpairs to a cache file. If the cache directory is not
+    writable, nothing happens.
+    """
+    directory = os.path.dirname(file_name)
+    try:
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory or '.', suffix='.tmp',
+                                         delete=False) as f:
+            numpy.savez(f, w=numpy.asarray(w), has_v=v is not None,
+                        v=numpy.zeros(0) if v is None else numpy.asarray(v))
+        os.replace(f.name, file_name)
+    except OSError:
+        pass
+
+
+def cached_eigenpairs(fingerprint, solve, cache=True, **parameters):
+    """
+    Eigenpairs from the cache, or from solve() (which returns w, v, v may
+    be None) if they are not there yet; then they are stored.
+
+    fingerprint: fingerprint of the hamiltonian (e.g. ham.fingerprint())
+    cache: True, a directory, or None/False to always call solve()
+    parameters: everything else the result depends on (k, sigma, which, ...)
+    """
+    if not cache:
+        return solve()
+    file_name = cache_file_name(fingerprint, cache, **parameters)
+    result = load(file_name)
+    if result is None:
+        result = solve()
+        save(file_name, *result)
+    return result
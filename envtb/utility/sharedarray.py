@@ -0,0 +1,75 @@
+"""
+NumPy arrays in shared memory, to hand big read-only data (e.g. hopping
+matrix blocks) to worker processes without pickling it for every task.
+
+In the parent process:
+>>> shared=SharedArray(blocks)
+>>> pool=ProcessPoolExecutor(initializer=init,initargs=(shared.descriptor(),))
+...
+>>> shared.release()
+
+In the worker (e.g. in init):
+>>> shm,blocks=attach(descriptor)
+"""
+
+import numpy
+from multiprocessing import shared_memory
+
+
+class SharedArray:
+    """
+    Copy of a numpy array in a shared memory block. The creating process
+    owns the block and has to call release() (or use the object as context
+    manager) when the workers are done.
+    """
+
+    def __init__(self, array):
+        """
+        array: the array to copy into shared memory.
+        """
+        array = numpy.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.__shm = shared_memory.SharedMemory(create=True,
+                                                size=max(1, array.nbytes))
+        self.array = numpy.ndarray(self.shape, self.dtype,
+                                   buffer=self.__shm.buf)
+        self.array[...] = array
+
+    def descriptor(self):
+        """
+        Picklable description of the shared array, which can be passed to
+        other processes and opened there with attach().
+        """
+        return (self.__shm.name, self.shape, self.dtype.str)
+
+    def release(self):
+        """
+        Closes and frees the shared memory block. The array must not be
+        used afterwards.
+        """
+        self.array = None
+        self.__shm.close()
+        self.__shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def attach(descriptor):
+    """
+    Opens a shared array created by SharedArray in another process.
+
+    descriptor: the result of SharedArray.descriptor().
+
+    Return:
+    shm: the SharedMemory object. Keep a reference to it as long as the
+    array is used.
+    array: numpy array using the shared memory.
+    """
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, numpy.ndarray(shape, numpy.dtype(dtype), buffer=shm.buf)
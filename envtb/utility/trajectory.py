@@ -0,0 +1,200 @@
+"""
+Append-only binary store for time series of wave functions.
+
+File layout (little endian):
+64 byte header: b'ENVTBTRJ', version (uint32), dimension of the
+coordinates (uint32), number of sites N (uint64), dtype of the wave
+functions (16 byte string, e.g. '<c16'), padding
+coordinates: N x dimension float64 (may be empty, dimension 0)
+frames: time (float64) followed by the N values of the wave function
+
+Frames are appended during the propagation. The number of frames follows
+from the file size, an incomplete last frame (e.g. of a killed job) is
+ignored. The frames are read with numpy.memmap, so a single frame is
+loaded without reading the rest of the file.
+
+Writing:
+>>> with TrajectoryWriter('wave_functions.trj', coords=ham.coords) as trj:
+...     trj.append(wf.wf1d, time)
+
+Reading:
+>>> trj = Trajectory('wave_functions.trj')
+>>> time, wf = trj[100]
+>>> for time, wf in trj.iterate(step=10):
+...     pass
+"""
+
+import os
+import numpy
+
+MAGIC = b'ENVTBTRJ'
+VERSION = 1
+HEADER_SIZE = 64
+
+
+def is_trajectory(file_name):
+    """
+    True if file_name is a trajectory file (and not e.g. a text file).
+    """
+    try:
+        with open(file_name, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def _read_header(f):
+    header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not a trajectory file' % f.name)
+    version, dim = numpy.frombuffer(header, '<u4', 2, 8)
+    N = int(numpy.frombuffer(header, '<u8', 1, 16)[0])
+    dtype = numpy.dtype(header[24:40].rstrip(b'\0').decode())
+    if version != VERSION:
+        raise ValueError('Unknown trajectory version %d' % version)
+    coords = numpy.frombuffer(f.read(8 * N * int(dim)), '<f8').reshape(N, int(dim))
+    return N, dtype, coords, HEADER_SIZE + 8 * N * int(dim)
+
+
+def _frame_dtype(N, dtype):
+    return numpy.dtype([('time', '<f8'), ('wf', dtype, (N,))])
+
+
+class TrajectoryWriter:
+    """
+    Appends frames (time, wave function) to a trajectory file.
+    """
+
+    def __init__(self, file_name, coords=None, N=None, dtype=complex,
+                 append=False):
+        """
+        file_name: name of the trajectory file
+        coords: site coordinates, stored in the header (optional)
+        N: number of sites, needed if coords is None
+        dtype: dtype of the stored wave functions
+        append: if True, an existing file is continued (an incomplete last
+        frame is removed), otherwise the file is created
+        """
+        self.file_name = file_name
+        if append and os.path.exists(file_name):
+            self.__file = open(file_name, 'r+b')
+            self.N, self.dtype, self.coords, self.data_offset = \
+                _read_header(self.__file)
+            self.frame_size = _frame_dtype(self.N, self.dtype).itemsize
+            nframes = (os.path.getsize(file_name) - self.data_offset) // \
+                self.frame_size
+            self.truncate(self.data_offset + nframes * self.frame_size)
+            return
+
+        if coords is not None:
+            coords = numpy.asarray(coords, dtype='<f8')
+            if coords.ndim == 1:
+                coords = coords[:, numpy.newaxis]
+            N = len(coords)
+        elif N is None:
+            raise ValueError('Either coords or N is needed')
+        else:
+            coords = numpy.zeros((N, 0), dtype='<f8')
+        self.N = N
+        self.dtype = numpy.dtype(dtype).newbyteorder('<')
+        self.coords = coords
+        self.data_offset = HEADER_SIZE + coords.nbytes
+        self.frame_size = _frame_dtype(N, self.dtype).itemsize
+
+        header = bytearray(HEADER_SIZE)
+        header[:len(MAGIC)] = MAGIC
+        header[8:16] = numpy.array([VERSION, coords.shape[1]], '<u4').tobytes()
+        header[16:24] = numpy.array([N], '<u8').tobytes()
+        header[24:40] = self.dtype.str.encode().ljust(16, b'\0')
+        self.__file = open(file_name, 'wb')
+        self.__file.write(header)
+        self.__file.write(numpy.ascontiguousarray(coords).tobytes())
+
+    def append(self, wf, time=0.0):
+        """
+        Appends the wave function wf (array of length N) at time.
+        """
+        wf = numpy.ascontiguousarray(wf, dtype=self.dtype)
+        if wf.shape != (self.N,):
+            raise ValueError('The wave function must have the shape (%d,)'
+                             % self.N)
+        self.__file.write(numpy.array([time], '<f8').tobytes())
+        self.__file.write(memoryview(wf).cast('B'))
+
+    def flush(self):
+        self.__file.flush()
+
+    def fileno(self):
+        return self.__file.fileno()
+
+    def tell(self):
+        return self.__file.tell()
+
+    def truncate(self, size):
+        """
+        Truncates the file to size bytes and continues writing there.
+        """
+        self.__file.truncate(size)
+        self.__file.seek(size)
+
+    def close(self):
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# end class TrajectoryWriter
+
+
+class Trajectory:
+    """
+    Read access to a trajectory file. Frames are memory mapped, so random
+    access and iteration only read the frames that are used.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            self.N, self.dtype, self.coords, self.data_offset = _read_header(f)
+        frame_dtype = _frame_dtype(self.N, self.dtype)
+        nframes = (os.path.getsize(file_name) - self.data_offset) // \
+            frame_dtype.itemsize
+        if nframes > 0:
+            self.frames = numpy.memmap(file_name, dtype=frame_dtype, mode='r',
+                                       offset=self.data_offset,
+                                       shape=(nframes,))
+        else:
+            self.frames = numpy.zeros(0, dtype=frame_dtype)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, i):
+        """
+        time, wf of frame i (a slice gives arrays of times and wave
+        functions).
+        """
+        frame = self.frames[i]
+        return frame['time'], frame['wf']
+
+    @property
+    def times(self):
+        """
+        Times of all frames.
+        """
+        return self.frames['time']
+
+    def iterate(self, start=0, stop=None, step=1):
+        """
+        Lazy iteration over (time, wf) of the frames start:stop:step.
+        """
+        for i in range(*slice(start, stop, step).indices(len(self))):
+            yield self[i]
+
+    def __iter__(self):
+        return self.iterate()
+
+# end class Trajectory
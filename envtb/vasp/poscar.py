@@ -22,7 +22,7 @@ class PoscarData:
     def __read_file(self,filename):
         dataraw=general.read_file_as_table(filename)
         latticeconstant=float(dataraw[1][0])
-        data=np.array(dataraw[2:5]).astype(np.float)
+        data=np.array(dataraw[2:5]).astype(float)
         
         self.lattice_vectors=LatticeVectors(data,latticeconstant)
     
@@ -59,7 +59,7 @@ class LatticeVectors:
         Returns the reciprocal lattice vectors.
         """
         latticevecs=self.__latticevecs
-        if self.__reciprocal_latticevecs==[]:
+        if len(self.__reciprocal_latticevecs)==0:
             reciprocal_latticevecs=np.array([np.cross(latticevecs[1], latticevecs[2]),
                                                np.cross(latticevecs[2], latticevecs[0]),
                                                np.cross(latticevecs[0], latticevecs[1])
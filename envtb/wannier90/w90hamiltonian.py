@@ -6,7 +6,6 @@ Spuren hinterlassen
 from envtb import general
 import numpy
 import math
-import cmath
 from envtb.vasp import poscar
 from scipy import linalg
 try:
@@ -18,12 +17,20 @@ except:
     pass
 import itertools
 from scipy import sparse
+import scipy.sparse.linalg
 
 import glob
 import os.path
+import warnings
+import hashlib
+import tempfile
+import zipfile
 import numpy.linalg
 import re
 import envtb.quantumcapacitance.utilities as utilities
+import envtb.utility.sharedarray as sharedarray
+import envtb.utility.eigencache as eigencache
+from concurrent.futures import ProcessPoolExecutor
 #from mayavi import mlab
 try:
     import envtb.utility.fourier
@@ -122,23 +129,40 @@ class Hamiltonian:
         return list(self.__orbitalpositions) 
         
     @classmethod
-    def from_file(cls,wannier90filename,poscarfilename,wannier90woutfilename,outcarfilename):
+    def from_file(cls,wannier90filename,poscarfilename,wannier90woutfilename,outcarfilename,cache=True):
         """
         A constructor to create an object based on data from files.
         wannier90filename: Path to the wannier90_hr.dat file
         poscarfilename: Path to the VASP POSCAR file
         wannier90woutfilename: Path to the wannier90.wout file
         outcarfilename: Path to the VASP OUTCAR file
+        cache: The parsed Hamiltonian is stored in a binary cache file (see
+        save_binary()), keyed by path, size and modification time of the input
+        files. If the input files are unchanged, the Hamiltonian is loaded
+        from the cache instead of parsing the files again.
+        True (default): the cache directory is .envtb_cache next to wannier90filename.
+        A string: path of the cache directory.
+        None/False: don't use the cache.
         """        
         self = cls()
         
+        if cache:
+            cachefilename=self.__cache_filename(cache,wannier90filename,
+                [wannier90filename,poscarfilename,wannier90woutfilename,outcarfilename])
+            cached=self.__read_cache(cachefilename)
+            if cached is not None:
+                return cached
+        
         poscardata = poscar.PoscarData(poscarfilename)
         self.__latticevecs=poscardata.lattice_vectors
-        self.__nrbands,wanndata = self.__read_wannier90_hr_file(wannier90filename)
-        self.__unitcellmatrixblocks, self.__unitcellnumbers = self.__process_wannier90_hr_data(wanndata)
+        self.__nrbands,degeneracies,wanndata = self.__read_wannier90_hr_file(wannier90filename)
+        self.__unitcellmatrixblocks, self.__unitcellnumbers = self.__process_wannier90_hr_data(wanndata,degeneracies)
         self.__orbitalspreads,self.__orbitalpositions=self.__orbital_spreads_and_positions(wannier90woutfilename)
         self.__fermi_energy=self.__get_fermi_energy_from_outcar(outcarfilename)
         
+        if cache:
+            self.__write_cache(cachefilename)
+        
         return self
     
     @classmethod
@@ -164,16 +188,24 @@ class Hamiltonian:
         return self
         
     @classmethod        
-    def from_nth_nn_list(cls,nnfile,customhopping=None):
+    def from_nth_nn_list(cls,nnfile,customhopping=None,cache=True):
         """
         A constructor to create a nth-nearest-neighbour Hamiltonian.
         
         nnfile: File containing the system information (see example data)
         customhopping: Dictionary, containing hopping parameters overriding those in nnfile.
                        Example: {0:ONSITE,1:1STNN,2:2NDNN}
+        cache: Use a binary cache file (default), see from_file().
         """
         self = cls()
         
+        if cache:
+            customhoppingkey=None if customhopping is None else sorted(customhopping.items())
+            cachefilename=self.__cache_filename(cache,nnfile,[nnfile],customhoppingkey)
+            cached=self.__read_cache(cachefilename)
+            if cached is not None:
+                return cached
+        
         latticevecs,nndata,orbitalspreads,orbitalpositions,defaulthopping=self.__read_nth_nn_file(nnfile)    
         
         if customhopping==None:
@@ -199,8 +231,125 @@ class Hamiltonian:
         self.__orbitalspreads=orbitalspreads
         self.__orbitalpositions=orbitalpositions
         
+        if cache:
+            self.__write_cache(cachefilename)
+        
+        return self
+    
+    @classmethod
+    def from_binary_file(cls,filename):
+        """
+        A constructor to load a Hamiltonian saved with save_binary().
+        
+        filename: Path to the binary file.
+        """
+        self = cls()
+        
+        with numpy.load(filename) as data:
+            nrbands=int(data['nrbands'])
+            shape=(nrbands,nrbands)
+            blockstarts=numpy.concatenate([[0],numpy.cumsum(data['nnz'])])
+            self.__unitcellmatrixblocks=[sparse.csr_matrix((data['data'][start:end],data['indices'][start:end],indptr),shape=shape)
+                                         for start,end,indptr in zip(blockstarts[:-1],blockstarts[1:],data['indptr'])]
+            self.__unitcellnumbers=data['unitcellnumbers'].tolist()
+            self.__latticevecs=poscar.LatticeVectors(data['latticevecs'])
+            self.__nrbands=nrbands
+            self.__orbitalspreads=data['orbitalspreads'].tolist()
+            self.__orbitalpositions=data['orbitalpositions'].tolist()
+            if data['has_fermi_energy']:
+                self.__fermi_energy=float(data['fermi_energy'])
+        
         return self
     
+    def save_binary(self,filename):
+        """
+        Save the Hamiltonian (hopping blocks, unit cell numbers, lattice vectors, 
+        orbital positions and spreads, Fermi energy) to a binary file, which
+        can be loaded with from_binary_file(). The file is a NumPy .npz archive.
+        
+        filename: Path to the binary file. Can also be an open file object.
+        """
+        blocks=[sparse.csr_matrix(block) for block in self.__unitcellmatrixblocks]
+        for block in blocks:
+            block.sort_indices()
+        
+        numpy.savez(filename,
+                    nrbands=self.__nrbands,
+                    data=numpy.concatenate([block.data for block in blocks]).astype(complex),
+                    indices=numpy.concatenate([block.indices for block in blocks]),
+                    indptr=numpy.array([block.indptr for block in blocks]),
+                    nnz=numpy.array([len(block.data) for block in blocks]),
+                    unitcellnumbers=numpy.array(self.__unitcellnumbers,dtype=int).reshape(-1,3),
+                    latticevecs=self.__latticevecs.latticevecs(),
+                    orbitalspreads=numpy.array(self.__orbitalspreads,dtype=float),
+                    orbitalpositions=numpy.array(self.__orbitalpositions,dtype=float),
+                    has_fermi_energy=self.__fermi_energy is not None,
+                    fermi_energy=numpy.nan if self.__fermi_energy is None else self.__fermi_energy)
+    
+    def fingerprint(self):
+        """
+        Hash of the content of the Hamiltonian (hopping blocks, unit cell numbers,
+        lattice vectors, orbital positions). Hamiltonians with the same content
+        have the same fingerprint, see envtb.utility.eigencache. The blocks
+        are hashed as complex matrices, so a Hamiltonian loaded from the
+        binary cache has the same fingerprint as the parsed one.
+        """
+        return eigencache.digest(numpy.array(self.__unitcellnumbers,dtype=int).reshape(-1,3),
+                                 numpy.array(self.__latticevecs.latticevecs(),dtype=float),
+                                 numpy.array(self.__orbitalpositions,dtype=float),
+                                 *[sparse.csr_matrix(block,dtype=complex) for block in self.__unitcellmatrixblocks])
+    
+    def __cache_filename(self,cache,mainfilename,inputfilenames,extra=None):
+        """
+        Path of the cache file for a set of input files. The file name contains
+        a hash of the path, size and modification time of the input files and
+        of extra (e.g. additional constructor arguments). The files are not
+        read, so a cache hit costs a few stat() calls.
+        
+        cache: True (directory .envtb_cache next to mainfilename) or a directory.
+        """
+        if cache is True:
+            cachedir=os.path.join(os.path.dirname(os.path.abspath(mainfilename)),'.envtb_cache')
+        else:
+            cachedir=cache
+        
+        key=hashlib.sha1(('envtb-w90-1 '+repr(extra)).encode())
+        for filename in inputfilenames:
+            filestat=os.stat(filename)
+            key.update(('%s %d %d\n'%(os.path.abspath(filename),filestat.st_size,
+                                       filestat.st_mtime_ns)).encode())
+        
+        return os.path.join(cachedir,'w90ham_'+key.hexdigest()+'.npz')
+    
+    def __read_cache(self,cachefilename):
+        """
+        Load a Hamiltonian from a cache file. Returns None if the file does not
+        exist or is unreadable.
+        """
+        if not os.path.isfile(cachefilename):
+            return None
+        try:
+            return self.from_binary_file(cachefilename)
+        except (OSError,ValueError,KeyError,zipfile.BadZipFile):
+            return None
+    
+    def __write_cache(self,cachefilename):
+        """
+        Write the Hamiltonian to a cache file. The file is written under a 
+        temporary name and then renamed, so that processes starting at the
+        same time never read a partially written file. If the cache directory
+        is not writable, nothing happens.
+        """
+        cachedir=os.path.dirname(cachefilename)
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir,exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=cachedir,suffix='.tmp',delete=False) as f:
+                self.save_binary(f)
+            os.replace(f.name,cachefilename)
+        except OSError:
+            pass
+    
     def __get_fermi_energy_from_outcar(self,outcarfilename):
         f = open(outcarfilename, 'r')
         lines = f.readlines()
@@ -248,10 +397,10 @@ class Hamiltonian:
                 
         return unitcellmatrixblocks,unitcellnumbers
         
-    def __process_wannier90_hr_data(self, wanndata):
+    def __process_wannier90_hr_data(self, wanndata, degeneracies):
         """
-        Reads hopping matrix elements from wanndata into object. wanndata is a list
-        of lines, each line being a list in the following format:
+        Reads hopping matrix elements from wanndata into object. wanndata is an
+        array with one row per line of the wannier90_hr.dat file, in the following format:
         veca vecb vecc thisorb otherorb re im
         
         veca,vecb,vecc: Unit cell coordinates of other cell
@@ -262,44 +411,166 @@ class Hamiltonian:
         Hopping matrix elements have to be sorted by unit cell coordinates (veca,vecb,vecc).
         Then, they have to be sorted by thisorb and otherorb, with thisorb running faster
         than otherorb.
+        
+        degeneracies: degeneracy of each unit cell (from the header of the file). The
+        matrix elements of each cell are divided by its degeneracy, like wannier90 does
+        when it interpolates the bandstructure.
         """
-        prevcell = []
-        unitcells = []
-        for line in wanndata:
-            currentcell = line[0:3]
-            if currentcell != prevcell:
-                unitcells.append([])
-            unitcells[-1].append(line)
-            prevcell = currentcell
+        nrbands=self.__nrbands
+        nrcells=len(wanndata)//nrbands**2
+        
+        if nrcells*nrbands**2 != len(wanndata) or nrcells != len(degeneracies):
+            raise ValueError('Number of matrix elements does not match the header of the wannier90_hr.dat file')
+        
+        wanndata=wanndata.reshape(nrcells,nrbands**2,7)
+        cells=numpy.rint(wanndata[:,:,0:3]).astype(int)
+        if (cells!=cells[:,:1,:]).any():
+            raise ValueError('Matrix elements in the wannier90_hr.dat file are not sorted by unit cell')
+        unitcellnumbers = cells[:,0,:].tolist()
+        
+        elements=(wanndata[:,:,5]+1j*wanndata[:,:,6])/degeneracies[:,numpy.newaxis]
+        #Transpose because first index in wannier90_hr.dat file runs faster than second
+        elements=elements.reshape(nrcells,nrbands,nrbands).transpose(0,2,1)
+        
+        #The nonzero elements come sorted by cell, row and column, so the
+        #CSR arrays of each block are contiguous slices
+        cellnrs,rows,cols=numpy.nonzero(elements)
+        data=elements[cellnrs,rows,cols]
+        cellstarts=numpy.searchsorted(cellnrs,numpy.arange(nrcells+1))
         
-        unitcellnumbers = [[int(x) for x in unitcell[0][0:3]] for unitcell in unitcells]
         unitcellmatrixblocks = []
-        for unitcell in unitcells:
-            elementlist = numpy.array([complex(float(line[5]), float(line[6])) for line in unitcell]) 
-            unitcellmatrixblocks.append(sparse.lil_matrix(numpy.transpose(elementlist.reshape((self.__nrbands, self.__nrbands))))) #Transpose because first index in wannier90_hr.dat file runs faster than second
-            #automatically disregards small entries - threshold unknown to me :)
+        for start,end in zip(cellstarts[:-1],cellstarts[1:]):
+            indptr=numpy.searchsorted(rows[start:end],numpy.arange(nrbands+1))
+            unitcellmatrixblocks.append(sparse.csr_matrix((data[start:end],cols[start:end],indptr),shape=(nrbands,nrbands)))
         
         return unitcellmatrixblocks, unitcellnumbers
 
     def __read_wannier90_hr_file(self,filename):
-        data=general.read_file_as_table(filename)
+        """
+        Reads a wannier90_hr.dat file. The header is read line by line,
+        the numeric section in bulk into a NumPy array.
         
-        nrbands=int(data[1][0])
-        linestart=int(math.ceil(float(data[2][0])/15))+3
-        wanndata=data[linestart:]
+        Return:
+        nrbands,degeneracies,wanndata
+        
+        degeneracies: array with the degeneracy of each unit cell
+        wanndata: array with one row per matrix element (see __process_wannier90_hr_data)
+        """
+        with open(filename,'rb') as f:
+            f.readline() #comment line
+            nrbands=int(f.readline())
+            nrcells=int(f.readline())
+            degeneracies=[]
+            while len(degeneracies)<nrcells:
+                degeneracies.extend(int(x) for x in f.readline().split())
+            wanndata=numpy.fromfile(f,dtype=float,sep=' ')
         
-        return nrbands,wanndata
-        #scipy.linalg.blas.fblas.zaxpy
+        return nrbands,numpy.array(degeneracies),wanndata.reshape(-1,7)
         
     def __bloch_phases(self,k):
         """
         Calculates the bloch factor e^ikr for each unit cell in
-        self.__unitcellnumbers
+        self.__unitcellnumbers.
+        
+        k: a kpoint or an array of kpoints (cartesian coordinates). For an
+        array of kpoints, all phases are calculated in one matrix product and
+        the result has the shape (nr of kpoints, nr of unit cells).
         """
         #TODO: if k is direct: lattice vectors are probably not necessary. How could that work?
-        latticevecs_transposed=numpy.transpose(self.__latticevecs.latticevecs())
-        return numpy.array([cmath.exp(complex(0,1)*numpy.dot(k, \
-        numpy.dot(latticevecs_transposed,cellnumber))) for cellnumber in self.__unitcellnumbers])
+        cellvectors=numpy.dot(numpy.array(self.__unitcellnumbers),self.__latticevecs.latticevecs())
+        return numpy.exp(1j*numpy.dot(k,numpy.transpose(cellvectors)))
+    
+    def __kpoints_to_cartesian(self,kpoints,basis):
+        """
+        Converts an array of kpoints to cartesian reciprocal coordinates.
+        
+        basis: 'c' or 'd', the basis the kpoints are given in.
+        """
+        kpoints=numpy.array(kpoints,dtype=float)
+        if basis=='d':
+            kpoints=numpy.dot(kpoints,self.__latticevecs.reciprocal_latticevecs())
+        return kpoints
+    
+    def stacked_dense_blocks(self,usedhoppingcells='all'):
+        """
+        Returns the hopping matrix blocks as one dense array of the shape
+        (nr of unit cells, nr of orbitals, nr of orbitals), in the order
+        of unitcellnumbers(). This is the data bloch_matrices() works on;
+        if you calculate many Bloch matrices, create it once and pass it
+        as dense_blocks.
+        
+        usedhoppingcells: If you don't want to use all hopping parameters,
+        you can set them here. The blocks of the unused cells are zero.
+        """
+        blocks=numpy.zeros((len(self.__unitcellnumbers),self.__nrbands,self.__nrbands),dtype=complex)
+        
+        for i in self.__usedunitcellnrs(usedhoppingcells):
+            blocks[i]=self.__unitcellmatrixblocks[i].toarray()
+        
+        return blocks
+    
+    def bloch_matrices(self,kpoints,basis='c',usedhoppingcells='all',dense_blocks=None):
+        """
+        Calculates the Bloch matrices H(k)=sum_R e^ikR H_R for a list of kpoints
+        at once. The phase factors of all kpoints are calculated in one matrix
+        product and the matrices are summed up with one tensordot.
+        
+        kpoints: list of kpoints.
+        basis: 'c' or 'd'. Determines if the kpoints are given in cartesian
+        reciprocal coordinates or direct reciprocal coordinates.
+        usedhoppingcells: see bloch_eigenvalues().
+        dense_blocks: the result of stacked_dense_blocks(usedhoppingcells). If
+        None, it is created.
+        
+        Return:
+        Array of the shape (nr of kpoints, nr of orbitals, nr of orbitals).
+        """
+        
+        if dense_blocks is None:
+            dense_blocks=self.stacked_dense_blocks(usedhoppingcells)
+        
+        bloch_phases=self.__bloch_phases(self.__kpoints_to_cartesian(kpoints,basis))
+        
+        if usedhoppingcells != 'all':
+            usedunitcellnrs=self.__usedunitcellnrs(usedhoppingcells)
+            bloch_phases=bloch_phases[:,usedunitcellnrs]
+            dense_blocks=dense_blocks[usedunitcellnrs]
+        
+        return numpy.tensordot(bloch_phases,dense_blocks,axes=(1,0))
+    
+    def sparse_bloch_solver(self,usedhoppingcells='all',**kwargs):
+        """
+        Creates a SparseBlochSolver, which calculates a few eigenvalues of the
+        Bloch matrices near a target energy without dense matrices. Use it for
+        big supercells, e.g.
+        >>> solver=ham.sparse_bloch_solver(nrbands=10,sigma=ham.fermi_energy())
+        >>> evals=solver.eigenvalues(k)
+        
+        usedhoppingcells: see bloch_eigenvalues().
+        kwargs: nrbands, sigma, method, tol, maxiter, warm_start. See SparseBlochSolver.
+        """
+        usedunitcellnrs=self.__usedunitcellnrs(usedhoppingcells)
+        cellvectors=numpy.dot(numpy.array(self.__unitcellnumbers)[usedunitcellnrs],self.__latticevecs.latticevecs())
+        return SparseBlochSolver([self.__unitcellmatrixblocks[i] for i in usedunitcellnrs],cellvectors,**kwargs)
+    
+    def __usedunitcellnrs(self,usedhoppingcells):
+        """
+        Converts usedhoppingcells ('all' or a list of unit cell coordinates)
+        to the indices of the used cells.
+        """
+        if usedhoppingcells == 'all':
+            return list(range(len(self.__unitcellnumbers)))
+        else:
+            return self.__unitcellcoordinates_to_nrs(usedhoppingcells)
+    
+    def __batchsize(self,batchsize):
+        """
+        Number of kpoints whose Bloch matrices are diagonalized together.
+        By default, a batch takes about 64 MB.
+        """
+        if batchsize is None:
+            batchsize=2**26//(16*self.__nrbands**2)
+        return max(1,int(batchsize))
         
     def __unitcellcoordinates_to_nrs(self,usedhoppingcells):
         """
@@ -404,13 +675,14 @@ class Hamiltonian:
         
         output.close()    
     
-    def maincell_eigenvalues(self,solver='dense',return_evecs=False,**kwargs):
+    def maincell_eigenvalues(self,solver='dense',return_evecs=False,hermitian=True,energy_window=None,band_range=None,**kwargs):
         """
         Calculates the eigenvalues of the main cell (no hopping to adjacent unit cells).
         
         solver: eigenvalue solver. There are:
-            'dense': Assuming a dense matrix; returns all eigenvalues. Uses
-            scipy.linalg.eig. E.g.
+            'dense': Assuming a dense matrix; returns all eigenvalues (or those
+            selected by energy_window or band_range). Uses scipy.linalg.eigh, or
+            scipy.linalg.eig if hermitian=False. E.g.
             >>> evals=ham.maincell_eigenvalues()
             'scipy_arpack': find a given number of eigenvalues and eigenvectors of
             a BIG, SPARSE matrix (including shift-invert). It can never give you
@@ -421,6 +693,8 @@ class Hamiltonian:
             for the available parameters. You will probably need k,sigma, and maybe nvc, which.
             Consider using which='SM' if E_F=0.
         return_evecs: Also return eigenvectors.
+        hermitian, energy_window, band_range: see bloch_eigenvalues(). Only
+        used by the 'dense' solver.
         """
         
         #XXX: Make solver an abstract class
@@ -439,16 +713,41 @@ class Hamiltonian:
             evals,evecs=sparse.linalg.eigsh(blochmatrix,**kwargs)
             #return numpy.sort(evals.real)
         elif solver=='dense':
-            evals,evecs=linalg.eig(blochmatrix.todense())
-            #return numpy.sort(evals.real)
+            return self.__dense_eigensolver(blochmatrix.toarray(),return_evecs,hermitian,energy_window,band_range)
         else:
             raise ValueError('Supplied solver not found')
         
-        if return_evecs:
-            evals_ordering=self.__sorting_order(evals)
-            return numpy.array(self.__apply_order(evals,evals_ordering)), numpy.array(self.__apply_order(evecs,evals_ordering))
-        else:
-            return numpy.sort(evals.real)
+        return numpy.sort(evals.real)
+        
+    def __dense_eigensolver(self,matrix,return_evecs=False,hermitian=True,energy_window=None,band_range=None):
+        """
+        Solves the eigenvalue problem of a dense matrix.
+        
+        If hermitian is True, scipy.linalg.eigh is used, optionally restricted to
+        the eigenvalues in energy_window=(emin,emax] or with indices in
+        band_range=(first,last) (both inclusive). If no eigenvectors are
+        requested, they are never calculated.
+        If hermitian is False, the general solver scipy.linalg.eig is used.
+        
+        Return:
+        evals (sorted), or evals,evecs if return_evecs is True.
+        """
+        
+        if not hermitian:
+            if energy_window is not None or band_range is not None:
+                raise ValueError('energy_window and band_range need hermitian=True')
+            evals,evecs=linalg.eig(matrix)
+            if return_evecs:
+                evals_ordering=self.__sorting_order(evals)
+                return numpy.array(self.__apply_order(evals,evals_ordering)), numpy.array(self.__apply_order(evecs,evals_ordering))
+            else:
+                return numpy.sort(evals.real)
+        
+        if energy_window is not None and band_range is not None:
+            raise ValueError('Supply either energy_window or band_range, not both')
+        
+        return linalg.eigh(matrix,eigvals_only=not return_evecs,
+                           subset_by_value=energy_window,subset_by_index=band_range)
         
     def maincell_hamiltonian_matrix(self):  
         """
@@ -459,7 +758,8 @@ class Hamiltonian:
                    
         return self.__unitcellmatrixblocks[self.__unitcellcoordinates_to_nrs([[0,0,0]])[0]]
     
-    def bloch_eigenvalues(self,k,basis='c',usedhoppingcells='all',return_evecs=False, dense_blocks=None):
+    def bloch_eigenvalues(self,k,basis='c',usedhoppingcells='all',return_evecs=False, dense_blocks=None,
+                          hermitian=True,energy_window=None,band_range=None,solver='dense',**kwargs):
         """
         Calculates the eigenvalues of the eigenvalue problem with
         Bloch boundary conditions for a given vector k.
@@ -474,41 +774,35 @@ class Hamiltonian:
         reciprocal coordinates or direct reciprocal coordinates.
         return_evecs: If True, evecs are also returned as the second return value.
         dense_blocks: if the function is invoked many times, supply the dense matrix blocks to increase
-        speed. Create them with dense_blocks=[block.toarray() for block in self.__unitcellmatrixblocks].
-        
-        """
-        
-        if usedhoppingcells == 'all':
-            usedunitcellnrs=list(range(len(self.__unitcellnumbers)))
-        else:
-            usedunitcellnrs=self.__unitcellcoordinates_to_nrs(usedhoppingcells)
-        
-        if basis=='d':
-            k=self.__latticevecs.direct_to_cartesian_reciprocal(k)
-            
-        orbitalnrs=list(range(self.__nrbands))
-        
-        bloch_phases=self.__bloch_phases(k)
-        #I think this needs lil_matrix, coo_matrix didn't work.
-        #blochmatrix = sparse.lil_matrix((len(orbitalnrs), len(orbitalnrs)), dtype=complex)
-        blochmatrix = numpy.zeros((len(orbitalnrs), len(orbitalnrs)), dtype=complex)
-        #print 'bloch_phases', bloch_phases
-        if dense_blocks is None:
-            for i in usedunitcellnrs:
-                blochmatrix += bloch_phases[i] * self.__unitcellmatrixblocks[i]
-        else:
-            for i in usedunitcellnrs:
-                blochmatrix += bloch_phases[i] * dense_blocks[i]
-
-        #print 'dense_blocks', dense_blocks, bloch_phases
-        #print blochmatrix.shape, blochmatrix
-        evals,evecs=linalg.eig(blochmatrix)
-        
-        if return_evecs==True:
-            evals_ordering=self.__sorting_order(evals)
-            return numpy.array(self.__apply_order(evals,evals_ordering)), numpy.array(self.__apply_order(evecs,evals_ordering))
-        else:
-            return numpy.sort(evals.real)
+        speed. Create them with dense_blocks=ham.stacked_dense_blocks(usedhoppingcells). To
+        calculate many kpoints, bandstructure_data() is much faster.
+        hermitian: If True (default), the Hermitian solver scipy.linalg.eigh is used and
+        the eigenvectors are returned in the columns, ordered like the eigenvalues.
+        If False, the general solver scipy.linalg.eig is used (as in earlier versions).
+        energy_window: (emin,emax). Only the eigenvalues emin < E <= emax are
+        calculated, e.g. energy_window=(ham.fermi_energy()-1,ham.fermi_energy()+1).
+        Needs hermitian=True.
+        band_range: (first,last). Only the eigenvalues with the indices first...last
+        (both inclusive, counted from the lowest eigenvalue) are calculated. Needs
+        hermitian=True.
+        solver: 'dense' (default) or 'sparse'. The sparse solver only calculates the
+        eigenvalues closest to a target energy, see sparse_bloch_solver() for the
+        parameters (kwargs). You can also supply a SparseBlochSolver, which is reused
+        (and warm-started with the eigenvectors of its previous kpoint).
+        
+        """
+        
+        if solver!='dense':
+            if not isinstance(solver,SparseBlochSolver):
+                solver=self.sparse_bloch_solver(usedhoppingcells,**kwargs)
+            return solver.eigenvalues(self.__kpoints_to_cartesian(k,basis),return_evecs==True)
+        
+        if isinstance(dense_blocks,list):
+            dense_blocks=numpy.array(dense_blocks)
+        
+        blochmatrix=self.bloch_matrices([k],basis,usedhoppingcells,dense_blocks)[0]
+        
+        return self.__dense_eigensolver(blochmatrix,return_evecs==True,hermitian,energy_window,band_range)
             
     def create_orbital_vector_list(self,vector,include_third_dimension=False,include_spread=False):
         """
@@ -558,7 +852,8 @@ class Hamiltonian:
         
         self.plot_vector(10*numpy.ones(len(self.__orbitalpositions)))
     
-    def bandstructure_data(self,kpoints,basis='c',usedhoppingcells='all'):
+    def bandstructure_data(self,kpoints,basis='c',usedhoppingcells='all',batchsize=None,
+                           hermitian=True,energy_window=None,band_range=None,solver='dense',nprocs=1,cache=None,**kwargs):
         """
         Calculates the bandstructure for a given kpoint list.
         For direct plotting, use plot_bandstructure(kpoints,filename).
@@ -572,10 +867,29 @@ class Hamiltonian:
         strip the list from unwanted cells).        
         basis: 'c' or 'd'. Determines if the kpoints are given in cartesian
         reciprocal coordinates or direct reciprocal coordinates.
+        batchsize: number of kpoints whose Bloch matrices are built and
+        diagonalized together. Default is None, which means that one batch
+        takes about 64 MB of memory.
+        hermitian, energy_window, band_range: see bloch_eigenvalues().
+        solver: 'dense' (default) or 'sparse'. The sparse solver calculates the
+        eigenvalues closest to a target energy for big supercells. The kpoints
+        are solved in path order, each one starting from the eigenvectors of the
+        previous kpoint. The parameters (nrbands, sigma, method...) are given as
+        kwargs, see sparse_bloch_solver().
+        nprocs: number of worker processes for the dense solver. Default is 1 (no
+        worker processes). If None, all CPUs are used. The kpoints are distributed
+        in ordered chunks; the hopping blocks are shared with the workers through
+        shared memory. Works without MPI, but can also be combined with it.
+        cache: None (default, no cache), True (directory .envtb_cache) or a directory.
+        The eigenvalues are stored under the fingerprint() of the Hamiltonian and
+        the kpoints and parameters, and are read instead of calculated the next
+        time. Not used with MPI, energy_window or a SparseBlochSolver instance.
 
         Return:
         A list of eigenvalues for each kpoint is returned. To sort 
         by band, use data.transpose().
+        If energy_window is used, the number of eigenvalues can be different
+        for each kpoint and a list of arrays is returned instead.
 
         If MPI is used, ONLY THE ROOT PROCESS returns the data, the others
         return None.
@@ -585,6 +899,16 @@ class Hamiltonian:
             kpoints=self.standard_paths(kpoints)[2]
             basis='d'
 
+        if cache and not self.mpi_comm and energy_window is None and isinstance(solver,str):
+            def solve():
+                return self.bandstructure_data(kpoints,basis,usedhoppingcells,batchsize,hermitian,
+                                               energy_window,band_range,solver,nprocs,**kwargs),None
+            return eigencache.cached_eigenpairs(self.fingerprint(),solve,cache,kind='bandstructure',
+                                                kpoints=numpy.asarray(kpoints,dtype=float),basis=basis,
+                                                usedhoppingcells=usedhoppingcells,hermitian=hermitian,
+                                                band_range=band_range,solver=solver,
+                                                kwargs=sorted(kwargs.items()))[0]
+
         if self.mpi_comm:
             if self.mpi_rank == 0:
                 path_parts = numpy.array_split(kpoints,self.mpi_size)
@@ -595,16 +919,44 @@ class Hamiltonian:
         else:
             path=kpoints
 
-        dense_blocks=[block.toarray() for block in self.__unitcellmatrixblocks]
-
-        data=numpy.array([self.bloch_eigenvalues(kpoint,basis,usedhoppingcells,dense_blocks=dense_blocks)
-                          for kpoint in path])
+        data=[]
+        if solver!='dense':
+            if energy_window is not None or band_range is not None:
+                raise ValueError('energy_window and band_range are not supported by the sparse solver')
+            if nprocs!=1:
+                raise ValueError('The sparse solver works through the kpoints in order, use nprocs=1')
+            if not isinstance(solver,SparseBlochSolver):
+                solver=self.sparse_bloch_solver(usedhoppingcells,**kwargs)
+            for k in self.__kpoints_to_cartesian(path,basis).reshape(len(path),-1):
+                data.append(solver.eigenvalues(k))
+        else:
+            if energy_window is not None and band_range is not None:
+                raise ValueError('Supply either energy_window or band_range, not both')
+            if not hermitian and (energy_window is not None or band_range is not None):
+                raise ValueError('energy_window and band_range need hermitian=True')
+            
+            options=dict(hermitian=hermitian,energy_window=energy_window,band_range=band_range)
+            batchsize=self.__batchsize(batchsize)
+            
+            if nprocs==1:
+                dense_blocks=self.stacked_dense_blocks(usedhoppingcells)
+                for start in range(0,len(path),batchsize):
+                    blochmatrices=self.bloch_matrices(path[start:start+batchsize],basis,usedhoppingcells,dense_blocks)
+                    data.extend(_stacked_bloch_eigenvalues(blochmatrices,**options))
+            elif len(path)>0:
+                data.extend(self.__bandstructure_data_pool(self.__kpoints_to_cartesian(path,basis).reshape(len(path),-1),
+                                                           usedhoppingcells,batchsize,nprocs,options))
+
+        if energy_window is None:
+            data=numpy.array(data).reshape(len(path),-1)
 
         if self.mpi_comm:
             allbsdata=None
             allbsdata=self.mpi_comm.gather(data,root=0)
         
             if self.mpi_rank==0:
+                if energy_window is not None:
+                    return [evals for part in allbsdata for evals in part]
                 return numpy.concatenate(allbsdata)
 #        allbsdata=numpy.empty((len(kpoints),self.__nrbands))
 #        comm.Allgather([data,MPI.DOUBLE],[allbsdata,MPI.DOUBLE])
@@ -613,6 +965,28 @@ class Hamiltonian:
         else:
             return data
     
+    def __bandstructure_data_pool(self,kpoints,usedhoppingcells,batchsize,nprocs,options):
+        """
+        Calculates the eigenvalues for the cartesian kpoints in a process pool. The
+        dense hopping blocks are put into shared memory once, the workers only
+        receive chunks of kpoints. The results are returned in the order of kpoints.
+        """
+        if nprocs is None:
+            nprocs=os.cpu_count() or 1
+        #at least a few chunks per worker, so that the load is balanced
+        chunksize=max(1,min(batchsize,-(-len(kpoints)//(4*nprocs))))
+        chunks=[kpoints[start:start+chunksize] for start in range(0,len(kpoints),chunksize)]
+        
+        usedunitcellnrs=self.__usedunitcellnrs(usedhoppingcells)
+        cellvectors=numpy.dot(numpy.array(self.__unitcellnumbers)[usedunitcellnrs],self.__latticevecs.latticevecs())
+        blocks=numpy.array([self.__unitcellmatrixblocks[i].toarray() for i in usedunitcellnrs],dtype=complex)
+        
+        with sharedarray.SharedArray(blocks) as sharedblocks:
+            del blocks
+            with ProcessPoolExecutor(nprocs,initializer=_bandstructure_worker_init,
+                                     initargs=(sharedblocks.descriptor(),cellvectors,options)) as pool:
+                return [evals for chunkdata in pool.map(_bandstructure_worker,chunks) for evals in chunkdata]
+    
     def point_path(self,corner_points,nrpointspersegment):
         """
         Generates a path connecting the corner_points with nrpointspersegment points per segment
@@ -657,7 +1031,7 @@ class Hamiltonian:
         return numpy.transpose([numpy.linspace(v1[j], \
                 v2[j],nrpoints,endpoint=False) for j in range(dimension)]).tolist()
         
-    def plot_bandstructure(self,kpoints,filename=None,basis='c',usedhoppingcells='all',mark_reclattice_points=False,mark_fermi_energy=False,axes=None):
+    def plot_bandstructure(self,kpoints,filename=None,basis='c',usedhoppingcells='all',mark_reclattice_points=False,mark_fermi_energy=False,axes=None,nprocs=1,cache=None):
         """
         Calculate the bandstructure at the points kpoints (given in 
         cartesian reciprocal coordinates - use direct_to_cartesian_reciprocal(k)
@@ -684,6 +1058,8 @@ class Hamiltonian:
         drawn. If True, the Fermi energy will be taken from fermi_energy().
         Default is False.
         axes: axes to draw into. If None, a new plot will be created.
+        nprocs: number of worker processes, see bandstructure_data().
+        cache: eigenvalue cache, see bandstructure_data().
         
         If MPI is used, ONLY THE ROOT PROCESS plots. This coincides with bandstructure_data,
         where also only the root process returns all the bandstructure data.
@@ -697,7 +1073,7 @@ class Hamiltonian:
         lattice_point_lines: The lattice point marks Line2D object.
         """
 
-        data=self.bandstructure_data(kpoints,basis,usedhoppingcells)
+        data=self.bandstructure_data(kpoints,basis,usedhoppingcells,nprocs=nprocs,cache=cache)
 
         if axes is None:
             fig=pyplot.figure(figsize=(15,10))
@@ -1117,24 +1493,13 @@ class Hamiltonian:
 
         oldunitcellmatrixblocks=self.__unitcellmatrixblocks
         oldunitcellnumbers=self.__unitcellnumbers
-        oldorbitalpositions=numpy.array(self.__orbitalpositions,copy=False)
+        oldorbitalpositions=numpy.asarray(self.__orbitalpositions)
         oldorbitalspreads=self.__orbitalspreads #Must be List, not numpy array!
         
-        if usedhoppingcells == 'all':
-            usedunitcellnrs=list(range(len(self.__unitcellnumbers)))
-        else:
-            usedunitcellnrs=self.__unitcellcoordinates_to_nrs(usedhoppingcells)
-        
+        usedunitcellnrs=self.__usedunitcellnrs(usedhoppingcells)
         
         nr_unitcells_in_supercell=len(cellcoordinates)   
         
-        cellcoordinates_reverse_dict={}
-        for i,coord in enumerate(cellcoordinates):
-            cellcoordinates_reverse_dict[tuple(coord)]=i
-        
-        unitcellmatrixblocks_dryctr=[]
-        unitcellnumbers=[]
-        
         if usedorbitals=='all':
             orbitalnrs=list(range(self.__nrbands))
         else:
@@ -1145,51 +1510,48 @@ class Hamiltonian:
         #Set new orbital positions and spreads
         oldunitcellcoordinates=self.unitcellcoordinates(cellcoordinates)
         orbitalspreads=[oldorbitalspreads[i] for i in orbitalnrs]*nr_unitcells_in_supercell #Repeat oldorbitalspreads
-        #print oldunitcellcoordinates
-        #print oldorbitalpositions
-        orbitalpositions=[list(oldorbitalpositions[orb]+cell) for cell in oldunitcellcoordinates for orb in orbitalnrs]
+        orbitalpositions=(oldunitcellcoordinates[:,numpy.newaxis,:]+oldorbitalpositions[numpy.newaxis,orbitalnrs,:]).reshape(-1,3).tolist()
         
         metric_numerator,metric_denominator=self.__metric(latticevecs)
-        latticevecs_dot_metric_numerator=numpy.dot(latticevecs,metric_numerator)
-        #Loop over cells in supercell
-        
-        """
-        Besser: zuerst alle indizes/positionen aufstellen, dann mit sparse.bmat die matrix zusammenbauen.
-        Andere fkten auch aktualisieren!!
-        
-        ...und auch mal mixins und connections zw. bauteilen (kleben) verbessern. vl wie elektrostatik-kleben?
-        """
-        for cellnr,cell in enumerate(numpy.array(cellcoordinates)):
-            #Loop over old blocks
-            for i,oldnumber in zip(list(range(len(oldunitcellmatrixblocks))),numpy.array(oldunitcellnumbers)):
-                if i in usedunitcellnrs:                        
-                    hopto=cell+oldnumber
-                    
-                    hopto_scaled_times_metric_denominator=numpy.dot(latticevecs_dot_metric_numerator,hopto)
-                    hopto_scaled=list(hopto_scaled_times_metric_denominator/metric_denominator)
-                    hopto_rest_times_metric_denominator=hopto_scaled_times_metric_denominator%metric_denominator
-                    hopto_nr=tuple(numpy.dot(hopto_rest_times_metric_denominator,latticevecs)/metric_denominator)
-                    
-                    try:
-                        skip_block=False
-                        hopto_nr_index=cellcoordinates_reverse_dict[hopto_nr]#cellcoordinates.index(hopto_nr) 
-                    except ValueError:
-                        skip_block=True #if the cell to hop to is not in the cellcoordinates list, the block is skipped
-                        
-                    if output_maincell_only and hopto_scaled!=[0,0,0]:
-                        skip_block=True
-                    
-                    if skip_block==False:                        
-                        try:
-                            unitcellindex=unitcellnumbers.index(hopto_scaled)
-                        except ValueError:
-                            unitcellindex=len(unitcellnumbers)
-                            unitcellnumbers.append(hopto_scaled)
-                            unitcellmatrixblocks_dryctr.append([])
-                        
-                        #unitcellmatrixblocks[unitcellindex][cellnr*orbitals_per_unitcell:(cellnr+1)*orbitals_per_unitcell,
-                        #                                    hopto_nr_index*orbitals_per_unitcell:(hopto_nr_index+1)*orbitals_per_unitcell]=oldblock_selectedorbitals
-                        unitcellmatrixblocks_dryctr[unitcellindex].append([i,cellnr,hopto_nr_index])
+        latticevecs_dot_metric_numerator=numpy.rint(numpy.dot(latticevecs,metric_numerator)).astype(numpy.int64)
+        metric_denominator=int(round(metric_denominator))
+        
+        """
+        The cell-to-cell mapping is calculated for all pairs of cells in the supercell
+        and used hopping blocks at once:
+        hopto: old unit cell that is hopped to
+        hopto_scaled: new (super)cell the old cell belongs to
+        hopto_nr: position of the old cell within the new cell, looked up in cellcoordinates
+        """
+        cells=numpy.array(cellcoordinates,dtype=numpy.int64).reshape(-1,3)
+        usedunitcellnumbers=numpy.array(oldunitcellnumbers,dtype=numpy.int64).reshape(-1,3)[usedunitcellnrs]
+        
+        hopto=cells[:,numpy.newaxis,:]+usedunitcellnumbers[numpy.newaxis,:,:]
+        hopto_scaled_times_metric_denominator=numpy.dot(hopto,numpy.transpose(latticevecs_dot_metric_numerator))
+        hopto_scaled=hopto_scaled_times_metric_denominator//metric_denominator
+        hopto_rest_times_metric_denominator=hopto_scaled_times_metric_denominator%metric_denominator
+        hopto_nr=numpy.dot(hopto_rest_times_metric_denominator,numpy.array(latticevecs,dtype=numpy.int64))//metric_denominator
+        
+        #if the cell to hop to is not in the cellcoordinates list, the block is skipped
+        cellkeys,hoptokeys=self.__cell_keys(cells,hopto_nr)
+        cellkeys_order=numpy.argsort(cellkeys,kind='stable')
+        positions=numpy.minimum(numpy.searchsorted(cellkeys,hoptokeys,sorter=cellkeys_order),len(cells)-1)
+        hopto_nr_index=cellkeys_order[positions]
+        valid=cellkeys[hopto_nr_index]==hoptokeys
+        
+        if output_maincell_only:
+            valid&=(hopto_scaled==0).all(axis=2)
+        
+        #Pairs are enumerated in the order of the supercell cells, then the old blocks. The
+        #new unit cell numbers are numbered by first occurrence in that order.
+        pair_cellnrs,pair_blocks=numpy.nonzero(valid)
+        pair_hopto_nr_index=hopto_nr_index[valid]
+        uniquecells,firstoccurrence,pair_unitcellindex=numpy.unique(hopto_scaled[valid],axis=0,return_index=True,return_inverse=True)
+        occurrenceorder=numpy.argsort(firstoccurrence)
+        unitcellnumbers=uniquecells[occurrenceorder].tolist()
+        newindex=numpy.empty_like(occurrenceorder)
+        newindex[occurrenceorder]=numpy.arange(len(occurrenceorder))
+        pair_unitcellindex=newindex[numpy.ravel(pair_unitcellindex)]
         
         oldlatticevecs=self.__latticevecs.latticevecs()
         newlatticevecs=numpy.dot(numpy.array(latticevecs),oldlatticevecs) # (A.B)'=B'.A' - new latticevectors in real coordinates
@@ -1199,16 +1561,37 @@ class Hamiltonian:
             oldblocks_selectedorbitals=oldunitcellmatrixblocks
         else:
             #the conversion to csr is annoying, but necessary
-            #oldblocks_selectedorbitals=[block.tocsr()[numpy.array(orbitalnrs)[:,numpy.newaxis],numpy.array(orbitalnrs)] for block in oldunitcellmatrixblocks]
             oldblocks_selectedorbitals=[block.tocsr()[orbitalnrs,:][:,orbitalnrs] for block in oldunitcellmatrixblocks]
         
+        #Collect the COO triplets of all new blocks, then split them by new unit cell
+        rows=[]
+        cols=[]
+        values=[]
+        blockids=[]
+        for blocknr,oldblocknr in enumerate(usedunitcellnrs):
+            pairs=numpy.nonzero(pair_blocks==blocknr)[0]
+            if len(pairs)==0:
+                continue
+            oldblock=sparse.coo_matrix(oldblocks_selectedorbitals[oldblocknr])
+            rows.append((pair_cellnrs[pairs,numpy.newaxis]*orbitals_per_unitcell+oldblock.row).ravel())
+            cols.append((pair_hopto_nr_index[pairs,numpy.newaxis]*orbitals_per_unitcell+oldblock.col).ravel())
+            values.append(numpy.tile(oldblock.data,len(pairs)))
+            blockids.append(numpy.repeat(pair_unitcellindex[pairs],oldblock.nnz))
+        
+        if len(blockids)>0:
+            rows,cols,values,blockids=[numpy.concatenate(x) for x in (rows,cols,values,blockids)]
+        else:
+            rows,cols,values,blockids=[numpy.zeros(0,dtype=int)]*4
+        
+        blockorder=numpy.argsort(blockids,kind='stable')
+        blockstarts=numpy.searchsorted(blockids[blockorder],numpy.arange(len(unitcellnumbers)+1))
+        supercellsize=orbitals_per_unitcell*nr_unitcells_in_supercell
+        
         unitcellmatrixblocks_sparse=[]
-        emptyblock=sparse.coo_matrix((orbitals_per_unitcell,orbitals_per_unitcell)) #placeholder for empty blocks; coo is much faster than lil. Better understanding may lead to improvements
-        for i,cell in enumerate(unitcellmatrixblocks_dryctr):
-            unitcellmatrixblocks_sparse_template= [ [ emptyblock if i==j else None for i in range(nr_unitcells_in_supercell) ] for j in range(nr_unitcells_in_supercell) ]
-            for block,i,j in cell:
-                unitcellmatrixblocks_sparse_template[i][j]=oldblocks_selectedorbitals[block]
-            unitcellmatrixblocks_sparse.append(sparse.bmat(unitcellmatrixblocks_sparse_template))
+        for start,end in zip(blockstarts[:-1],blockstarts[1:]):
+            elements=blockorder[start:end]
+            unitcellmatrixblocks_sparse.append(sparse.csr_matrix((values[elements].astype(complex),(rows[elements],cols[elements])),
+                                                                 shape=(supercellsize,supercellsize)))
            
            
         #Mix in matrix elements from other hamiltonian
@@ -1254,23 +1637,25 @@ class Hamiltonian:
         
     
         #Apply magnetic field
-        #distances_in_unit_cell=numpy.array([[x-y for x in numpy.array(orbitalpositions)] for y in numpy.array(orbitalpositions)])
         if magnetic_B!=None:
             Tesla_conversion_factor=1.602176487/1.0545717*1e-5
             #print Tesla_conversion_factor
+            #The phases are only evaluated for the stored matrix elements of each block
+            positions=numpy.array(orbitalpositions)
             for i,number in enumerate(unitcellnumbers):
                 unitcellcoordinates=numpy.dot(number,newlatticevecs)
-                othercell_orbitalpositions=[unitcellcoordinates+orb for orb in orbitalpositions]
-                #distances=distances_in_unit_cell+unitcellcoordinates #distances[i][j]=Distance from orb i in main cell to orb j in other cell
-                #print othercell_orbitalpositions
+                block=sparse.coo_matrix(unitcellmatrixblocks_sparse[i])
+                main=positions[block.row]
+                other=positions[block.col]+unitcellcoordinates #other cell orbital positions
                 if gauge_B=='landau_x':
-                    phasematrix=numpy.exp(1j*magnetic_B*Tesla_conversion_factor*numpy.array([[-0.5*(other[0]-main[0])*(other[1]+main[1]) for other in othercell_orbitalpositions] for main in numpy.array(orbitalpositions)]))
-                if gauge_B=='landau_y':
-                    phasematrix=numpy.exp(1j*magnetic_B*Tesla_conversion_factor*numpy.array([[0.5*(other[1]-main[1])*(other[0]+main[0]) for other in othercell_orbitalpositions] for main in numpy.array(orbitalpositions)]))
-                if gauge_B=='symmetric':
-                    phasematrix=numpy.exp(1j*magnetic_B*Tesla_conversion_factor*numpy.array([[0.5*((other[1]-main[1])*(other[0]+main[0])-(other[0]-main[0])*(other[1]+main[1])) for other in othercell_orbitalpositions] for main in numpy.array(orbitalpositions)]))
-                #XXX: matrices are implicitly converted to numpy arrays. Make phasematrix a sparse matrix.
-                unitcellmatrixblocks_sparse[i]=sparse.coo_matrix(unitcellmatrixblocks_sparse[i].multiply(phasematrix))
+                    phases=-0.5*(other[:,0]-main[:,0])*(other[:,1]+main[:,1])
+                elif gauge_B=='landau_y':
+                    phases=0.5*(other[:,1]-main[:,1])*(other[:,0]+main[:,0])
+                elif gauge_B=='symmetric':
+                    phases=0.25*((other[:,1]-main[:,1])*(other[:,0]+main[:,0])-(other[:,0]-main[:,0])*(other[:,1]+main[:,1]))
+                else:
+                    raise ValueError('Unknown gauge: '+str(gauge_B))
+                unitcellmatrixblocks_sparse[i]=sparse.coo_matrix((block.data*numpy.exp(1j*magnetic_B*Tesla_conversion_factor*phases),(block.row,block.col)),shape=block.shape)
         if energyshift != None and self.__fermi_energy != None:
             newfermi_energy=self.__fermi_energy+energyshift
         else:
@@ -1281,6 +1666,20 @@ class Hamiltonian:
         return self.from_raw_data(unitcellmatrixblocks_sparse, unitcellnumbers, newlatticevecs,orbitalspreads,orbitalpositions,newfermi_energy)
         #return unitcellmatrixblocks
     
+    def __cell_keys(self,*cellarrays):
+        """
+        Encodes integer cell coordinates (arrays with 3 columns in the last axis) as
+        single integers, so that cells can be compared and searched with NumPy.
+        All arrays are encoded with the same key.
+        """
+        allcells=numpy.concatenate([cells.reshape(-1,3) for cells in cellarrays])
+        if len(allcells)==0:
+            return [cells[...,0] for cells in cellarrays]
+        cellmin=allcells.min(axis=0)
+        cellspan=allcells.max(axis=0)-cellmin+1
+        return [((cells[...,0]-cellmin[0])*cellspan[1]+(cells[...,1]-cellmin[1]))*cellspan[2]+(cells[...,2]-cellmin[2])
+                for cells in cellarrays]
+    
     def __metric(self,basis):
         """
         Calculates the metric for a given basis using the formula
@@ -1409,6 +1808,202 @@ class Hamiltonian:
     
         return [[ii,jj,kk] for ii in range(i) for jj in range(j) for kk in range(k)]
 
+def _stacked_bloch_eigenvalues(blochmatrices,hermitian=True,energy_window=None,band_range=None):
+    """
+    Eigenvalues of a stack of Bloch matrices (first axis: kpoint), see
+    Hamiltonian.bloch_eigenvalues() for the parameters.
+    
+    Return:
+    list of eigenvalue arrays, one per matrix.
+    """
+    if not hermitian:
+        return [numpy.sort(linalg.eigvals(blochmatrix).real) for blochmatrix in blochmatrices]
+    if energy_window is None and band_range is None:
+        return list(numpy.linalg.eigvalsh(blochmatrices))
+    return [linalg.eigh(blochmatrix,eigvals_only=True,subset_by_value=energy_window,subset_by_index=band_range)
+            for blochmatrix in blochmatrices]
+
+_bandstructure_worker_state={}
+
+def _bandstructure_worker_init(blocks_descriptor,cellvectors,options):
+    """
+    Initializer of the bandstructure_data worker processes: attaches the shared hopping blocks.
+    """
+    shm,blocks=sharedarray.attach(blocks_descriptor)
+    _bandstructure_worker_state.update(shm=shm,blocks=blocks,cellvectors=cellvectors,options=options)
+
+def _bandstructure_worker(kpoints):
+    """
+    Eigenvalues for a chunk of cartesian kpoints, calculated in a worker process.
+    """
+    state=_bandstructure_worker_state
+    bloch_phases=numpy.exp(1j*numpy.dot(kpoints,numpy.transpose(state['cellvectors'])))
+    blochmatrices=numpy.tensordot(bloch_phases,state['blocks'],axes=(1,0))
+    return _stacked_bloch_eigenvalues(blochmatrices,**state['options'])
+
+class SparseBlochSolver:
+    """
+    Calculates a few eigenvalues of Bloch matrices H(k)=sum_R e^ikR H_R near a
+    target energy without creating dense matrices.
+    
+    H(k) is kept as a csr_matrix with a fixed sparsity pattern (the union of
+    the patterns of all hopping blocks). For a new k, only its data is
+    recalculated: data=phase_map.e^ikR, where phase_map maps the hopping
+    blocks' elements to the elements of H(k).
+    
+    The eigenvectors of the last k are used as initial guess for the next k,
+    so solve the k-points in path order.
+    
+    Create it with Hamiltonian.sparse_bloch_solver().
+    """
+    
+    def __init__(self,unitcellmatrixblocks,cellvectors,nrbands=6,sigma=0.0,method='shift-invert',tol=0,maxiter=None,warm_start=True):
+        """
+        unitcellmatrixblocks: hopping blocks H_R (sparse matrices)
+        cellvectors: the cartesian vectors R of the blocks, one per row
+        nrbands: number of eigenvalues per kpoint
+        sigma: the eigenvalues closest to sigma are calculated. If None, the lowest
+        eigenvalues are calculated.
+        method: 'shift-invert': scipy.sparse.linalg.eigsh in shift-invert mode.
+                'lobpcg': scipy.sparse.linalg.lobpcg applied to (H-sigma)^2, followed by
+                a Rayleigh-Ritz step with H. Needs no factorization, but converges slower
+                (best for the lowest bands, sigma=None). If the eigenpairs are not
+                converged after maxiter iterations, the kpoint is solved again with
+                shift-invert.
+        tol, maxiter: passed to the eigensolver. For 'lobpcg', maxiter defaults to 200.
+        warm_start: If True, the eigenvectors of the previous kpoint are the initial guess.
+        """
+        
+        if method not in ('shift-invert','lobpcg'):
+            raise ValueError('Unknown method: '+str(method))
+        
+        self.nrbands=nrbands
+        self.sigma=sigma
+        self.method=method
+        self.tol=tol
+        self.maxiter=maxiter
+        self.warm_start=warm_start
+        self.__cellvectors=numpy.array(cellvectors,dtype=float).reshape(-1,3)
+        self.__previous_evecs=None
+        
+        blocks=[sparse.coo_matrix(block) for block in unitcellmatrixblocks]
+        n=blocks[0].shape[0]
+        rows=numpy.concatenate([block.row for block in blocks]).astype(numpy.int64)
+        cols=numpy.concatenate([block.col for block in blocks]).astype(numpy.int64)
+        data=numpy.concatenate([block.data for block in blocks]).astype(complex)
+        cellnrs=numpy.repeat(numpy.arange(len(blocks)),[block.nnz for block in blocks])
+        
+        #pattern elements are sorted by row, then column, i.e. in csr order
+        patternkeys,elementnrs=numpy.unique(rows*n+cols,return_inverse=True)
+        indptr=numpy.searchsorted(patternkeys//n,numpy.arange(n+1))
+        
+        self.__phase_map=sparse.csr_matrix((data,(numpy.ravel(elementnrs),cellnrs)),shape=(len(patternkeys),len(blocks)))
+        self.__matrix=sparse.csr_matrix((numpy.zeros(len(patternkeys),dtype=complex),patternkeys%n,indptr),shape=(n,n))
+    
+    def reset(self):
+        """
+        Forget the eigenvectors of the previous kpoint, e.g. before starting a new path.
+        """
+        self.__previous_evecs=None
+    
+    def bloch_matrix(self,k):
+        """
+        Returns the sparse Bloch matrix H(k) for the cartesian kpoint k.
+        The returned matrix is reused (and overwritten) for the next kpoint.
+        """
+        phases=numpy.exp(1j*numpy.dot(self.__cellvectors,numpy.array(k,dtype=float)))
+        self.__matrix.data[:]=self.__phase_map.dot(phases)
+        return self.__matrix
+    
+    def eigenvalues(self,k,return_evecs=False):
+        """
+        Calculates the nrbands eigenvalues closest to sigma (or the lowest ones) for the
+        cartesian kpoint k.
+        
+        Return:
+        evals (sorted), or evals,evecs if return_evecs is True (eigenvectors in the columns).
+        """
+        
+        matrix=self.bloch_matrix(k)
+        
+        if self.method=='shift-invert':
+            evals,evecs=self.__shift_invert(matrix,self.maxiter)
+        else:
+            evals,evecs=self.__lobpcg(matrix)
+        
+        order=numpy.argsort(evals)
+        evals=evals[order]
+        evecs=evecs[:,order]
+        
+        if self.warm_start:
+            self.__previous_evecs=evecs
+        
+        if return_evecs:
+            return evals,evecs
+        else:
+            return evals
+    
+    def __shift_invert(self,matrix,maxiter):
+        """
+        Eigenvalues closest to sigma using ARPACK in shift-invert mode (or the lowest
+        eigenvalues if sigma is None). eigsh only takes one starting vector, so the
+        sum of the previous eigenvectors is used. maxiter is passed to eigsh.
+        """
+        v0=None
+        if self.__previous_evecs is not None:
+            v0=self.__previous_evecs.sum(axis=1)
+        if self.sigma is None:
+            evals,evecs=sparse.linalg.eigsh(matrix,k=self.nrbands,which='SA',v0=v0,tol=self.tol,maxiter=maxiter)
+        else:
+            evals,evecs=sparse.linalg.eigsh(matrix,k=self.nrbands,sigma=self.sigma,which='LM',v0=v0,tol=self.tol,maxiter=maxiter)
+        return evals.real,evecs
+    
+    def __lobpcg(self,matrix):
+        """
+        Lowest eigenvalues using LOBPCG, or, if sigma is given, eigenvalues closest to
+        sigma by spectral folding: the lowest eigenvectors of (H-sigma)^2 span the wanted
+        eigenspace, which is then diagonalized with H. Folding squares the condition
+        number, so the convergence can be slow for sigma deep inside the spectrum.
+        
+        The convergence warnings of lobpcg are suppressed; instead the residuals
+        |H.v-E.v| of the wanted eigenpairs are checked. If one of them is above the
+        tolerance (tol, or the default tolerance of lobpcg, sqrt(1e-15)*n), shift-invert
+        is used for this kpoint (with the default number of ARPACK iterations).
+        """
+        n=matrix.shape[0]
+        if self.sigma is None:
+            operator=matrix
+        else:
+            shifted=matrix-self.sigma*sparse.identity(n,dtype=complex,format='csr')
+            operator=sparse.linalg.LinearOperator((n,n),matvec=lambda v: shifted.dot(shifted.dot(v)),
+                                                  matmat=lambda v: shifted.dot(shifted.dot(v)),dtype=complex)
+        
+        #A larger block than nrbands improves the convergence of clustered eigenvalues
+        blocksize=min(n,2*self.nrbands)
+        guess=numpy.random.RandomState(0).standard_normal((n,blocksize))+0j
+        if self.__previous_evecs is not None:
+            guess[:,:self.__previous_evecs.shape[1]]=self.__previous_evecs
+        
+        maxiter=self.maxiter if self.maxiter is not None else 200
+        tol=self.tol if self.tol else None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',UserWarning)
+            operator_evals,subspace=sparse.linalg.lobpcg(operator,guess,tol=tol,maxiter=maxiter,largest=False)
+        #only the lowest vectors are converged
+        subspace=subspace[:,numpy.argsort(operator_evals)[:self.nrbands]]
+        
+        #Rayleigh-Ritz: (H-sigma)^2 does not distinguish sigma+E and sigma-E
+        subspace,_=linalg.qr(subspace,mode='economic')
+        evals,vecs=linalg.eigh(numpy.dot(subspace.T.conj(),matrix.dot(subspace)))
+        evecs=numpy.dot(subspace,vecs)
+        
+        residuals=numpy.linalg.norm(matrix.dot(evecs)-evecs*evals,axis=0)
+        if tol is None:
+            tol=numpy.sqrt(1e-15)*n
+        if not residuals.max()<=tol:
+            return self.__shift_invert(matrix,None)
+        return evals,evecs
+
 class BandstructurePlot:
     """
     Combine several bandstructure plots.
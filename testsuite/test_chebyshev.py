@@ -0,0 +1,38 @@
+import numpy as np
+import scipy.sparse.linalg
+import envtb.ldos.hamiltonian
+from envtb.time_propagator import chebyshev
+
+hbar = 0.66 * 10**(-15)
+
+
+def graphene_and_states(nstates):
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=6, Ny=4)
+    ham.build_hamiltonian()
+    random = np.random.RandomState(0)
+    psi = random.normal(size=(ham.Ntot, nstates)) + \
+        1j * random.normal(size=(ham.Ntot, nstates))
+    return ham, psi / np.linalg.norm(psi, axis=0)
+
+
+def test_chebyshev_step_matches_expm_multiply():
+    ham, psi = graphene_and_states(2)
+    for dt in (1e-16, 5e-14):
+        expected = scipy.sparse.linalg.expm_multiply(
+            -1j * dt / hbar * ham.mtot.tocsc(), psi)
+        prop = chebyshev.ChebyshevPropagator(psi, ham, dt=dt)
+        wf, dt_out, nterms = prop.propagate()
+        assert dt_out == dt
+        assert np.allclose(wf, expected, atol=1e-8)
+        assert np.allclose(np.linalg.norm(wf, axis=0), 1., atol=1e-10)
+        single = chebyshev.ChebyshevPropagator(psi[:, 0], ham, dt=dt,
+                                               bounds=prop.bounds)
+        assert np.allclose(single.propagate()[0].wf1d, expected[:, 0],
+                           atol=1e-8)
+
+
+def test_default_bounds_enclose_spectrum():
+    ham, psi = graphene_and_states(1)
+    w = np.linalg.eigvalsh(ham.mtot.toarray())
+    emin, emax = chebyshev.ChebyshevPropagator(psi[:, 0], ham).bounds
+    assert emin <= w[0] + 1e-8 and emax >= w[-1] - 1e-8
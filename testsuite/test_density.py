@@ -0,0 +1,60 @@
+import numpy as np
+import scipy.sparse
+import envtb.ldos.hamiltonian
+from envtb.ldos import density, kpm
+
+
+def graphene_flake():
+    return envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=6, Ny=4)
+
+
+def test_chebyshev_coefficients_match_quadrature():
+    nmoments, scale, shift = 50, 9.5, 0.3
+    nodes = 2 * nmoments
+    theta = np.pi * (np.arange(nodes) + 0.5) / nodes
+    f = density.fermi_function(scale * np.cos(theta) + shift, 0.1, 0.05)
+    expected = np.dot(np.cos(np.outer(np.arange(nmoments), theta)), f) * 2. / nodes
+    expected[0] /= 2.
+    coefficients = density.fermi_chebyshev_coefficients(0.1, 0.05, nmoments,
+                                                        scale, shift)
+    assert np.allclose(coefficients, expected, atol=1e-13)
+
+
+def test_chebyshev_density_at_default_temperature():
+    ham = graphene_flake()
+    exact = density.electron_density(ham, mu=0.1, kT=0.0025, method='exact')
+    chebyshev = density.electron_density(ham, mu=0.1, kT=0.0025)
+    assert np.max(np.abs(chebyshev - exact)) < 1e-6
+
+
+def test_probe_colors_separate_sites():
+    ham = graphene_flake()
+    matrix = kpm.sparse_hamiltonian_matrix(ham)
+    distance = 3
+    reach = abs(matrix) + scipy.sparse.identity(matrix.shape[0])
+    reach = (reach**distance).toarray() > 0
+    for colors in (density.probe_colors(matrix, distance),
+                   density.probe_colors(matrix, distance, ham.coords_array(),
+                                        max_nnz=0)):
+        same = colors[:, np.newaxis] == colors[np.newaxis, :]
+        np.fill_diagonal(same, False)
+        assert not np.any(reach & same)
+
+
+def test_hamiltonian_density_counts_all_states():
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=8, Ny=8)
+    w = np.linalg.eigvalsh(kpm.sparse_hamiltonian_matrix(ham).toarray())
+    mu = 0.5 * (w[40] + w[41])
+    assert np.isclose(ham.electron_density(mu, kT=1e-4).sum(), 41)
+
+
+def test_probing_groups_sites_of_large_lattice():
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=60, Ny=8)
+    matrix = kpm.sparse_hamiltonian_matrix(ham)
+    engine = density.ElectronDensity(ham, probe_error=1e-4)
+    exact = density.electron_density(ham, mu=0.1, kT=1.0, method='exact')
+    assert np.max(np.abs(engine(0.1, 1.0) - exact)) < 1e-6
+    colors = density.probe_colors(matrix, 31, ham.coords_array())
+    assert colors.max() + 1 < matrix.shape[0]
+    assert np.array_equal(density.probe_colors(matrix, 10**4),
+                          np.arange(matrix.shape[0]))
@@ -0,0 +1,57 @@
+import filecmp
+import numpy as np
+import pytest
+import envtb.ldos.hamiltonian
+from envtb.time_propagator import ensemble
+
+
+class Pulse(object):
+
+    def __init__(self, stop_after=None):
+        self.stop_after = stop_after
+
+    def __call__(self, t):
+        if self.stop_after is not None and t > self.stop_after:
+            raise KeyboardInterrupt
+        return [1e-3 * np.sin(1e14 * t), 0.]
+
+
+def make_ensemble(directory, pulse=None):
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=6, Ny=4)
+    ham.build_hamiltonian()
+    eigenpairs = np.linalg.eigh(ham.mtot.toarray())
+    return ensemble.EnsemblePropagation(
+        ham, pulse or Pulse(), eigenpairs, dt=1e-16, nframes=60,
+        save_every=5, checkpoint_every=20, directory=str(directory))
+
+
+def output_files(propagation, Nstate):
+    return [propagation.file_name(kind, Nstate) for kind in
+            ('wave_functions', 'expansion', 'coords_current', 'dipole')]
+
+
+def test_resumed_run_writes_the_same_files(tmp_path):
+    full = make_ensemble(tmp_path / 'full')
+    assert full.run([3], nprocs=1) == [3]
+
+    # killed between the checkpoints at frames 40 and 60
+    interrupted = make_ensemble(tmp_path / 'part', Pulse(stop_after=50.5e-16))
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.run([3], nprocs=1)
+    resumed = make_ensemble(tmp_path / 'part')
+    assert resumed.run([3], nprocs=1) == [3]
+
+    for expected, actual in zip(output_files(full, 3), output_files(resumed, 3)):
+        assert filecmp.cmp(expected, actual, shallow=False)
+
+
+def test_process_pool_matches_serial_run(tmp_path):
+    serial = make_ensemble(tmp_path / 'serial')
+    serial.run([2, 5], nprocs=1)
+    pool = make_ensemble(tmp_path / 'pool')
+    assert sorted(pool.run([2, 5], nprocs=2)) == [2, 5]
+    assert pool.run([], nprocs=2) == []
+    for Nstate in (2, 5):
+        for expected, actual in zip(output_files(serial, Nstate),
+                                    output_files(pool, Nstate)):
+            assert filecmp.cmp(expected, actual, shallow=False)
@@ -0,0 +1,60 @@
+import warnings
+import numpy as np
+import scipy.sparse
+import pytest
+import envtb.ldos.hamiltonian
+from envtb.ldos import greens_function, leads
+
+
+def ribbon_with_potential():
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=5, Ny=4)
+    ham.build_hamiltonian()
+    potential = np.random.RandomState(1).uniform(-0.5, 0.5, ham.Ntot)
+    ham.mtot = (ham.mtot + scipy.sparse.diags(potential)).tocsr()
+    return ham
+
+
+def direct_inverse(ham, E, sigma_left, sigma_right, zplus=1e-12):
+    Ny = ham.Ny
+    matrix = (E + 1j * zplus) * np.eye(ham.Ntot) - ham.mtot.toarray()
+    matrix[:Ny, :Ny] -= sigma_left
+    matrix[-Ny:, -Ny:] -= sigma_right
+    return np.linalg.inv(matrix)
+
+
+def test_recursive_blocks_match_direct_inverse():
+    ham = ribbon_with_potential()
+    E, Nx, Ny = 0.4, ham.Nx, ham.Ny
+    sigma_left, sigma_right = leads.lead_self_energies(E, ham.m0, ham.mI)
+    G = direct_inverse(ham, E, sigma_left, sigma_right)
+    recursive = greens_function.RecursiveGreensFunction(
+        ham, E, sigma_left=sigma_left, sigma_right=sigma_right)
+
+    def block(i, j):
+        return G[i*Ny:(i+1)*Ny, j*Ny:(j+1)*Ny]
+
+    assert np.allclose(recursive.get_diagonal_elements(), np.diag(G))
+    for i, G_ii in enumerate(recursive.get_diagonal_blocks()):
+        assert np.allclose(G_ii, block(i, i))
+    offdiagonal = recursive.get_offdiagonal_blocks()
+    assert sorted(offdiagonal) == list(range(Nx - 1))
+    for i, (G_lower, G_upper) in offdiagonal.items():
+        assert np.allclose(G_lower, block(i + 1, i))
+        assert np.allclose(G_upper, block(i, i + 1))
+    assert np.allclose(recursive.get_corner_block(), block(0, Nx - 1))
+
+
+def test_greens_function_falls_back_to_direct_inverse():
+    ham = ribbon_with_potential()
+    matrix = ham.mtot.tolil()
+    matrix[0, ham.Ntot - 1] = matrix[ham.Ntot - 1, 0] = -0.2
+    ham.mtot = matrix.tocsr()
+    with pytest.raises(greens_function.SliceStructureError):
+        greens_function.RecursiveGreensFunction(ham, 0.4)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        diagonal = greens_function.GreensFunction(ham, 0.4).get_diagonal_elements()
+    assert any('direct inverse' in str(w.message) for w in caught)
+    G = direct_inverse(ham, 0.4, 0., 0.)
+    assert np.allclose(diagonal, np.diag(G))
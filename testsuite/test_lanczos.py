@@ -0,0 +1,41 @@
+import numpy as np
+import scipy.sparse.linalg
+import envtb.ldos.hamiltonian
+from envtb.time_propagator import lanczos
+
+hbar = 0.66 * 10**(-15)
+
+
+def graphene_and_states(nstates):
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=6, Ny=4)
+    ham.build_hamiltonian()
+    random = np.random.RandomState(0)
+    psi = random.normal(size=(ham.Ntot, nstates)) + \
+        1j * random.normal(size=(ham.Ntot, nstates))
+    return ham, psi / np.linalg.norm(psi, axis=0)
+
+
+def exact_step(ham, psi, dt):
+    return scipy.sparse.linalg.expm_multiply(-1j * dt / hbar * ham.mtot.tocsc(), psi)
+
+
+def test_lanczos_step_matches_expm_multiply():
+    ham, psi = graphene_and_states(1)
+    psi = psi[:, 0]
+    for regime in ('SIL', 'TSC'):
+        prop = lanczos.LanczosPropagator(psi, ham, NK=10, dt=2e-16)
+        wf, dt, NK = prop.propagate(num_error=1e-20, regime=regime)
+        assert np.allclose(wf.wf1d, exact_step(ham, psi, dt), atol=1e-8)
+        assert np.isclose(np.linalg.norm(wf.wf1d), 1., atol=1e-12)
+
+
+def test_block_lanczos_step_matches_expm_multiply():
+    ham, psi = graphene_and_states(3)
+    for regime in ('SIL', 'TSC'):
+        prop = lanczos.BlockLanczosPropagator(psi, ham, NK=10, dt=2e-16)
+        wf, dt, NK = prop.propagate(num_error=1e-20, regime=regime)
+        assert np.allclose(wf, exact_step(ham, psi, dt), atol=1e-8)
+        assert np.allclose(np.linalg.norm(wf, axis=0), 1., atol=1e-12)
+        single = lanczos.LanczosPropagator(psi[:, 1], ham, NK=NK, dt=dt)
+        assert np.allclose(single.propagate(num_error=1., regime='TSC')[0].wf1d,
+                           wf[:, 1], atol=1e-10)
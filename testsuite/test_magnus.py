@@ -0,0 +1,63 @@
+import numpy as np
+import scipy.sparse.linalg
+import envtb.ldos.hamiltonian
+from envtb.time_propagator import magnus, time_dependent_hamiltonian
+
+hbar = 0.66 * 10**(-15)
+
+
+def graphene():
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=5, Ny=4)
+    ham.build_hamiltonian()
+    w, v = np.linalg.eigh(ham.mtot.toarray())
+    return ham, v[:, ham.Ntot // 2 - 1].astype(complex)
+
+
+def scaled_x(ham):
+    x = ham.coords_array()[:ham.Ntot, 0]
+    return (x - x.mean()) / np.ptp(x)
+
+
+def test_static_hamiltonian_matches_expm_multiply():
+    ham, psi = graphene()
+    ham_t = time_dependent_hamiltonian.TimeDependentHamiltonian(ham)
+    dt, nsteps = 5e-16, 4
+    expected = scipy.sparse.linalg.expm_multiply(
+        -1j * nsteps * dt / hbar * ham_t.mtot.tocsc(), psi)
+    for backend in ('lanczos', 'chebyshev'):
+        propagator = magnus.MagnusPropagator(ham_t, dt, backend=backend,
+                                             num_error=1e-24)
+        wf, t = propagator.propagate(psi, 0., nsteps)
+        assert np.isclose(t, nsteps * dt)
+        assert np.allclose(wf, expected, atol=1e-8)
+
+
+def test_fourth_order_convergence():
+    ham, psi = graphene()
+    x = scaled_x(ham)
+    ham_t = time_dependent_hamiltonian.TimeDependentHamiltonian(
+        ham, scalar_potential=lambda t: 1.5 * np.sin(2e15 * t) * x)
+    T = 4e-15
+
+    def run(nsteps, backend='lanczos'):
+        propagator = magnus.MagnusPropagator(ham_t, T / nsteps, NK=14,
+                                             backend=backend, num_error=1e-26)
+        return propagator.propagate(psi, 0., nsteps)[0]
+
+    reference = run(256)
+    errors = [np.linalg.norm(run(nsteps) - reference) for nsteps in (16, 32)]
+    assert 12. < errors[0] / errors[1] < 24.
+    assert np.linalg.norm(run(32, 'chebyshev') - run(32)) < 1e-8
+
+
+def test_chebyshev_bounds_follow_growing_potential():
+    ham, psi = graphene()
+    x = scaled_x(ham)
+    T = 2e-13
+    # the potential grows far beyond the 5% margin of the first step
+    ham_t = time_dependent_hamiltonian.TimeDependentHamiltonian(
+        ham, scalar_potential=lambda t: 20. * t / T * x)
+    results = [magnus.MagnusPropagator(ham_t, T / 4, backend=backend, NK=14,
+                                       num_error=1e-24).propagate(psi, 0., 4)[0]
+               for backend in ('lanczos', 'chebyshev')]
+    assert np.allclose(results[0], results[1], atol=1e-8)
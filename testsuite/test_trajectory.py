@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from envtb.utility import trajectory
+
+
+def write_frames(file_name, nframes=7, N=5):
+    random = np.random.RandomState(0)
+    coords = random.normal(size=(N, 3))
+    frames = random.normal(size=(nframes, N)) + 1j * random.normal(size=(nframes, N))
+    times = 1e-16 * np.arange(nframes)
+    with trajectory.TrajectoryWriter(file_name, coords=coords) as writer:
+        for time, wf in zip(times, frames):
+            writer.append(wf, time)
+    return coords, times, frames
+
+
+def test_round_trip(tmp_path):
+    file_name = str(tmp_path / 'wf.trj')
+    coords, times, frames = write_frames(file_name)
+    assert trajectory.is_trajectory(file_name)
+
+    trj = trajectory.Trajectory(file_name)
+    assert len(trj) == len(frames)
+    assert np.array_equal(trj.coords, coords)
+    assert np.array_equal(trj.times, times)
+    for i in (0, 3, -1):
+        time, wf = trj[i]
+        assert time == times[i]
+        assert np.array_equal(wf, frames[i])
+    slice_times, slice_frames = trj[1:6:2]
+    assert np.array_equal(slice_frames, frames[1:6:2])
+
+    for start, stop, step in ((0, None, 1), (1, 6, 2), (2, None, 3), (5, 2, 1)):
+        iterated = list(trj.iterate(start, stop, step))
+        expected = list(range(len(frames)))[start:stop:step]
+        assert [time for time, wf in iterated] == list(times[expected])
+        for (time, wf), i in zip(iterated, expected):
+            assert np.array_equal(wf, frames[i])
+    assert len(list(trj)) == len(frames)
+
+
+def test_incomplete_frame_is_ignored_and_appended_over(tmp_path):
+    file_name = str(tmp_path / 'wf.trj')
+    coords, times, frames = write_frames(file_name, nframes=4)
+    with open(file_name, 'ab') as f:
+        f.write(b'\0' * 10)
+    assert len(trajectory.Trajectory(file_name)) == 4
+
+    with trajectory.TrajectoryWriter(file_name, append=True) as writer:
+        writer.append(frames[0], 1.)
+    trj = trajectory.Trajectory(file_name)
+    assert len(trj) == 5
+    assert trj[4][0] == 1. and np.array_equal(trj[4][1], frames[0])
+
+
+def test_not_a_trajectory(tmp_path):
+    file_name = str(tmp_path / 'wf.out')
+    with open(file_name, 'w') as f:
+        f.write('0.0 1.0\n' * 20)
+    assert not trajectory.is_trajectory(file_name)
+    with pytest.raises(ValueError):
+        trajectory.Trajectory(file_name)
@@ -0,0 +1,33 @@
+import numpy as np
+import envtb.ldos.hamiltonian
+from envtb.ldos import transport
+
+
+def test_surface_greens_function_of_chain():
+    H00, H01 = np.zeros((1, 1)), -np.ones((1, 1))
+    for E in (0., 0.3, -1.5):
+        g = transport.surface_greens_function(E, H00, H01)
+        expected = (E - 1j * np.sqrt(4. - E**2)) / 2.
+        assert np.allclose(g, expected, atol=1e-8)
+
+
+def test_surface_greens_function_solves_dyson_equation():
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=2, Ny=8)
+    H00, H01 = ham.m0.toarray(), ham.mI.toarray()
+    for E in (0., -0.126, 0.7):
+        g = transport.surface_greens_function(E, H00, H01)
+        z = (E + 1e-9j) * np.eye(len(H00))
+        dyson = np.linalg.inv(z - H00 - H01.dot(g).dot(H01.conj().T))
+        assert np.allclose(g, dyson, atol=1e-8)
+
+
+def test_clean_ribbon_has_integer_transmission():
+    chain = envtb.ldos.hamiltonian.HamiltonianTB(Ny=1, Nx=6)
+    ribbon = envtb.ldos.hamiltonian.HamiltonianTB(Ny=5, Nx=6)
+    graphene = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx=6, Ny=8)
+    for ham, energies, modes in ((chain, [800.], [1]),
+                                 (ribbon, [800., 500.], [5, 3]),
+                                 (graphene, [0., 0.5], [4, 1])):
+        device = transport.TwoTerminalDevice(ham)
+        T = [device.transmission(E) for E in energies]
+        assert np.allclose(T, modes, atol=1e-6)
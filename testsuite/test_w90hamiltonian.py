@@ -0,0 +1,409 @@
+import os
+import warnings
+import numpy as np
+from envtb.wannier90 import w90hamiltonian
+
+LATTICE = np.array([[2.46, 0., 0.], [1.23, 1.23 * np.sqrt(3), 0.], [0., 0., 10.]])
+POSITIONS = [[0., 0., 0.], [1.23, 0.71, 0.]]
+# hopping index -> value: onsite A, nearest neighbour, onsite B
+HOPPING = {0: 0.3, 1: -2.7, 2: -0.2}
+# cell, orbital, orbital, hopping index (grouped by cell)
+NN_LIST = [((0, 0, 0), 0, 0, 0), ((0, 0, 0), 0, 1, 1),
+           ((0, 0, 0), 1, 0, 1), ((0, 0, 0), 1, 1, 2),
+           ((-1, 0, 0), 0, 1, 1), ((1, 0, 0), 1, 0, 1),
+           ((0, -1, 0), 0, 1, 1), ((0, 1, 0), 1, 0, 1)]
+DEGENERACIES = {(0, 0, 0): 1, (-1, 0, 0): 2, (1, 0, 0): 2,
+                (0, -1, 0): 3, (0, 1, 0): 3}
+
+
+def write_nn_file(directory):
+    filename = os.path.join(str(directory), 'graphene.nn')
+    with open(filename, 'w') as f:
+        for vec in LATTICE:
+            f.write('%.12g %.12g %.12g\n' % tuple(vec))
+        f.write('\n')
+        for pos in POSITIONS:
+            f.write('0.5 %g %g %g\n' % tuple(pos))
+        f.write('\n')
+        for index, value in sorted(HOPPING.items()):
+            f.write('%d %g\n' % (index, value))
+        f.write('\n')
+        for cell, i, j, index in NN_LIST:
+            f.write('%d %d %d %d %d %d\n' % (cell + (i, j, index)))
+    return filename
+
+
+def reference_blocks():
+    blocks = {}
+    for cell, i, j, index in NN_LIST:
+        blocks.setdefault(cell, np.zeros((2, 2), dtype=complex))[i, j] = \
+            HOPPING[index]
+    return blocks
+
+
+def write_wannier90_files(directory, blocks=None):
+    """
+    wannier90_hr.dat (elements multiplied by the cell degeneracies, first
+    orbital index running fastest), POSCAR, wannier90.wout and OUTCAR.
+    """
+    directory = str(directory)
+    names = [os.path.join(directory, name) for name in
+             ('wannier90_hr.dat', 'POSCAR', 'wannier90.wout', 'OUTCAR')]
+    if blocks is None:
+        blocks = reference_blocks()
+    cells = sorted(blocks)
+    with open(names[0], 'w') as f:
+        f.write('written by test_w90hamiltonian\n2\n%d\n' % len(cells))
+        f.write(' '.join(str(DEGENERACIES[cell]) for cell in cells) + '\n')
+        for cell in cells:
+            for j in range(2):
+                for i in range(2):
+                    value = blocks[cell][i, j] * DEGENERACIES[cell]
+                    f.write('%d %d %d %d %d %.8f %.8f\n' % (
+                        cell + (i + 1, j + 1, value.real, value.imag)))
+    with open(names[1], 'w') as f:
+        f.write('graphene\n1.0\n')
+        for vec in LATTICE:
+            f.write('%.12g %.12g %.12g\n' % tuple(vec))
+        f.write('C\n2\nCartesian\n0 0 0\n1.23 0.71 0\n')
+    with open(names[2], 'w') as f:
+        f.write(' |  Number of Wannier Functions               :'
+                '               2                 |\n')
+        f.write(' Final State\n')
+        for nr, pos in enumerate(POSITIONS):
+            f.write('  WF centre and spread    %d  ( %.7f, %.7f, %.7f )'
+                    '     0.5000000\n' % ((nr + 1,) + tuple(pos)))
+    with open(names[3], 'w') as f:
+        f.write(' E-fermi :  -1.2345     XC(G=0):  -0.5\n')
+    return names
+
+
+def assert_same_blocks(ham, blocks):
+    assert len(ham.unitcellnumbers()) == len(blocks)
+    for cell, block in zip(ham.unitcellnumbers(), ham.matrixelements()):
+        assert np.allclose(block.toarray(), blocks[tuple(cell)])
+
+
+def test_cache_is_used_by_default(tmp_path):
+    filename = write_nn_file(tmp_path)
+    ham = w90hamiltonian.Hamiltonian.from_nth_nn_list(filename)
+    cachefiles = os.listdir(os.path.join(str(tmp_path), '.envtb_cache'))
+    assert len(cachefiles) == 1
+    assert_same_blocks(ham, reference_blocks())
+
+    cached = w90hamiltonian.Hamiltonian.from_nth_nn_list(filename)
+    assert cached.fingerprint() == ham.fingerprint()
+    assert cached.orbitalpositions() == ham.orbitalpositions()
+    assert os.listdir(os.path.join(str(tmp_path), '.envtb_cache')) == cachefiles
+
+
+def test_cache_key_follows_the_input_files(tmp_path):
+    filename = write_nn_file(tmp_path)
+    cachedir = os.path.join(str(tmp_path), '.envtb_cache')
+    w90hamiltonian.Hamiltonian.from_nth_nn_list(filename)
+
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    w90hamiltonian.Hamiltonian.from_nth_nn_list(filename)
+    assert len(os.listdir(cachedir)) == 2
+
+    with open(filename) as f:
+        content = f.read()
+    with open(filename, 'w') as f:
+        f.write(content.replace('1 -2.7', '1 -3.1'))
+    ham = w90hamiltonian.Hamiltonian.from_nth_nn_list(filename)
+    assert len(os.listdir(cachedir)) == 3
+    assert np.isclose(ham.maincell_hamiltonian_matrix()[0, 1], -3.1)
+
+    ham = w90hamiltonian.Hamiltonian.from_nth_nn_list(filename, {1: -2.0})
+    assert len(os.listdir(cachedir)) == 4
+    assert np.isclose(ham.maincell_hamiltonian_matrix()[0, 1], -2.0)
+
+
+def test_cache_can_be_disabled(tmp_path):
+    w90hamiltonian.Hamiltonian.from_file(*write_wannier90_files(tmp_path),
+                                         cache=None)
+    assert not os.path.exists(os.path.join(str(tmp_path), '.envtb_cache'))
+
+
+def test_hr_file_round_trip_through_the_cache(tmp_path):
+    names = write_wannier90_files(tmp_path)
+    for cache in (True, True, None):
+        ham = w90hamiltonian.Hamiltonian.from_file(*names, cache=cache)
+        assert_same_blocks(ham, reference_blocks())
+        assert np.allclose(ham.latticevectors(), LATTICE)
+        assert np.allclose(ham.orbitalpositions(), POSITIONS, atol=1e-6)
+        assert ham.fermi_energy() == -1.2345
+
+
+def graphene(tmp_path):
+    return w90hamiltonian.Hamiltonian.from_nth_nn_list(write_nn_file(tmp_path),
+                                                       cache=None)
+
+
+def loop_bloch_matrix(ham, k):
+    matrix = np.zeros((ham.nrorbitals(), ham.nrorbitals()), dtype=complex)
+    for cell, block in zip(ham.unitcellnumbers(), ham.matrixelements()):
+        R = np.dot(cell, ham.latticevectors())
+        matrix += np.exp(1j * np.dot(k, R)) * block.toarray()
+    return matrix
+
+
+def kpoint_path(ham, nrpoints=17):
+    reciprocal = ham.reciprocal_latticevectors()
+    return np.dot(np.random.RandomState(0).uniform(-1, 1, (nrpoints, 3)),
+                  reciprocal)
+
+
+def test_bloch_matrices_match_the_loop_over_cells(tmp_path):
+    ham = graphene(tmp_path)
+    kpoints = kpoint_path(ham)
+    matrices = ham.bloch_matrices(kpoints)
+    for k, matrix in zip(kpoints, matrices):
+        assert np.allclose(matrix, loop_bloch_matrix(ham, k))
+        assert np.allclose(matrix, matrix.conj().T)
+
+    direct = np.dot(kpoints, np.linalg.inv(ham.reciprocal_latticevectors()))
+    assert np.allclose(ham.bloch_matrices(direct, basis='d'), matrices)
+
+    usedcells = [[0, 0, 0], [1, 0, 0], [-1, 0, 0]]
+    reference = [sum(np.exp(1j * np.dot(k, np.dot(cell, LATTICE))) *
+                     reference_blocks()[tuple(cell)] for cell in usedcells)
+                 for k in kpoints]
+    assert np.allclose(ham.bloch_matrices(kpoints, usedhoppingcells=usedcells),
+                       reference)
+
+
+def test_bandstructure_matches_the_general_eigensolver(tmp_path):
+    ham = graphene(tmp_path)
+    kpoints = kpoint_path(ham)
+    reference = [np.sort(np.linalg.eigvals(loop_bloch_matrix(ham, k)).real)
+                 for k in kpoints]
+    for batchsize in (None, 5):
+        assert np.allclose(ham.bandstructure_data(kpoints, batchsize=batchsize),
+                           reference)
+    assert np.allclose(ham.bandstructure_data(kpoints, hermitian=False),
+                       reference)
+    assert np.allclose(ham.bloch_eigenvalues(kpoints[3]), reference[3])
+    # graphene: E = (eA+eB)/2 +- sqrt(((eA-eB)/2)^2 + t^2 |f(k)|^2)
+    K = np.dot([1. / 3, 2. / 3, 0], ham.reciprocal_latticevectors())
+    assert np.allclose(ham.bloch_eigenvalues(K), [-0.2, 0.3], atol=1e-6)
+
+
+def test_energy_window_and_band_range_select_from_the_full_spectrum(tmp_path):
+    ham = graphene(tmp_path).create_supercell_hamiltonian(
+        [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]],
+        [[2, 0, 0], [0, 2, 0], [0, 0, 1]])
+    kpoints = kpoint_path(ham)
+    full = [np.linalg.eigvalsh(loop_bloch_matrix(ham, k)) for k in kpoints]
+
+    window = (-2., 1.5)
+    data = ham.bandstructure_data(kpoints, energy_window=window)
+    for evals, reference in zip(data, full):
+        inside = reference[(reference > window[0]) & (reference <= window[1])]
+        assert np.allclose(evals, inside)
+
+    data = ham.bandstructure_data(kpoints, band_range=(2, 5))
+    assert np.allclose(data, [reference[2:6] for reference in full])
+
+    evals, evecs = ham.bloch_eigenvalues(kpoints[0], return_evecs=True,
+                                         band_range=(3, 4))
+    matrix = loop_bloch_matrix(ham, kpoints[0])
+    assert np.allclose(evals, full[0][3:5])
+    assert np.allclose(np.dot(matrix, evecs), evecs * evals)
+
+    assert np.allclose(ham.maincell_eigenvalues(energy_window=window),
+                       [e for e in np.linalg.eigvalsh(
+                           ham.maincell_hamiltonian_matrix().toarray())
+                        if window[0] < e <= window[1]])
+
+
+def read_hr_file_by_line(filename):
+    with open(filename) as f:
+        lines = f.readlines()
+    nrbands, nrcells = int(lines[1]), int(lines[2])
+    degeneracies = []
+    nr = 3
+    while len(degeneracies) < nrcells:
+        degeneracies.extend(int(x) for x in lines[nr].split())
+        nr += 1
+    blocks = {}
+    for line in lines[nr:]:
+        a, b, c, i, j = [int(x) for x in line.split()[:5]]
+        re, im = [float(x) for x in line.split()[5:]]
+        cellnr = len(blocks) - 1 if (a, b, c) in blocks else len(blocks)
+        block = blocks.setdefault((a, b, c), np.zeros((nrbands, nrbands),
+                                                      dtype=complex))
+        block[i - 1, j - 1] = (re + 1j * im) / degeneracies[cellnr]
+    return blocks
+
+
+def test_hr_reader_matches_the_line_by_line_parser(tmp_path):
+    random = np.random.RandomState(1)
+    blocks = {}
+    for cell in sorted(DEGENERACIES):
+        if cell not in blocks:
+            block = random.normal(size=(2, 2)) + 1j * random.normal(size=(2, 2))
+            block[0, 1] = 0.
+            blocks[cell] = block
+            blocks[tuple(-x for x in cell)] = block.conj().T
+    blocks[(0, 0, 0)] = blocks[(0, 0, 0)] + blocks[(0, 0, 0)].conj().T
+    names = write_wannier90_files(tmp_path, blocks)
+
+    reference = read_hr_file_by_line(names[0])
+    assert all(np.allclose(reference[cell], blocks[cell]) for cell in blocks)
+    ham = w90hamiltonian.Hamiltonian.from_file(*names, cache=None)
+    assert ham.unitcellnumbers() == [list(cell) for cell in sorted(blocks)]
+    assert_same_blocks(ham, reference)
+    assert ham.orbitalspreads() == [0.5, 0.5]
+
+
+def test_supercell_bands_are_the_folded_primitive_bands(tmp_path):
+    ham = graphene(tmp_path)
+    b = ham.reciprocal_latticevectors()
+    # the cells have to lie in the new unit cell
+    for latticevecs, cells, G in (
+            ([[2, 0, 0], [0, 1, 0], [0, 0, 1]], [[0, 0, 0], [1, 0, 0]], b[0] / 2),
+            ([[1, 1, 0], [-1, 1, 0], [0, 0, 1]], [[0, 0, 0], [0, 1, 0]],
+             (b[0] + b[1]) / 2)):
+        supercell = ham.create_supercell_hamiltonian(cells, latticevecs)
+        assert np.allclose(supercell.latticevectors(),
+                           np.dot(latticevecs, LATTICE))
+        assert np.allclose(supercell.orbitalpositions(),
+                           [np.add(p, np.dot(cell, LATTICE))
+                            for cell in cells for p in POSITIONS])
+        kpoints = kpoint_path(supercell)
+        folded = [np.sort(np.concatenate([ham.bloch_eigenvalues(k),
+                                          ham.bloch_eigenvalues(k + G)]))
+                  for k in kpoints]
+        assert np.allclose(supercell.bandstructure_data(kpoints), folded)
+
+    maincell = ham.create_supercell_hamiltonian(
+        [[0, 0, 0], [1, 0, 0]], [[2, 0, 0], [0, 1, 0], [0, 0, 1]],
+        output_maincell_only=True)
+    assert maincell.unitcellnumbers() == [[0, 0, 0]]
+    assert np.allclose(maincell.maincell_hamiltonian_matrix().toarray(),
+                       supercell_maincell_by_loop(ham, [[0, 0, 0], [1, 0, 0]]))
+
+
+def supercell_maincell_by_loop(ham, cells):
+    n = ham.nrorbitals()
+    matrix = np.zeros((n * len(cells), n * len(cells)), dtype=complex)
+    for cell, block in zip(ham.unitcellnumbers(), ham.matrixelements()):
+        for i, main in enumerate(cells):
+            other = list(np.add(main, cell))
+            if other in cells:
+                j = cells.index(other)
+                matrix[i * n:(i + 1) * n, j * n:(j + 1) * n] += block.toarray()
+    return matrix
+
+
+def peierls_by_loop(ham, B, gauge):
+    """
+    Peierls phases applied to every element of the dense blocks.
+    """
+    factor = B * 1.602176487 / 1.0545717 * 1e-5
+    positions = np.array(ham.orbitalpositions())
+    blocks = []
+    for cell, block in zip(ham.unitcellnumbers(), ham.matrixelements()):
+        block = block.toarray().astype(complex)
+        shift = np.dot(cell, ham.latticevectors())
+        for i, j in np.ndindex(*block.shape):
+            (x1, y1), (x2, y2) = positions[i, :2], (positions[j] + shift)[:2]
+            phase = {'landau_x': -0.5 * (x2 - x1) * (y2 + y1),
+                     'landau_y': 0.5 * (y2 - y1) * (x2 + x1),
+                     'symmetric': 0.25 * ((y2 - y1) * (x2 + x1) -
+                                          (x2 - x1) * (y2 + y1))}[gauge]
+            block[i, j] *= np.exp(1j * factor * phase)
+        blocks.append(block)
+    return blocks
+
+
+def test_peierls_phases_match_the_dense_loop(tmp_path):
+    ham = graphene(tmp_path)
+    cells = [[0, 0, 0], [0, 1, 0], [-1, 2, 0]]
+    ribbon_vecs = [[1, 0, 0], [-5, 10, 0], [0, 0, 1]]
+    ribbon = ham.create_supercell_hamiltonian(cells, ribbon_vecs)
+    for gauge in ('landau_x', 'landau_y', 'symmetric'):
+        field = ham.create_supercell_hamiltonian(cells, ribbon_vecs,
+                                                 magnetic_B=2000., gauge_B=gauge)
+        assert field.unitcellnumbers() == ribbon.unitcellnumbers()
+        for block, reference in zip(field.matrixelements(),
+                                    peierls_by_loop(ribbon, 2000., gauge)):
+            assert np.allclose(block.toarray(), reference)
+
+    field = ham.create_supercell_hamiltonian(cells, ribbon_vecs, magnetic_B=0.)
+    for block, reference in zip(field.matrixelements(), ribbon.matrixelements()):
+        assert np.allclose(block.toarray(), reference.toarray())
+
+    # landau_x keeps the periodicity in x: H(k) stays hermitian
+    field = ham.create_supercell_hamiltonian(cells, ribbon_vecs, magnetic_B=2000.)
+    for matrix in field.bloch_matrices(kpoint_path(field)):
+        assert np.allclose(matrix, matrix.conj().T)
+
+
+def test_flake_spectrum_does_not_depend_on_the_gauge(tmp_path):
+    ham = graphene(tmp_path)
+    cells = [[i, j, 0] for i in range(3) for j in range(3)]
+    flake_vecs = [[10, 0, 0], [0, 10, 0], [0, 0, 1]]
+    spectra = [ham.create_supercell_hamiltonian(
+        cells, flake_vecs, magnetic_B=B, gauge_B=gauge,
+        output_maincell_only=True).maincell_eigenvalues()
+        for B, gauge in ((None, 'landau_x'), (5000., 'landau_x'),
+                         (5000., 'landau_y'), (5000., 'symmetric'))]
+    assert not np.allclose(spectra[0], spectra[1], atol=1e-3)
+    assert np.allclose(spectra[1], spectra[2])
+    assert np.allclose(spectra[1], spectra[3])
+
+
+def closest_eigenvalues(matrix, nrbands, sigma):
+    evals = np.linalg.eigvalsh(matrix)
+    if sigma is None:
+        return evals[:nrbands]
+    return np.sort(evals[np.argsort(np.abs(evals - sigma))[:nrbands]])
+
+
+def test_sparse_bloch_solver_matches_eigh(tmp_path):
+    ham = graphene(tmp_path).create_supercell_hamiltonian(
+        [[i, j, 0] for i in range(6) for j in range(6)],
+        [[6, 0, 0], [0, 6, 0], [0, 0, 1]])
+    kpoints = kpoint_path(ham, 8)
+    matrices = ham.bloch_matrices(kpoints)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', UserWarning)
+        # maxiter=2 does not converge, lobpcg falls back to shift-invert
+        for method, sigma, maxiter in (('shift-invert', None, None),
+                                       ('shift-invert', 1.0, None),
+                                       ('lobpcg', None, None),
+                                       ('lobpcg', 0.1, None),
+                                       ('lobpcg', 1.0, 2)):
+            solver = ham.sparse_bloch_solver(nrbands=4, sigma=sigma,
+                                             method=method, maxiter=maxiter)
+            for k, matrix in zip(kpoints, matrices):
+                assert np.allclose(solver.bloch_matrix(k).toarray(), matrix)
+                evals, evecs = solver.eigenvalues(k, return_evecs=True)
+                assert np.allclose(evals, closest_eigenvalues(matrix, 4, sigma))
+                assert np.allclose(np.dot(matrix, evecs), evecs * evals)
+
+    data = ham.bandstructure_data(kpoints, solver='sparse', nrbands=4, sigma=1.0)
+    assert np.allclose(data, [closest_eigenvalues(matrix, 4, 1.0)
+                              for matrix in matrices])
+
+
+def test_process_pool_matches_the_serial_bandstructure(tmp_path):
+    ham = graphene(tmp_path).create_supercell_hamiltonian(
+        [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]],
+        [[2, 0, 0], [0, 2, 0], [0, 0, 1]])
+    kpoints = kpoint_path(ham, 23)
+    usedcells = [[0, 0, 0], [1, 0, 0], [-1, 0, 0]]
+    for options in ({}, {'band_range': (1, 4)}, {'hermitian': False},
+                    {'usedhoppingcells': usedcells, 'batchsize': 4}):
+        serial = ham.bandstructure_data(kpoints, **options)
+        assert np.allclose(ham.bandstructure_data(kpoints, nprocs=2, **options),
+                           serial)
+
+    window = (-2., 1.5)
+    serial = ham.bandstructure_data(kpoints, energy_window=window)
+    pool = ham.bandstructure_data(kpoints, energy_window=window, nprocs=2)
+    assert len(pool) == len(serial)
+    assert all(np.allclose(a, b) for a, b in zip(pool, serial))